@@ -0,0 +1,600 @@
+"""
+ASGI entry point serving the same routes as ``server:app``.
+
+Serving modes (chosen at deploy time with the SERVER_MODE env var, see Procfile):
+
+  SERVER_MODE=wsgi (default)
+      gunicorn server:app
+      Sync workers; every request holds a thread for its whole DB round trip.
+
+  SERVER_MODE=asgi
+      gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+      The read-heavy routes (conversation lists, search, stats, changes,
+      inventory list, inventory suggestions and the DB health check) run
+      natively on an async psycopg3 pool, so one worker can keep many DB
+      round trips in flight at once. The /api/events stream is native too,
+      so an open stream costs an asyncio queue rather than a thread.
+
+Both modes use Flask's url_map for routing. The native handlers reuse the
+query builders, row serializers, JSON provider, response cache, ETag and
+CORS rules from server.py, so their bodies and headers match what
+``server:app`` returns. They read from the primary only: read replicas
+(DATABASE_REPLICA_URLS) serve the Flask routes, not the native ones.
+Any route without a native handler (writes, photo streaming, export, bulk
+import, CORS preflights) is passed to the Flask app itself through a small
+WSGI adapter (wsgi_app), each request on its own thread from a pool of
+WSGI_THREADS (default DB_POOL_MAX), so a slow upload or export does not hold
+up the rest. All writes take this path and use server.py's psycopg2 pool;
+the async pool serves reads only.
+"""
+import io
+import os
+import time
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import tempfile
+from urllib.parse import parse_qsl
+
+from psycopg_pool import AsyncConnectionPool
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header, parse_etags
+
+import server
+
+ASYNC_POOL_MIN_SIZE = int(os.getenv("ASYNC_POOL_MIN_SIZE", 1))
+ASYNC_POOL_MAX_SIZE = int(os.getenv("ASYNC_POOL_MAX_SIZE", 20))
+ASYNC_POOL_TIMEOUT = float(os.getenv("ASYNC_POOL_TIMEOUT", 10))
+# Threads running Flask routes that have no native handler, one request each.
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", server.DB_POOL_MAX))
+
+url_adapter = server.app.url_map.bind("localhost")
+db_pool = None
+# Flask endpoint name of the request being served, used as the metrics label.
+current_endpoint = contextvars.ContextVar("current_endpoint", default="background")
+log = logging.getLogger("asgi")
+
+# -----------------------------------------------------------------
+# WSGI FALLBACK
+# -----------------------------------------------------------------
+wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="wsgi")
+
+# Request bodies larger than this are spooled to a temporary file.
+WSGI_SPOOL_MEMORY = 64 * 1024
+
+def _wsgi_environ(scope, body):
+    """PEP 3333 environ for an ASGI http scope, reading the request from `body`."""
+    script_name = scope.get("root_path", "")
+    path = scope["path"]
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        # The whole body has been read, so chunked uploads have no
+        # Content-Length yet are still complete.
+        "wsgi.input_terminated": True,
+        "wsgi.errors": io.StringIO(),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+    for raw_name, raw_value in scope["headers"]:
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = raw_value.decode("latin-1")
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+async def _read_body(receive):
+    """The request body as a rewound file, or None if the client went away."""
+    body = tempfile.SpooledTemporaryFile(max_size=WSGI_SPOOL_MEMORY)
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            body.close()
+            return None
+        body.write(message.get("body", b""))
+        if not message.get("more_body", False):
+            body.seek(0)
+            return body
+
+def _run_wsgi(environ, send, loop):
+    """
+    Call the Flask app on this (wsgi_executor) thread and relay its response
+    to the event loop, one chunk at a time so a streamed export waits for
+    the client. The response iterable is always closed, which is how
+    streamed routes return their pooled connection.
+    """
+    response = {}
+
+    def relay(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and response.get("sent"):
+            raise exc_info[1].with_traceback(exc_info[2])
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                               for name, value in headers]
+        return write
+
+    def write(data):
+        if not response.get("sent"):
+            response["sent"] = True
+            relay({"type": "http.response.start", "status": response["status"],
+                   "headers": response["headers"]})
+        if data:
+            relay({"type": "http.response.body", "body": data, "more_body": True})
+
+    iterable = server.app(environ, start_response)
+    try:
+        for chunk in iterable:
+            write(chunk)
+        write(b"")
+        relay({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+async def wsgi_app(scope, receive, send):
+    """Serve one request with the Flask app, on its own wsgi_executor thread."""
+    body = await _read_body(receive)
+    if body is None:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            wsgi_executor, contextvars.copy_context().run,
+            _run_wsgi, _wsgi_environ(scope, body), send, loop)
+    finally:
+        body.close()
+
+# -----------------------------------------------------------------
+# DATABASE CONNECTION WITH POOLING
+# -----------------------------------------------------------------
+async def open_db_pool():
+    """Open the async pool, preferring the internal URL like server.py does."""
+    global db_pool
+    candidates = (("primary", server.RAW_DATABASE_URL),
+                  ("public fallback", server.RAW_DATABASE_PUBLIC_URL))
+    for label, url in candidates:
+        if not url:
+            continue
+        dsn, sslmode, _ = server._dsn_and_sslmode(url)
+        pool = AsyncConnectionPool(
+            dsn,
+            kwargs={"sslmode": sslmode},
+            min_size=ASYNC_POOL_MIN_SIZE,
+            max_size=ASYNC_POOL_MAX_SIZE,
+            timeout=ASYNC_POOL_TIMEOUT,
+            open=False,
+        )
+        try:
+            await pool.open(wait=True, timeout=ASYNC_POOL_TIMEOUT)
+            db_pool = pool
+            log.info("Async connection pool created successfully (%s)", label)
+            return
+        except Exception as e:
+            log.warning("Async %s DB pool failed: %s", label, e)
+            await pool.close()
+    log.error("Async DB pool is not initialized")
+
+async def close_db_pool():
+    if db_pool is not None:
+        await db_pool.close()
+
+async def fetch_all(sql, params=None):
+    async with db_pool.connection() as conn:
+        async with conn.cursor() as cur:
+            started = time.perf_counter()
+            try:
+                await cur.execute(sql, params)
+            finally:
+                elapsed = time.perf_counter() - started
+                server.DB_QUERY_SECONDS.labels(current_endpoint.get()).observe(elapsed)
+            rows = await cur.fetchall()
+        if server.SLOW_QUERY_MS > 0 and elapsed * 1000 >= server.SLOW_QUERY_MS:
+            plan = None
+            if server._should_explain(sql):
+                plan = await _explain(conn, sql, params)
+            server.log_slow_query(sql, params, elapsed, current_endpoint.get(), plan)
+        return rows
+
+async def _explain(conn, sql, params):
+    """Like server.TimedCursor._explain, in a savepoint on the same connection."""
+    try:
+        async with conn.transaction():
+            async with conn.cursor() as cur:
+                await cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+                return "\n".join(row[0] for row in await cur.fetchall())
+    except Exception:
+        log.warning("EXPLAIN of a slow query failed", exc_info=True)
+        return None
+
+# -----------------------------------------------------------------
+# NATIVE ROUTES
+# -----------------------------------------------------------------
+async def _query_route(args, build, page, error):
+    """
+    Run a server.py query builder on the async pool and serialize the rows
+    with the matching page function. Returns (status, payload); `error` is
+    the same message the Flask route reports on a database failure.
+    """
+    try:
+        sql, params, *extra = build(args)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    if db_pool is None:
+        return 500, {"error": "Failed to connect to the database"}
+    try:
+        rows = await fetch_all(sql, params)
+    except Exception:
+        log.exception(error)
+        return 500, {"error": error}
+    try:
+        return 200, page(rows, *extra)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+
+def _list_route(endpoint):
+    where_sql, label = server.CONVERSATION_LIST_FILTERS[endpoint]
+
+    async def handler(args):
+        return await _query_route(
+            args, lambda a: server._list_conversations_query(a, where_sql),
+            server._conversation_page, f"Failed to fetch {label}")
+    return handler
+
+async def search_conversations(args):
+    return await _query_route(
+        args, server._search_conversations_query, server._search_page,
+        "Failed to search conversations")
+
+async def get_conversation_changes(args):
+    return await _query_route(
+        args, server._conversation_changes_query, server._changes_page,
+        "Failed to fetch conversation changes")
+
+async def get_conversation_stats(args):
+    return await _query_route(
+        args, lambda a: (server.CONVERSATION_STATS_SQL, None),
+        server._conversation_stats, "Failed to fetch conversation stats")
+
+async def get_inventory(args):
+    return await _query_route(
+        args, server._inventory_list_query, server._inventory_page,
+        "Failed to fetch inventory")
+
+async def suggest_inventory(args):
+    return await _query_route(
+        args, server._inventory_suggest_query, server._inventory_suggestions,
+        "Failed to suggest inventory names")
+
+async def health_check_db(args):
+    if db_pool is None:
+        return 500, {"status": "db: down"}
+    try:
+        await fetch_all("SELECT 1")
+        return 200, {"status": "db: up"}
+    except Exception:
+        log.exception("DB health check failed")
+        return 500, {"status": "db: error"}
+
+# Flask endpoint name -> (async handler, the route's @cached_response tag or
+# None when the Flask route is not cached)
+NATIVE_ROUTES = {
+    'get_conversations': (_list_route('get_conversations'), 'conversations'),
+    'get_saved_conversations': (_list_route('get_saved_conversations'), 'conversations'),
+    'get_shared_conversations': (_list_route('get_shared_conversations'), 'conversations'),
+    'search_conversations': (search_conversations, 'conversations'),
+    'get_conversation_stats': (get_conversation_stats, 'conversations'),
+    'get_conversation_changes': (get_conversation_changes, None),
+    'get_inventory': (get_inventory, 'inventory'),
+    'suggest_inventory': (suggest_inventory, 'inventory'),
+    'health_check_db': (health_check_db, None),
+}
+
+# -----------------------------------------------------------------
+# ASGI APPLICATION
+# -----------------------------------------------------------------
+def _match_native(scope):
+    """The endpoint name if a native or streaming handler serves it, else None."""
+    if scope["method"] not in ("GET", "HEAD"):
+        return None
+    try:
+        endpoint, _ = url_adapter.match(scope["path"], method="GET")
+    except HTTPException:
+        return None
+    if endpoint not in NATIVE_ROUTES and endpoint not in STREAMING_ROUTES:
+        return None
+    return endpoint
+
+def _request_header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+def _cors_headers(scope):
+    """
+    What server.py's CORS(app) (flask-cors defaults) adds: the request's
+    Origin echoed back with Vary: Origin, or * when there is none.
+    """
+    origin = _request_header(scope, b"origin")
+    if origin:
+        return [("Access-Control-Allow-Origin", origin), ("Vary", "Origin")]
+    return [("Access-Control-Allow-Origin", "*")]
+
+async def _send_response(send, status, body, headers):
+    headers = [*headers, (server.REQUEST_ID_HEADER, server.current_request_id.get())]
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+def _start_request(scope, endpoint):
+    """Set the metrics label and request ID seen by this request's queries and logs."""
+    current_endpoint.set(endpoint)
+    server.current_request_id.set(
+        server._pick_request_id(_request_header(scope, b"x-request-id")))
+
+async def _serve_native(scope, send, endpoint, handler, cache_tag):
+    started = time.perf_counter()
+    _start_request(scope, endpoint)
+    status = await _render_native(scope, send, handler, cache_tag)
+    server.record_request(scope["method"], endpoint, status, time.perf_counter() - started)
+
+async def _cache_ready():
+    """Like the check in server.cached_response, without blocking the loop."""
+    if not server.RESPONSE_CACHE_ENABLED:
+        return False
+    if server._cache_listener_pid != os.getpid():
+        return await asyncio.to_thread(server._ensure_cache_listener)
+    return server.response_cache.listening
+
+async def _render_native(scope, send, handler, cache_tag):
+    """
+    Run a native handler and send its response. A route with a cache tag
+    shares server.response_cache (same keys and entries) with its Flask
+    route and answers If-None-Match the same way. Returns the status sent.
+    """
+    query = scope["query_string"].decode("latin-1")
+    args = MultiDict(parse_qsl(query, keep_blank_values=True, errors="replace"))
+    key = (scope["path"], tuple(sorted(args.items(multi=True))))
+    use_cache = cache_tag is not None and await _cache_ready()
+    entry = server.response_cache.get(key) if use_cache else None
+    if entry is None:
+        generation = server.response_cache.generation(cache_tag) if cache_tag else None
+        status, payload = await handler(args)
+        rendered = server.app.json.response(payload)
+        body = rendered.get_data()
+        if status == 200 and cache_tag is not None:
+            entry = (body, rendered.mimetype, server._body_etag(body), {})
+            if use_cache:
+                server.response_cache.put(key, cache_tag, generation, entry)
+        content_type = rendered.content_type
+    else:
+        status = 200
+        body, content_type = entry[:2]
+    headers = _cors_headers(scope)
+
+    encoding = None
+    if server.COMPRESSION_ENABLED:
+        headers.append(("Vary", "Accept-Encoding"))
+        if len(body) >= server.COMPRESSION_MIN_SIZE:
+            encoding = server._negotiate_encoding(
+                parse_accept_header(_request_header(scope, b"accept-encoding")))
+
+    if entry is not None:
+        etag = entry[2]
+        # Weak when compressed, like server.compress_response.
+        headers += [("ETag", f'W/"{etag}"' if encoding else f'"{etag}"'),
+                    ("Cache-Control", "no-cache")]
+        if parse_etags(_request_header(scope, b"if-none-match")).contains_weak(etag):
+            await _send_response(send, 304, b"", headers)
+            return 304
+
+    if encoding:
+        variants = entry[3] if entry is not None else {}
+        data = variants.get(encoding)
+        if data is None:
+            data = variants[encoding] = server._compress_body(body, encoding)
+        body = data
+        headers.append(("Content-Encoding", encoding))
+    headers += [("Content-Type", content_type),
+                ("Content-Length", str(len(body)))]
+    if scope["method"] == "HEAD":
+        body = b""
+    await _send_response(send, status, body, headers)
+    return status
+
+# -----------------------------------------------------------------
+# EVENT STREAM
+# -----------------------------------------------------------------
+class _AsyncSubscriber:
+    """
+    An /api/events stream's inbox on the event loop, filled from server.py's
+    listener thread: lists of events, then None once closed.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=server.EVENTS_QUEUE_MAX)
+
+    def put(self, events):
+        try:
+            self.loop.call_soon_threadsafe(self._put, events)
+            return True
+        except RuntimeError:  # loop closed
+            return False
+
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self._close)
+        except RuntimeError:
+            pass
+
+    def _put(self, events):
+        try:
+            self.queue.put_nowait(events)
+        except asyncio.QueueFull:
+            self._close()
+
+    def _close(self):
+        # A full queue is closed by dropping its backlog.
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except asyncio.QueueFull:
+                self.queue.get_nowait()
+
+async def _send_json(scope, send, status, payload, headers=()):
+    rendered = server.app.json.response(payload)
+    body = rendered.get_data()
+    await _send_response(send, status, body, [
+        *_cors_headers(scope),
+        ("Content-Type", rendered.content_type),
+        ("Content-Length", str(len(body))),
+        *headers,
+    ])
+
+async def _wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def stream_events(scope, receive, send):
+    """
+    Native /api/events (see server.stream_events): each open stream is an
+    asyncio queue instead of a worker thread.
+    """
+    query = scope["query_string"].decode("latin-1")
+    args = MultiDict(parse_qsl(query, keep_blank_values=True, errors="replace"))
+    last_event_id = _request_header(scope, b"last-event-id") or args.get("last_event_id")
+
+    await asyncio.to_thread(server._ensure_cache_listener)
+    await asyncio.to_thread(server.event_hub.wait_started, server.DB_CONNECT_TIMEOUT)
+    subscriber = _AsyncSubscriber(asyncio.get_running_loop())
+    position = server.event_hub.subscribe(subscriber)
+    if position is None:
+        await _send_json(scope, send, 503, {"error": server.EVENTS_UNAVAILABLE}, [("Retry-After", "5")])
+        return 503
+
+    disconnect = None
+    try:
+        replay, last = [], position
+        if last_event_id:
+            try:
+                last = server._parse_event_id(last_event_id)
+            except ValueError:
+                replay = None
+            if replay is not None:
+                if db_pool is None:
+                    await _send_json(scope, send, 500, {"error": "Failed to connect to the database"})
+                    return 500
+                try:
+                    rows = await fetch_all(*server._events_replay_query(last, position))
+                except Exception:
+                    log.exception("Failed to replay events")
+                    await _send_json(scope, send, 500, {"error": "Failed to replay events"})
+                    return 500
+                replay = server._replay_events(rows, last)
+        if replay is None:
+            last = position
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [*((k.lower().encode("latin-1"), v.encode("latin-1"))
+                          for k, v in _cors_headers(scope)),
+                        (b"content-type", b"text/event-stream; charset=utf-8"),
+                        (b"cache-control", b"no-cache"),
+                        (b"x-accel-buffering", b"no"),
+                        (b"x-request-id", server.current_request_id.get().encode())],
+        })
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return 200
+        opening = "retry: 3000\n\n"
+        if replay is None:
+            opening += server._format_reset(position)
+        else:
+            opening += "".join(server._format_event(row) for row in replay)
+        await send({"type": "http.response.body", "body": opening.encode(), "more_body": True})
+
+        disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+        while True:
+            get = asyncio.ensure_future(subscriber.queue.get())
+            done, _ = await asyncio.wait({get, disconnect}, timeout=server.EVENTS_HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if get not in done:
+                get.cancel()
+                if disconnect in done:
+                    return 200
+                chunk = ": keepalive\n\n"
+            else:
+                events = get.result()
+                if events is None:
+                    await send({"type": "http.response.body", "body": b""})
+                    return 200
+                # Skip what a client coming from a worker further ahead has seen.
+                chunk = "".join(server._format_event(row) for row in events
+                                if tuple(row[:2]) > last)
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+    finally:
+        server.event_hub.unsubscribe(subscriber)
+        if disconnect is not None:
+            disconnect.cancel()
+
+async def _serve_stream(scope, receive, send, endpoint):
+    started = time.perf_counter()
+    _start_request(scope, endpoint)
+    status = await STREAMING_ROUTES[endpoint](scope, receive, send)
+    server.record_request(scope["method"], endpoint, status, time.perf_counter() - started)
+
+# Flask endpoint name -> async handler that sends its own streamed response
+STREAMING_ROUTES = {
+    'stream_events': stream_events,
+}
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await open_db_pool()
+            # Native routes skip Flask's after_request hooks that start it.
+            await asyncio.to_thread(server._ensure_ranking_thread)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_db_pool()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    endpoint = _match_native(scope) if scope["type"] == "http" else None
+    if endpoint is None:
+        await wsgi_app(scope, receive, send)
+    elif endpoint in STREAMING_ROUTES:
+        await _serve_stream(scope, receive, send, endpoint)
+    else:
+        await _serve_native(scope, send, endpoint, *NATIVE_ROUTES[endpoint])
@@ -0,0 +1,435 @@
+"""
+Load benchmark for the API.
+
+Starts a throwaway Postgres (initdb + pg_ctl from PATH, fsync off, deleted
+afterwards), migrates and seeds it, boots the app under gunicorn exactly as
+the Procfile does, then drives every route at a fixed concurrency for a
+fixed time. Prints (or writes) one JSON document per run:
+
+    {"config": {...}, "routes": {"<name>": {"requests", "errors", "rps",
+     "p50_ms", "p95_ms", "p99_ms", "max_ms"}, ...},
+     "rss_mb": {"<name>": <sum of worker RSS after the route>, ...}}
+
+Usage:
+    python benchmark.py --conversations 1000000 --photo-ratio 0.2 -o before.json
+    python benchmark.py ... -o after.json
+    python benchmark.py --compare before.json after.json
+
+Pass --database-url to benchmark against an existing (disposable!) database
+instead; it is migrated and seeded the same way.
+"""
+import argparse
+import base64
+import hashlib
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from migrations import run_migrations
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SEARCH_WORDS = ("weather", "recipe", "garden", "travel", "invoice", "python", "music", "repair")
+SECONDS_APART = 7  # created_at spacing of seeded conversations
+log = logging.getLogger("benchmark")
+
+# -----------------------------------------------------------------
+# THROWAWAY POSTGRES
+# -----------------------------------------------------------------
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class TempPostgres:
+    """A private Postgres cluster in a temp dir, torn down on exit."""
+
+    def __init__(self):
+        if not shutil.which("initdb") or not shutil.which("pg_ctl"):
+            sys.exit("initdb/pg_ctl not found on PATH; install Postgres or pass --database-url")
+        self.datadir = tempfile.mkdtemp(prefix="bench-pg-")
+        self.port = _free_port()
+
+    def __enter__(self):
+        subprocess.run(["initdb", "-D", self.datadir, "-U", "postgres", "--auth=trust"],
+                       check=True, stdout=subprocess.DEVNULL)
+        options = (f"-p {self.port} -k {self.datadir} -c listen_addresses=127.0.0.1 "
+                   "-c fsync=off -c synchronous_commit=off -c full_page_writes=off "
+                   "-c max_connections=200")
+        subprocess.run(["pg_ctl", "-D", self.datadir, "-o", options, "-w",
+                        "-l", os.path.join(self.datadir, "postgres.log"), "start"],
+                       check=True, stdout=subprocess.DEVNULL)
+        return f"postgresql://postgres@127.0.0.1:{self.port}/postgres"
+
+    def __exit__(self, *exc):
+        subprocess.run(["pg_ctl", "-D", self.datadir, "-m", "immediate", "stop"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.datadir, ignore_errors=True)
+
+# -----------------------------------------------------------------
+# SEEDING
+# -----------------------------------------------------------------
+def _fake_jpeg(size, rng):
+    """Incompressible bytes behind a JPEG signature, like a real photo on disk."""
+    return b"\xff\xd8\xff\xe0" + rng.randbytes(max(0, size - 4))
+
+def seed(url, args):
+    conn = psycopg2.connect(url, sslmode="disable")
+    try:
+        run_migrations(conn)
+        rng = random.Random(args.seed)
+        with conn.cursor() as cur:
+            # TRUNCATE fires no row or statement triggers, and these side
+            # tables have no foreign key to conversations, so clear them too
+            # and zero the stats counters the inserts below will add to.
+            cur.execute("TRUNCATE conversations, inventory, photo_inferences, ranking_refreshes, "
+                        "change_events, conversation_tombstones RESTART IDENTITY CASCADE")
+            cur.execute("UPDATE conversation_stats SET total = 0, saved = 0, shared = 0, "
+                        "rated = 0, rating_sum = 0, rating_count = 0")
+            # Text, flags, ratings and ages are generated server side; words
+            # from SEARCH_WORDS make the search route return real hits.
+            cur.execute('''
+                INSERT INTO conversations (conversation_text, created_at, is_saved, is_shared,
+                                           rating_sum, rating_count, rating_score, title)
+                SELECT (%s::text[])[1 + i %% %s] || ' ' || repeat(md5(i::text) || ' ', %s),
+                       (NOW() AT TIME ZONE 'utc') - make_interval(secs => i * %s),
+                       i %% 5 = 0,
+                       i %% 11 = 0,
+                       (i %% 5) * (i %% 7),
+                       i %% 7,
+                       CASE WHEN i %% 7 > 0 THEN ((i %% 5) * (i %% 7) + 15.0) / (i %% 7 + 5) END,
+                       CASE WHEN i %% 3 = 0 THEN NULL ELSE 'Conversation ' || i END
+                  FROM generate_series(1, %s) AS i
+            ''', (list(SEARCH_WORDS), len(SEARCH_WORDS), args.text_words, SECONDS_APART,
+                  args.conversations))
+            cur.execute('''
+                INSERT INTO rating_events (conversation_id, rating, created_at)
+                SELECT id, 1 + id %% 5, (NOW() AT TIME ZONE 'utc') - make_interval(hours => id %% 1000)
+                  FROM conversations
+                 WHERE rating_count > 0
+            ''')
+            cur.execute('''
+                INSERT INTO inventory (name)
+                SELECT 'Item ' || i || ' ' || md5(i::text) FROM generate_series(1, %s) AS i
+            ''', (args.inventory,))
+            conn.commit()
+
+            # A pool of distinct photos reused across rows keeps seeding fast
+            # while every photo still has realistic, incompressible size.
+            blobs = []
+            for _ in range(args.distinct_photos):
+                data = _fake_jpeg(int(rng.gauss(args.photo_bytes, args.photo_bytes / 4)) or 1024, rng)
+                blobs.append((hashlib.sha256(data).hexdigest(), data))
+            photo_ids = [i for i in range(1, args.conversations + 1) if rng.random() < args.photo_ratio]
+            for start in range(0, len(photo_ids), 1000):
+                rows = []
+                for conv_id in photo_ids[start:start + 1000]:
+                    digest, data = blobs[conv_id % len(blobs)]
+                    rows.append((conv_id, "image/jpeg", digest, len(data), psycopg2.Binary(data)))
+                execute_values(cur, '''
+                    INSERT INTO conversation_photos (conversation_id, content_type, sha256, byte_size, data)
+                    VALUES %s
+                ''', rows, page_size=len(rows))
+                conn.commit()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE")
+        return photo_ids
+    finally:
+        conn.close()
+
+# -----------------------------------------------------------------
+# APP UNDER TEST
+# -----------------------------------------------------------------
+def start_app(url, args):
+    port = _free_port()
+    env = dict(os.environ, DATABASE_URL=url, RESPONSE_CACHE_ENABLED="1" if args.cache else "0")
+    env.pop("DATABASE_PUBLIC_URL", None)
+    if args.workers:
+        env["WEB_CONCURRENCY"] = str(args.workers)
+    command = [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}"]
+    if args.mode == "asgi":
+        command += ["-k", "uvicorn.workers.UvicornWorker", "asgi:app"]
+    else:
+        command += ["server:app"]
+    proc = subprocess.Popen(command, cwd=HERE, env=env, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            status, _ = _request(port, "GET", "/api/health/db")
+            if status == 200:
+                return proc, port
+        except OSError:
+            pass
+        time.sleep(0.2)
+    stop_app(proc)
+    sys.exit("the app did not become healthy within 30s")
+
+def stop_app(proc):
+    os.killpg(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+def worker_rss_mb(master_pid):
+    """Summed RSS of the gunicorn workers (children of the master), from /proc."""
+    total_kb = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        if int(status.get("PPid", "0")) == master_pid:
+            total_kb += int(status.get("VmRSS", "0 kB").split()[0])
+    return round(total_kb / 1024, 1)
+
+# -----------------------------------------------------------------
+# LOAD GENERATION
+# -----------------------------------------------------------------
+def _request(port, method, path, body=None, conn=None):
+    own = conn is None
+    conn = conn or http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    headers = {"Accept-Encoding": "gzip"}
+    payload = None
+    if body is not None:
+        payload = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    conn.request(method, path, body=payload, headers=headers)
+    resp = conn.getresponse()
+    data = resp.read()
+    if own:
+        conn.close()
+    return resp.status, data
+
+def routes(args, photo_ids):
+    """(name, method, request factory) for every route; factories return (path, body)."""
+    n = args.conversations
+    photo = base64.b64encode(_fake_jpeg(args.photo_bytes, random.Random(1))).decode()
+    created = []  # ids from the POST route, consumed by the DELETE route
+    created_lock = threading.Lock()
+
+    def any_id(rng):
+        return rng.randint(1, n)
+
+    def photo_id(rng):
+        return rng.choice(photo_ids) if photo_ids else any_id(rng)
+
+    def take_created(rng):
+        with created_lock:
+            return created.pop() if created else any_id(rng)
+
+    def list_page(path):
+        return lambda rng: (path + "?" + urlencode({"limit": args.page_size}), None)
+
+    return created, created_lock, [
+        ("list", "GET", list_page("/api/conversations")),
+        ("list_saved", "GET", list_page("/api/conversations/saved")),
+        ("list_shared", "GET", list_page("/api/conversations/shared")),
+        ("list_sparse", "GET", lambda rng: (
+            "/api/conversations?" + urlencode({"limit": args.page_size, "fields": "id,title"}), None)),
+        ("search", "GET", lambda rng: (
+            "/api/conversations/search?" + urlencode({"q": rng.choice(SEARCH_WORDS), "limit": 20}), None)),
+        ("top_all", "GET", lambda rng: ("/api/conversations/top?limit=20", None)),
+        ("top_7d", "GET", lambda rng: ("/api/conversations/top?window=7d&limit=20", None)),
+        ("photo", "GET", lambda rng: (f"/api/conversations/{photo_id(rng)}/photo", None)),
+        ("export_1k", "GET", lambda rng: (
+            "/api/conversations/export?" + urlencode({
+                "fields": "id,title,created_at",
+                "since": (datetime.utcnow() - timedelta(seconds=1000 * SECONDS_APART)).isoformat(),
+            }), None)),
+        ("inventory", "GET", lambda rng: ("/api/inventory", None)),
+        ("health", "GET", lambda rng: ("/api/health", None)),
+        ("health_db", "GET", lambda rng: ("/api/health/db", None)),
+        ("create", "POST", lambda rng: ("/api/conversations", {
+            "conversation": "benchmark " + rng.choice(SEARCH_WORDS), "title": "bench",
+            **({"photo_base64": photo} if rng.random() < args.photo_ratio else {})})),
+        ("rate", "PATCH", lambda rng: (f"/api/conversations/{any_id(rng)}", {"rating": rng.randint(1, 5)})),
+        ("bulk_100", "POST", lambda rng: ("/api/conversations/bulk", [
+            {"conversation": f"bulk {i}"} for i in range(100)])),
+        ("delete", "DELETE", lambda rng: (f"/api/conversations/{take_created(rng)}", None)),
+        ("inventory_add", "POST", lambda rng: ("/api/inventory", {"name": f"bench {rng.random()}"})),
+        ("inventory_edit", "PUT", lambda rng: (
+            f"/api/inventory/{rng.randint(1, args.inventory)}", {"name": f"edited {rng.random()}"})),
+    ]
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return round(sorted_values[index] * 1000, 2)
+
+def drive(port, method, factory, args, on_response=None):
+    """Run `factory` requests from `args.concurrency` threads for `args.duration` seconds."""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def client(seed):
+        nonlocal errors
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        local, local_errors = [], 0
+        while time.monotonic() < deadline:
+            path, body = factory(rng)
+            started = time.perf_counter()
+            try:
+                status, data = _request(port, method, path, body, conn)
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                status, data = 0, b""
+            local.append(time.perf_counter() - started)
+            if status == 0 or status >= 400:
+                local_errors += 1
+            elif on_response:
+                on_response(data)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    threads = [threading.Thread(target=client, args=(args.seed + i,)) for i in range(args.concurrency)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": _percentile(latencies, 50),
+        "p95_ms": _percentile(latencies, 95),
+        "p99_ms": _percentile(latencies, 99),
+        "max_ms": _percentile(latencies, 100),
+    }
+
+def run(args):
+    with (TempPostgres() if not args.database_url else _Existing(args.database_url)) as url:
+        log.info("Seeding %s conversations, %s inventory items", args.conversations, args.inventory)
+        started = time.monotonic()
+        photo_ids = seed(url, args)
+        seed_seconds = round(time.monotonic() - started, 1)
+
+        proc, port = start_app(url, args)
+        try:
+            created, created_lock, scenarios = routes(args, photo_ids)
+
+            def remember_id(data):
+                try:
+                    conv_id = json.loads(data)["id"]
+                except (ValueError, KeyError, TypeError):
+                    return
+                with created_lock:
+                    created.append(conv_id)
+
+            results, rss = {}, {}
+            for name, method, factory in scenarios:
+                if args.only and name not in args.only:
+                    continue
+                log.info("%s: %s clients for %ss", name, args.concurrency, args.duration)
+                results[name] = drive(port, method, factory, args,
+                                      remember_id if name == "create" else None)
+                rss[name] = worker_rss_mb(proc.pid)
+        finally:
+            stop_app(proc)
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("output", "compare", "database_url")}
+    config["seed_seconds"] = seed_seconds
+    return {"config": config, "routes": results, "rss_mb": rss}
+
+class _Existing:
+    def __init__(self, url):
+        self.url = url
+
+    def __enter__(self):
+        return self.url
+
+    def __exit__(self, *exc):
+        pass
+
+# -----------------------------------------------------------------
+# COMPARISON
+# -----------------------------------------------------------------
+def compare(before_path, after_path):
+    """Print per-route changes between two result files (negative ms = faster)."""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    metrics = ("rps", "p50_ms", "p95_ms", "p99_ms")
+    print(f"{'route':<16}" + "".join(f"{m:>20}" for m in metrics) + f"{'rss_mb':>20}")
+    for name in sorted(set(before["routes"]) & set(after["routes"])):
+        cells = []
+        for metric in metrics + ("rss_mb",):
+            if metric == "rss_mb":
+                old, new = before["rss_mb"].get(name), after["rss_mb"].get(name)
+            else:
+                old, new = before["routes"][name][metric], after["routes"][name][metric]
+            if old in (None, 0) or new is None:
+                cells.append(f"{str(new):>20}")
+            else:
+                cells.append(f"{new:>10} ({(new - old) / old * 100:+6.1f}%)")
+        print(f"{name:<16}" + "".join(cells))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--conversations", type=int, default=100_000)
+    parser.add_argument("--inventory", type=int, default=10_000)
+    parser.add_argument("--photo-ratio", type=float, default=0.2,
+                        help="share of conversations with a photo")
+    parser.add_argument("--photo-bytes", type=int, default=200_000, help="mean photo size")
+    parser.add_argument("--distinct-photos", type=int, default=64)
+    parser.add_argument("--text-words", type=int, default=20,
+                        help="32-char words per conversation text")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per route")
+    parser.add_argument("--mode", choices=("wsgi", "asgi"), default="wsgi")
+    parser.add_argument("--workers", type=int, help="WEB_CONCURRENCY for gunicorn")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="disable the response cache")
+    parser.add_argument("--only", nargs="+", metavar="ROUTE", help="run only these routes")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database-url", help="use this (disposable) database instead of initdb")
+    parser.add_argument("-o", "--output", help="write the JSON result here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    result = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    else:
+        print(result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Gunicorn settings, sized to the per-worker DB pool in server.py.
+
+Each worker runs DB_POOL_MAX request threads. Its primary pool holds
+DB_POOL_MAX connections plus one per background thread (the ranking expiry
+thread, THUMBNAIL_WORKERS, and INFERENCE_WORKERS when INFERENCE_BACKEND is
+set), so every thread can hold a pooled connection and a request never
+queues behind background jobs.
+Worker count is capped so that workers * (that pool + 1) connections,
+counting the response-cache LISTEN connection, stay within
+DB_MAX_CONNECTIONS. Keep that value below the
+server's max_connections so migrations and admin sessions still fit.
+Set WEB_CONCURRENCY to override the worker count.
+
+gunicorn loads this file automatically from the working directory.
+"""
+import multiprocessing
+import os
+
+db_pool_max = int(os.getenv("DB_POOL_MAX", 10))
+db_max_connections = int(os.getenv("DB_MAX_CONNECTIONS", 90))
+# Mirrors DB_POOL_BACKGROUND in server.py.
+db_pool_background = 1 + int(os.getenv("THUMBNAIL_WORKERS", 2)) + (
+    int(os.getenv("INFERENCE_WORKERS", 1)) if os.getenv("INFERENCE_BACKEND") else 0)
+
+workers = int(os.getenv(
+    "WEB_CONCURRENCY",
+    max(1, min(multiprocessing.cpu_count() * 2 + 1, db_max_connections // (db_pool_max + db_pool_background + 1))),
+))
+worker_class = "gthread"
+threads = db_pool_max
+
+# Safe now that server.py opens its pool lazily in each worker after fork.
+preload_app = True
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers periodically to bound memory growth.
+max_requests = 10000
+max_requests_jitter = 1000
+
+def child_exit(server, worker):
+    # Drop the dead worker's live gauges from the multiprocess /metrics view.
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
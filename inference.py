@@ -0,0 +1,67 @@
+"""
+Pluggable photo inference backends.
+
+A backend has a `model` name, stored with every result so switching models
+re-runs inference, and an `infer_batch(images)` method that takes a list of
+image bytes and returns one JSON-serializable result per image, in order.
+It raises to fail the whole batch; server.py retries it.
+
+INFERENCE_BACKEND selects one:
+
+  (unset)              inference is off
+  stub                 StubBackend, a local stand-in for development and tests
+  roboflow             RoboflowBackend, a hosted model through inference_sdk
+  package.module:Name  any class with the interface above, built with no args
+"""
+import base64
+import hashlib
+import importlib
+
+
+class InferenceBackend:
+    model = None
+
+    def infer_batch(self, images):
+        raise NotImplementedError
+
+
+class StubBackend(InferenceBackend):
+    """Deterministic fake model: no network, no weights, instant."""
+    model = "stub"
+
+    def infer_batch(self, images):
+        return [{
+            "predictions": [],
+            "byte_size": len(image),
+            "digest": hashlib.sha256(image).hexdigest()[:16],
+        } for image in images]
+
+
+class RoboflowBackend(InferenceBackend):
+    """A hosted Roboflow model, called with one request per batch."""
+
+    def __init__(self, model_id, api_url, api_key):
+        from inference_sdk import InferenceHTTPClient
+        if not model_id:
+            raise ValueError("INFERENCE_MODEL_ID is required for the roboflow backend")
+        self.model = model_id
+        self.client = InferenceHTTPClient(api_url=api_url, api_key=api_key)
+
+    def infer_batch(self, images):
+        encoded = [base64.b64encode(image).decode("ascii") for image in images]
+        results = self.client.infer(encoded, model_id=self.model)
+        return results if isinstance(results, list) else [results]
+
+
+def load_backend(spec, model_id=None, api_url=None, api_key=None):
+    """Build the backend named by `spec`, or return None when it is empty."""
+    if not spec:
+        return None
+    if spec == "stub":
+        return StubBackend()
+    if spec == "roboflow":
+        return RoboflowBackend(model_id, api_url, api_key)
+    module_name, _, class_name = spec.partition(":")
+    if not class_name:
+        raise ValueError(f"Unknown inference backend: {spec}")
+    return getattr(importlib.import_module(module_name), class_name)()
@@ -0,0 +1,617 @@
+"""
+Versioned schema migrations.
+
+Each step runs once, in order, in its own transaction, and is recorded in
+the 'schema_version' table. A session-level advisory lock serializes
+concurrent runners (several deploy replicas starting at once), so exactly
+one process applies a given step. The web workers never run DDL; run
+`flask --app server migrate` before starting them (the Procfile does).
+
+Steps are append-only: never edit one that has shipped, add a new one.
+Step 1 is written with IF NOT EXISTS so it adopts databases created by the
+old per-worker startup code.
+"""
+import logging
+
+log = logging.getLogger("migrations")
+
+# Arbitrary constant key for pg_advisory_lock, shared by every runner.
+MIGRATION_LOCK_KEY = 720_416_001
+
+# (version, description, [SQL statements])
+MIGRATIONS = [
+    (1, "base conversations and inventory tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id SERIAL PRIMARY KEY,
+            conversation_text TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            is_saved BOOLEAN NOT NULL DEFAULT FALSE,
+            is_shared BOOLEAN NOT NULL DEFAULT FALSE
+        )
+        ''',
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS rating_sum FLOAT DEFAULT 0",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS rating_count INT DEFAULT 0",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS photo_base64 TEXT",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS title TEXT",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS is_saved BOOLEAN NOT NULL DEFAULT FALSE",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS is_shared BOOLEAN NOT NULL DEFAULT FALSE",
+        '''
+        CREATE TABLE IF NOT EXISTS inventory (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+        ''',
+    ]),
+    (2, "keyset pagination indexes on (created_at, id)", [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversations_created_id
+            ON conversations (created_at DESC, id DESC)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversations_saved_created_id
+            ON conversations (created_at DESC, id DESC)
+         WHERE is_saved
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversations_shared_created_id
+            ON conversations (created_at DESC, id DESC)
+         WHERE is_shared
+        ''',
+    ]),
+    (3, "conversation_photos side table", [
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_photos (
+            conversation_id INT PRIMARY KEY
+                REFERENCES conversations (id) ON DELETE CASCADE,
+            content_type TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            byte_size INT NOT NULL,
+            data BYTEA NOT NULL
+        )
+        ''',
+    ]),
+    (4, "response cache invalidation triggers", [
+        # The channel name must match server.CACHE_CHANNEL.
+        '''
+        CREATE OR REPLACE FUNCTION notify_response_cache() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('response_cache', TG_ARGV[0]);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS conversations_response_cache ON conversations",
+        '''
+        CREATE TRIGGER conversations_response_cache
+        AFTER INSERT OR UPDATE OR DELETE ON conversations
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_response_cache('conversations')
+        ''',
+        "DROP TRIGGER IF EXISTS conversation_photos_response_cache ON conversation_photos",
+        '''
+        CREATE TRIGGER conversation_photos_response_cache
+        AFTER INSERT OR UPDATE OR DELETE ON conversation_photos
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_response_cache('conversations')
+        ''',
+        "DROP TRIGGER IF EXISTS inventory_response_cache ON inventory",
+        '''
+        CREATE TRIGGER inventory_response_cache
+        AFTER INSERT OR UPDATE OR DELETE ON inventory
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_response_cache('inventory')
+        ''',
+    ]),
+    (5, "full-text search vector and GIN index", [
+        '''
+        ALTER TABLE conversations
+        ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', COALESCE(title, '')), 'A') ||
+            setweight(to_tsvector('english', COALESCE(conversation_text, '')), 'B')
+        ) STORED
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversations_search
+            ON conversations USING GIN (search_vector)
+        ''',
+    ]),
+    (6, "conversation_thumbnails table", [
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_thumbnails (
+            conversation_id INT NOT NULL
+                REFERENCES conversation_photos (conversation_id) ON DELETE CASCADE,
+            size INT NOT NULL,
+            source_sha256 TEXT NOT NULL,
+            content_type TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            byte_size INT NOT NULL,
+            data BYTEA NOT NULL,
+            PRIMARY KEY (conversation_id, size)
+        )
+        ''',
+        "DROP TRIGGER IF EXISTS conversation_thumbnails_response_cache ON conversation_thumbnails",
+        '''
+        CREATE TRIGGER conversation_thumbnails_response_cache
+        AFTER INSERT OR UPDATE OR DELETE ON conversation_thumbnails
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_response_cache('conversations')
+        ''',
+    ]),
+    (7, "photo_inferences job table keyed by photo hash", [
+        '''
+        CREATE TABLE IF NOT EXISTS photo_inferences (
+            sha256 TEXT NOT NULL,
+            model TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+                CHECK (status IN ('pending', 'running', 'done', 'failed')),
+            attempts INT NOT NULL DEFAULT 0,
+            result JSONB,
+            error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc'),
+            updated_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc'),
+            PRIMARY KEY (sha256, model)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_photo_inferences_queue
+            ON photo_inferences (model, created_at)
+         WHERE status IN ('pending', 'running')
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversation_photos_sha256
+            ON conversation_photos (sha256)
+        ''',
+        "DROP TRIGGER IF EXISTS photo_inferences_response_cache ON photo_inferences",
+        '''
+        CREATE TRIGGER photo_inferences_response_cache
+        AFTER INSERT OR UPDATE OR DELETE ON photo_inferences
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_response_cache('conversations')
+        ''',
+    ]),
+    (8, "rating events and Bayesian rankings", [
+        '''
+        CREATE TABLE IF NOT EXISTS rating_events (
+            id BIGSERIAL PRIMARY KEY,
+            conversation_id INT NOT NULL
+                REFERENCES conversations (id) ON DELETE CASCADE,
+            rating FLOAT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc')
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_rating_events_created
+            ON rating_events (created_at)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_rating_events_conversation
+            ON rating_events (conversation_id, created_at)
+        ''',
+        # All-time Bayesian average, kept current by every rating. Existing
+        # rows start from the default prior (mean 3, weight 5); run
+        # `flask --app server refresh-rankings` to apply a configured one.
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS rating_score FLOAT",
+        '''
+        UPDATE conversations
+           SET rating_score = (COALESCE(rating_sum, 0) + 15) / (COALESCE(rating_count, 0) + 5)
+         WHERE rating_count > 0
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversations_rating_score
+            ON conversations (rating_score DESC, id DESC)
+         WHERE rating_count > 0
+        ''',
+        # Per-window leaderboards (24h, 7d, ...): incremented by every rating.
+        # Expired ratings are subtracted incrementally, the events created in
+        # [expired_before, cutoff) of ranking_refreshes; a window with no
+        # refresh row is rebuilt from rating_events.
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_rankings (
+            window_name TEXT NOT NULL,
+            conversation_id INT NOT NULL
+                REFERENCES conversations (id) ON DELETE CASCADE,
+            rating_sum FLOAT NOT NULL,
+            rating_count INT NOT NULL,
+            score FLOAT NOT NULL,
+            PRIMARY KEY (window_name, conversation_id)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversation_rankings_score
+            ON conversation_rankings (window_name, score DESC, conversation_id DESC)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ranking_refreshes (
+            window_name TEXT PRIMARY KEY,
+            refreshed_at TIMESTAMP NOT NULL,
+            expired_before TIMESTAMP NOT NULL
+        )
+        ''',
+        "DROP TRIGGER IF EXISTS conversation_rankings_response_cache ON conversation_rankings",
+        '''
+        CREATE TRIGGER conversation_rankings_response_cache
+        AFTER INSERT OR UPDATE OR DELETE ON conversation_rankings
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_response_cache('conversations')
+        ''',
+    ]),
+    (9, "inventory name prefix and trigram indexes", [
+        # Needs a role allowed to create extensions (the database owner on
+        # PostgreSQL 13+, where pg_trgm is trusted).
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        # Fuzzy matches: `name % q`, nearest first via `ORDER BY name <-> q`,
+        # which GiST can serve and GIN cannot.
+        '''
+        CREATE INDEX IF NOT EXISTS idx_inventory_name_trgm_gist
+            ON inventory USING GIST (name gist_trgm_ops)
+        ''',
+        # Prefix matches in name order: in the C collation a plain btree
+        # serves both `LIKE 'q%'` and `ORDER BY lower(name) COLLATE "C"`,
+        # including one- and two-letter prefixes too short for trigrams.
+        '''
+        CREATE INDEX IF NOT EXISTS idx_inventory_name_prefix_c
+            ON inventory ((lower(name) COLLATE "C"))
+        ''',
+    ]),
+    (10, "conversation_stats counters maintained by triggers", [
+        # The figures are the sum over all 16 slots. Each write bumps the
+        # slot of its backend, so concurrent writers rarely wait on one row.
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_stats (
+            slot INT PRIMARY KEY,
+            total BIGINT NOT NULL DEFAULT 0,
+            saved BIGINT NOT NULL DEFAULT 0,
+            shared BIGINT NOT NULL DEFAULT 0,
+            rated BIGINT NOT NULL DEFAULT 0,
+            rating_sum FLOAT NOT NULL DEFAULT 0,
+            rating_count BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        INSERT INTO conversation_stats (slot)
+        SELECT generate_series(0, 15)
+        ON CONFLICT (slot) DO NOTHING
+        ''',
+        '''
+        UPDATE conversation_stats s
+           SET total = c.total, saved = c.saved, shared = c.shared, rated = c.rated,
+               rating_sum = c.rating_sum, rating_count = c.rating_count
+          FROM (SELECT COUNT(*) AS total,
+                       COUNT(*) FILTER (WHERE is_saved) AS saved,
+                       COUNT(*) FILTER (WHERE is_shared) AS shared,
+                       COUNT(*) FILTER (WHERE rating_count > 0) AS rated,
+                       COALESCE(SUM(rating_sum), 0) AS rating_sum,
+                       COALESCE(SUM(rating_count), 0) AS rating_count
+                  FROM conversations) c
+         WHERE s.slot = 0
+        ''',
+        # Statement-level with transition tables: a bulk insert of 1000 rows
+        # is one counter update, not 1000.
+        '''
+        CREATE OR REPLACE FUNCTION conversation_stats_apply() RETURNS trigger AS $$
+        DECLARE
+            changed TEXT;
+        BEGIN
+            -- Only the transition tables of the firing event exist.
+            changed := CASE TG_OP
+                WHEN 'INSERT' THEN 'SELECT 1 AS sign, * FROM new_rows'
+                WHEN 'DELETE' THEN 'SELECT -1 AS sign, * FROM old_rows'
+                ELSE 'SELECT 1 AS sign, * FROM new_rows
+                      UNION ALL SELECT -1 AS sign, * FROM old_rows'
+            END;
+            EXECUTE format($sql$
+                UPDATE conversation_stats s
+                   SET total = s.total + d.total,
+                       saved = s.saved + d.saved,
+                       shared = s.shared + d.shared,
+                       rated = s.rated + d.rated,
+                       rating_sum = s.rating_sum + d.rating_sum,
+                       rating_count = s.rating_count + d.rating_count
+                  FROM (SELECT COALESCE(SUM(sign), 0) AS total,
+                               COALESCE(SUM(sign) FILTER (WHERE is_saved), 0) AS saved,
+                               COALESCE(SUM(sign) FILTER (WHERE is_shared), 0) AS shared,
+                               COALESCE(SUM(sign) FILTER (WHERE rating_count > 0), 0) AS rated,
+                               COALESCE(SUM(sign * COALESCE(rating_sum, 0)), 0) AS rating_sum,
+                               COALESCE(SUM(sign * COALESCE(rating_count, 0)), 0) AS rating_count
+                          FROM (%s) changed) d
+                 WHERE s.slot = pg_backend_pid() %% 16
+                   AND (d.total, d.saved, d.shared, d.rated, d.rating_sum, d.rating_count)
+                       IS DISTINCT FROM (0::bigint, 0::bigint, 0::bigint, 0::bigint, 0::float, 0::bigint)
+            $sql$, changed);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS conversations_stats_insert ON conversations",
+        '''
+        CREATE TRIGGER conversations_stats_insert
+        AFTER INSERT ON conversations
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE conversation_stats_apply()
+        ''',
+        "DROP TRIGGER IF EXISTS conversations_stats_update ON conversations",
+        '''
+        CREATE TRIGGER conversations_stats_update
+        AFTER UPDATE ON conversations
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE conversation_stats_apply()
+        ''',
+        "DROP TRIGGER IF EXISTS conversations_stats_delete ON conversations",
+        '''
+        CREATE TRIGGER conversations_stats_delete
+        AFTER DELETE ON conversations
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE conversation_stats_apply()
+        ''',
+    ]),
+    (11, "change_events feed for /api/events", [
+        # Ordered by (txid, id): once txid is below the oldest running
+        # transaction, no event can still appear before it. The NOTIFY
+        # channel must match server.EVENTS_CHANNEL.
+        '''
+        CREATE TABLE IF NOT EXISTS change_events (
+            id BIGSERIAL PRIMARY KEY,
+            txid BIGINT NOT NULL DEFAULT txid_current(),
+            resource TEXT NOT NULL,
+            action TEXT NOT NULL CHECK (action IN ('created', 'updated', 'deleted')),
+            row_id INT NOT NULL,
+            data JSONB,
+            created_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc')
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_change_events_position
+            ON change_events (txid, id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_change_events_created
+            ON change_events (created_at)
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION record_change_event(
+            p_resource TEXT, p_action TEXT, p_row_id INT, p_data JSONB
+        ) RETURNS void AS $$
+        BEGIN
+            INSERT INTO change_events (resource, action, row_id, data)
+            VALUES (p_resource, p_action, p_row_id, p_data);
+            -- Repeats within one transaction are delivered once.
+            PERFORM pg_notify('change_events', '');
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION conversations_change_event() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM record_change_event('conversations', 'deleted', OLD.id, NULL);
+            ELSE
+                PERFORM record_change_event(
+                    'conversations',
+                    CASE TG_OP WHEN 'INSERT' THEN 'created' ELSE 'updated' END,
+                    NEW.id,
+                    jsonb_build_object(
+                        'conversation', NEW.conversation_text,
+                        'created_at', NEW.created_at,
+                        'is_saved', NEW.is_saved,
+                        'is_shared', NEW.is_shared,
+                        'rating_sum', COALESCE(NEW.rating_sum, 0),
+                        'rating_count', COALESCE(NEW.rating_count, 0),
+                        'title', NEW.title));
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS conversations_change_events ON conversations",
+        '''
+        CREATE TRIGGER conversations_change_events
+        AFTER INSERT OR DELETE ON conversations
+        FOR EACH ROW EXECUTE PROCEDURE conversations_change_event()
+        ''',
+        # Only changes to fields the API returns; rating_score refreshes
+        # and the like stay quiet.
+        "DROP TRIGGER IF EXISTS conversations_change_events_update ON conversations",
+        '''
+        CREATE TRIGGER conversations_change_events_update
+        AFTER UPDATE ON conversations
+        FOR EACH ROW
+        WHEN ((OLD.conversation_text, OLD.title, OLD.is_saved, OLD.is_shared,
+               OLD.rating_sum, OLD.rating_count)
+              IS DISTINCT FROM
+              (NEW.conversation_text, NEW.title, NEW.is_saved, NEW.is_shared,
+               NEW.rating_sum, NEW.rating_count))
+        EXECUTE PROCEDURE conversations_change_event()
+        ''',
+        # A new or removed photo is an update of its conversation, unless
+        # the conversation itself is being deleted.
+        '''
+        CREATE OR REPLACE FUNCTION conversation_photos_change_event() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                IF EXISTS (SELECT 1 FROM conversations WHERE id = OLD.conversation_id) THEN
+                    PERFORM record_change_event('conversations', 'updated', OLD.conversation_id,
+                                                jsonb_build_object('photo_sha256', NULL));
+                END IF;
+            ELSE
+                PERFORM record_change_event('conversations', 'updated', NEW.conversation_id,
+                                            jsonb_build_object('photo_sha256', NEW.sha256));
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS conversation_photos_change_events ON conversation_photos",
+        '''
+        CREATE TRIGGER conversation_photos_change_events
+        AFTER INSERT OR UPDATE OF sha256 OR DELETE ON conversation_photos
+        FOR EACH ROW EXECUTE PROCEDURE conversation_photos_change_event()
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION inventory_change_event() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM record_change_event('inventory', 'deleted', OLD.id, NULL);
+            ELSE
+                PERFORM record_change_event(
+                    'inventory',
+                    CASE TG_OP WHEN 'INSERT' THEN 'created' ELSE 'updated' END,
+                    NEW.id,
+                    jsonb_build_object('name', NEW.name));
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS inventory_change_events ON inventory",
+        '''
+        CREATE TRIGGER inventory_change_events
+        AFTER INSERT OR UPDATE OR DELETE ON inventory
+        FOR EACH ROW EXECUTE PROCEDURE inventory_change_event()
+        ''',
+    ]),
+    (12, "conversation change versions and delete tombstones", [
+        # (change_txid, change_seq) orders changes for delta sync the same
+        # way change_events does: read only below the oldest running
+        # transaction. Adding the columns rewrites the table once, giving
+        # every existing row its own version.
+        "CREATE SEQUENCE IF NOT EXISTS conversation_change_seq",
+        '''
+        ALTER TABLE conversations
+        ADD COLUMN IF NOT EXISTS change_txid BIGINT NOT NULL DEFAULT txid_current()
+        ''',
+        '''
+        ALTER TABLE conversations
+        ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT nextval('conversation_change_seq')
+        ''',
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP",
+        "UPDATE conversations SET updated_at = created_at WHERE updated_at IS NULL",
+        "ALTER TABLE conversations ALTER COLUMN updated_at SET DEFAULT (NOW() AT TIME ZONE 'utc')",
+        "ALTER TABLE conversations ALTER COLUMN updated_at SET NOT NULL",
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversations_change
+            ON conversations (change_txid, change_seq)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_tombstones (
+            conversation_id INT PRIMARY KEY,
+            deleted_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc'),
+            change_txid BIGINT NOT NULL DEFAULT txid_current(),
+            change_seq BIGINT NOT NULL DEFAULT nextval('conversation_change_seq')
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversation_tombstones_change
+            ON conversation_tombstones (change_txid, change_seq)
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION touch_conversations(ids INT[]) RETURNS void AS $$
+            UPDATE conversations
+               SET change_txid = txid_current(),
+                   change_seq = nextval('conversation_change_seq'),
+                   updated_at = NOW() AT TIME ZONE 'utc'
+             WHERE id = ANY(ids)
+        $$ LANGUAGE sql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION conversation_bump_change() RETURNS trigger AS $$
+        BEGIN
+            NEW.change_txid := txid_current();
+            NEW.change_seq := nextval('conversation_change_seq');
+            NEW.updated_at := NOW() AT TIME ZONE 'utc';
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        # Same column list as conversations_change_events_update (migration 11).
+        "DROP TRIGGER IF EXISTS conversations_bump_change ON conversations",
+        '''
+        CREATE TRIGGER conversations_bump_change
+        BEFORE UPDATE ON conversations
+        FOR EACH ROW
+        WHEN ((OLD.conversation_text, OLD.title, OLD.is_saved, OLD.is_shared,
+               OLD.rating_sum, OLD.rating_count)
+              IS DISTINCT FROM
+              (NEW.conversation_text, NEW.title, NEW.is_saved, NEW.is_shared,
+               NEW.rating_sum, NEW.rating_count))
+        EXECUTE PROCEDURE conversation_bump_change()
+        ''',
+        # A photo is written in the same transaction that locked its
+        # conversation, so it can bump it here. Thumbnails and inference
+        # results bump theirs from server.py after their own commit.
+        '''
+        CREATE OR REPLACE FUNCTION conversation_photos_touch() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM touch_conversations(ARRAY[OLD.conversation_id]);
+            ELSE
+                PERFORM touch_conversations(ARRAY[NEW.conversation_id]);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS conversation_photos_touch ON conversation_photos",
+        '''
+        CREATE TRIGGER conversation_photos_touch
+        AFTER INSERT OR UPDATE OF sha256 OR DELETE ON conversation_photos
+        FOR EACH ROW EXECUTE PROCEDURE conversation_photos_touch()
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION conversation_tombstones_record() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO conversation_tombstones (conversation_id)
+            SELECT id FROM old_rows
+            ON CONFLICT (conversation_id) DO NOTHING;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS conversations_tombstones ON conversations",
+        '''
+        CREATE TRIGGER conversations_tombstones
+        AFTER DELETE ON conversations
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE conversation_tombstones_record()
+        ''',
+    ]),
+]
+
+def current_version(cur):
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+def run_migrations(conn):
+    """
+    Apply every pending step on `conn` (a psycopg2 connection).
+    Returns the list of versions applied; raises on the first failure, after
+    rolling back that step.
+    """
+    applied = []
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        try:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc')
+                )
+            ''')
+            conn.commit()
+
+            version = current_version(cur)
+            for step_version, description, statements in MIGRATIONS:
+                if step_version <= version:
+                    continue
+                log.info("Applying migration %s: %s", step_version, description)
+                try:
+                    for statement in statements:
+                        cur.execute(statement)
+                    cur.execute(
+                        "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                        (step_version, description))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied.append(step_version)
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+            conn.commit()
+    return applied
@@ -1,18 +1,437 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+from werkzeug.wsgi import wrap_file
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess,
+)
 import psycopg2
-from psycopg2 import pool
+from psycopg2.extras import Json, execute_values
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.sql import Composable
+from migrations import run_migrations
+from inference import load_backend
 import os
-from datetime import datetime
+import io
+import time
+import select
+import threading
+import queue
+import functools
+import contextvars
+import logging
+import logging.handlers
+import atexit
+import sys
+import re
+import uuid
+import tempfile
+import itertools
+import random
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import csv
+import zlib
+import base64
+import binascii
+import hashlib
+import json
+from datetime import date, datetime, timezone
+
+try:
+    import orjson
+except ImportError:  # FastJSONProvider falls back to the stdlib encoder
+    orjson = None
+try:
+    import brotli
+except ImportError:  # responses are offered as zstd/gzip only
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # responses are offered as br/gzip only
+    zstandard = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails are not generated
+    Image = ImageOps = None
+
+# -----------------------------------------------------------------
+# JSON ENCODING
+# -----------------------------------------------------------------
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Encodes responses with orjson when it is installed, straight to bytes
+    (no intermediate str), and with the stdlib encoder otherwise. Either way
+    datetimes come out as ISO 8601 (`datetime.isoformat()`), instead of
+    Flask's default HTTP-date format, and keys keep insertion order.
+    """
+    sort_keys = False
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def _orjson_usable(self, kwargs):
+        # Pretty-printing (debug mode) and custom dumps() kwargs go through
+        # the stdlib path, which supports them.
+        return orjson is not None and not kwargs and (
+            self.compact or (self.compact is None and not self._app.debug))
+
+    def dumps(self, obj, **kwargs):
+        if self._orjson_usable(kwargs):
+            return orjson.dumps(obj, default=self.default,
+                                option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if not self._orjson_usable({}):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app)
 
+# -----------------------------------------------------------------
+# LOGGING
+# -----------------------------------------------------------------
+# Log lines are formatted in the thread that logs them, then handed to a
+# writer thread through a bounded queue, so a request never waits on
+# stderr; when the queue is full records are dropped and counted. Every
+# line carries the ID of the request that logged it (X-Request-ID, taken
+# from the client when well-formed, generated otherwise) and is echoed back
+# in the response header.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # or "text"
+LOG_QUEUE_MAX = 10000
+REQUEST_ID_HEADER = "X-Request-ID"
+_REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:-]{1,64}")
+current_request_id = contextvars.ContextVar("request_id", default=None)
+
+LOG_RECORDS_DROPPED = Counter(
+    "log_records_dropped", "Log records dropped because the log queue was full")
+
+# Attributes every LogRecord has; anything else came in through `extra=`.
+_LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "request_id"}
+
+class RequestIdFilter(logging.Filter):
+    """Stamps each record with the current request ID (None outside requests)."""
+
+    def filter(self, record):
+        record.request_id = current_request_id.get()
+        return True
+
+class StructuredFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message, request_id, any
+    `extra=` fields, and the traceback if there is one. With as_json=False,
+    the same fields as plain text.
+    """
+
+    def __init__(self, as_json=True):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        if self.as_json:
+            return json.dumps(entry, default=str)
+        head = f"{entry.pop('ts')} {entry.pop('level')} [{entry.pop('request_id') or '-'}] "
+        head += f"{entry.pop('logger')}: {entry.pop('message')}"
+        trace = entry.pop("exc_info", None)
+        fields = " ".join(f"{key}={value!r}" for key, value in entry.items())
+        return "\n".join(part for part in (head + (" " + fields if fields else ""), trace) if part)
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that starts its writer thread lazily in each process (so
+    it survives gunicorn's fork) and drops records instead of blocking.
+    """
+
+    def __init__(self, target):
+        super().__init__(queue.Queue(maxsize=LOG_QUEUE_MAX))
+        self.target = target
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A fresh queue: the parent's may have been copied mid-put.
+            self.queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+            listener = logging.handlers.QueueListener(self.queue, self.target)
+            listener.start()
+            atexit.register(listener.stop)
+            self._pid = os.getpid()
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+def _configure_logging():
+    """Route every logger (server, asgi, migrations, libraries) through the queue."""
+    root = logging.getLogger()
+    if any(isinstance(handler, QueueLogHandler) for handler in root.handlers):
+        return
+    writer = logging.StreamHandler(sys.stderr)
+    writer.setFormatter(logging.Formatter("%(message)s"))
+    handler = QueueLogHandler(writer)
+    handler.setFormatter(StructuredFormatter(as_json=LOG_FORMAT != "text"))
+    handler.addFilter(RequestIdFilter())
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+_configure_logging()
+log = logging.getLogger("server")
+
+def _pick_request_id(incoming):
+    """The client's request ID when it is well-formed, a fresh one otherwise."""
+    if incoming and _REQUEST_ID_RE.fullmatch(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+@app.before_request
+def _assign_request_id():
+    g.request_id = _pick_request_id(request.headers.get(REQUEST_ID_HEADER))
+    g.request_id_token = current_request_id.set(g.request_id)
+
+@app.after_request
+def _send_request_id(resp):
+    if 'request_id' in g:
+        resp.headers[REQUEST_ID_HEADER] = g.request_id
+    return resp
+
+@app.teardown_request
+def _clear_request_id(exc):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        current_request_id.reset(token)
+
+# -----------------------------------------------------------------
+# SLOW QUERY LOG
+# -----------------------------------------------------------------
+# Statements slower than SLOW_QUERY_MS are logged with their route and the
+# shape of their parameters (types and sizes, never values). A sampled
+# fraction of slow plain reads is run once more under EXPLAIN (ANALYZE,
+# BUFFERS), at most once per SLOW_QUERY_EXPLAIN_INTERVAL per worker, and
+# the plan is logged with them. Writes and statements with side effects
+# are never re-run.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 500))  # 0 disables the log
+SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv("SLOW_QUERY_EXPLAIN_SAMPLE", 0))
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", 60))
+SLOW_QUERY_MAX_STATEMENT = 2000
+
+slow_query_log = logging.getLogger("server.slow_query")
+_explained_at = None
+_explain_lock = threading.Lock()
+_SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+_SIDE_EFFECT_RE = re.compile(
+    r"\b(insert|update|delete|merge|nextval|setval|pg_notify|pg_advisory_\w*|"
+    r"touch_conversations|lock)\b", re.IGNORECASE)
+
+def _statement_text(query):
+    """The SQL as one line, string literals masked (execute_values inlines data)."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    text = " ".join(_SQL_LITERAL_RE.sub("'?'", str(query)).split())
+    if len(text) > SLOW_QUERY_MAX_STATEMENT:
+        text = text[:SLOW_QUERY_MAX_STATEMENT] + "..."
+    return text
+
+def _param_shape(value):
+    if value is None:
+        return "null"
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return f"{type(value).__name__}({len(value)})"
+    if isinstance(value, (list, tuple)):
+        kinds = sorted({_param_shape(item).split("(")[0] for item in value[:100]})
+        return f"{type(value).__name__}[{'|'.join(kinds)}]({len(value)})"
+    if isinstance(value, dict):
+        return f"dict({len(value)})"
+    return type(value).__name__
+
+def _params_shape(params):
+    """Types and sizes of a statement's parameters, e.g. ['int', 'str(12)']."""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: _param_shape(value) for key, value in params.items()}
+    return [_param_shape(value) for value in params]
+
+def _should_explain(query):
+    """Whether to capture a plan for this slow statement (sampled, rate limited)."""
+    global _explained_at
+    if SLOW_QUERY_EXPLAIN_SAMPLE <= 0 or random.random() >= SLOW_QUERY_EXPLAIN_SAMPLE:
+        return False
+    text = query.decode("utf-8", "replace") if isinstance(query, bytes) else str(query)
+    words = text.lstrip().split(None, 1)
+    if not words or words[0].upper() not in ("SELECT", "WITH") or _SIDE_EFFECT_RE.search(text):
+        return False
+    with _explain_lock:
+        now = time.monotonic()
+        if _explained_at is not None and now - _explained_at < SLOW_QUERY_EXPLAIN_INTERVAL:
+            return False
+        _explained_at = now
+    return True
+
+def log_slow_query(query, params, seconds, route, plan=None):
+    extra = {
+        "duration_ms": round(seconds * 1000, 1),
+        "route": route,
+        "statement": _statement_text(query),
+        "params": _params_shape(params),
+    }
+    if plan:
+        extra["plan"] = plan
+    slow_query_log.warning("Slow query (%.0f ms) in %s", seconds * 1000, route, extra=extra)
+
+# -----------------------------------------------------------------
+# METRICS
+# -----------------------------------------------------------------
+# Under gunicorn set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates every
+# worker (gunicorn.conf.py cleans up after dead workers).
+HTTP_REQUESTS = Counter(
+    "http_requests", "HTTP requests served", ["method", "endpoint", "status"])
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time to build the response", ["method", "endpoint"])
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Time spent in cursor.execute", ["endpoint"])
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Pooled connections currently checked out",
+    multiprocess_mode="livesum")
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_checkout_wait_seconds", "Time get_db_connection waited for a connection",
+    buckets=(.001, .005, .01, .05, .1, .25, .5, 1, 2.5, 5, 10))
+DB_POOL_ERRORS = Counter(
+    "db_pool_errors", "Failures in get_db_connection/release_db_connection",
+    ["operation", "reason"])
+
+def _metrics_endpoint():
+    """Endpoint label for the current request, 'background' outside one."""
+    if has_request_context():
+        return request.endpoint or "unmatched"
+    return "background"
+
+def record_request(method, endpoint, status, seconds):
+    HTTP_REQUESTS.labels(method, endpoint, str(status)).inc()
+    HTTP_REQUEST_SECONDS.labels(method, endpoint).observe(seconds)
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that reports every execute() to DB_QUERY_SECONDS and logs the
+    slow ones (see SLOW QUERY LOG).
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        succeeded = False
+        try:
+            result = super().execute(query, vars)
+            succeeded = True
+            return result
+        finally:
+            self._observe(query, vars, time.perf_counter() - start, succeeded)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            # No plan for executemany: it is only used for writes.
+            self._observe(query, None, time.perf_counter() - start, False)
+
+    def _observe(self, query, vars, seconds, explain):
+        endpoint = _metrics_endpoint()
+        DB_QUERY_SECONDS.labels(endpoint).observe(seconds)
+        if SLOW_QUERY_MS <= 0 or seconds * 1000 < SLOW_QUERY_MS:
+            return
+        if isinstance(query, Composable):
+            query = query.as_string(self.connection)
+        plan = None
+        # Named (server-side) cursors would re-run an export-sized scan.
+        if explain and self.name is None and _should_explain(query):
+            plan = self._explain(query, vars)
+        log_slow_query(query, vars, seconds, endpoint, plan)
+
+    def _explain(self, query, vars):
+        """
+        Run `query` again under EXPLAIN (ANALYZE, BUFFERS) on this cursor's
+        connection and return the plan text, or None if that fails. Inside a
+        transaction it runs in a savepoint, so a failure leaves the caller's
+        transaction usable; a plain cursor keeps it out of the metrics.
+        """
+        conn = self.connection
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) "
+        statement = prefix.encode() + query if isinstance(query, bytes) else prefix + query
+        in_transaction = not conn.autocommit
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                if in_transaction:
+                    cur.execute("SAVEPOINT slow_query_explain")
+                try:
+                    cur.execute(statement, vars)
+                    plan = "\n".join(row[0] for row in cur.fetchall())
+                except Exception:
+                    if in_transaction:
+                        cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                    raise
+                finally:
+                    if in_transaction:
+                        cur.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        except Exception:
+            log.warning("EXPLAIN of a slow query failed", exc_info=True)
+            return None
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        record_request(request.method, _metrics_endpoint(), response.status_code,
+                       time.perf_counter() - started)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        body = generate_latest(registry)
+    else:
+        body = generate_latest()
+    return Response(body, mimetype=CONTENT_TYPE_LATEST)
+
 # -----------------------------------------------------------------
 # DATABASE CONNECTION WITH POOLING
 # -----------------------------------------------------------------
 from urllib.parse import urlparse
-import re as _re
 
 # Prefer the internal connection if present; fall back to public
 RAW_DATABASE_URL = os.getenv(
@@ -34,340 +453,2612 @@ def _dsn_and_sslmode(url: str):
         sslmode = "disable"
     return url, sslmode, host
 
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+# Background threads that each hold a connection while they work: the
+# ranking expiry thread, the thumbnail executor and, with a backend
+# configured, the inference workers. The primary pool gets this many
+# connections on top of DB_POOL_MAX (one per request thread), so background
+# load never makes a request wait.
+DB_POOL_BACKGROUND = 1 + int(os.getenv("THUMBNAIL_WORKERS", 2)) + (
+    int(os.getenv("INFERENCE_WORKERS", 1)) if os.getenv("INFERENCE_BACKEND") else 0)
+# Seconds a request waits for a free connection before getting a 503.
+DB_POOL_CHECKOUT_TIMEOUT = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT", 5))
+# Idle connections older than this are pinged before reuse...
+DB_POOL_VALIDATE_AFTER = float(os.getenv("DB_POOL_VALIDATE_AFTER", 30))
+# ...and older than this are closed and replaced.
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", 300))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 5))
+# Minimum seconds between attempts to rebuild a pool that failed to connect.
+DB_POOL_RETRY_INTERVAL = float(os.getenv("DB_POOL_RETRY_INTERVAL", 5))
+
+class PoolExhausted(Exception):
+    """No pooled connection became free within DB_POOL_CHECKOUT_TIMEOUT."""
+
+class ConnectionPool:
+    """
+    Per-process pool of psycopg2 connections.
+
+    Unlike psycopg2.pool.ThreadedConnectionPool it waits (bounded) for a
+    free connection instead of failing at once, keeps returned connections
+    up to `maxconn` instead of closing everything above `minconn`, and
+    validates or recycles connections that have been sitting idle.
+    """
+
+    def __init__(self, dsn, sslmode, minconn, maxconn):
+        self._connect_kwargs = dict(dsn=dsn, sslmode=sslmode,
+                                    connect_timeout=DB_CONNECT_TIMEOUT,
+                                    cursor_factory=TimedCursor)
+        self.maxconn = maxconn
+        self.closed = False
+        self._idle = []  # [(conn, returned_at)], most recently returned last
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        return psycopg2.connect(**self._connect_kwargs)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self, timeout):
+        """Check out a usable connection, waiting up to `timeout` seconds."""
+        if not self._slots.acquire(timeout=timeout):
+            raise PoolExhausted(f"no connection free after {timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    conn, returned_at = self._idle.pop() if self._idle else (None, None)
+                if conn is None:
+                    return self._connect()
+                idle_for = time.monotonic() - returned_at
+                if conn.closed or idle_for > DB_POOL_MAX_IDLE:
+                    self._close(conn)
+                elif idle_for > DB_POOL_VALIDATE_AFTER and not self._is_alive(conn):
+                    self._close(conn)
+                else:
+                    return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """Return a connection, discarding it if it is broken."""
+        try:
+            if self.closed or conn.closed:
+                self._close(conn)
+                return
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._close(conn)
+                return
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            now = time.monotonic()
+            with self._lock:
+                self._idle.append((conn, now))
+                # Reap connections nobody has needed for a while.
+                while self._idle and now - self._idle[0][1] > DB_POOL_MAX_IDLE:
+                    self._close(self._idle.pop(0)[0])
+        except Exception:
+            self._close(conn)
+            raise
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self.closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
 def _create_pool(url: str):
     dsn, sslmode, host = _dsn_and_sslmode(url)
     # Log a sanitized DSN for debugging
-    safe_dsn = _re.sub(r":[^@]+@", ":***@", dsn)
-    print(f"[INFO] DB connecting to {safe_dsn} (sslmode={sslmode})")
-    return psycopg2.pool.ThreadedConnectionPool(
-        minconn=1,
-        maxconn=10,
-        dsn=dsn,
-        sslmode=sslmode
-    )
+    safe_dsn = re.sub(r":[^@]+@", ":***@", dsn)
+    log.info("DB connecting to %s (sslmode=%s)", safe_dsn, sslmode)
+    return ConnectionPool(dsn, sslmode, minconn=DB_POOL_MIN,
+                          maxconn=DB_POOL_MAX + DB_POOL_BACKGROUND)
 
+# The pool is created lazily in each process on first use, never at import,
+# so a gunicorn --preload master never hands its sockets to forked workers.
 db_pool = None
-try:
-    db_pool = _create_pool(RAW_DATABASE_URL)
-    print("[INFO] Connection pool created successfully (primary)")
-except Exception as e:
-    print(f"[WARN] Primary DB pool failed: {e}")
-    if RAW_DATABASE_PUBLIC_URL:
+db_url_in_use = None  # URL the pool connected with; reused for LISTEN connections
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pool_failed_at = None
+_conn_pools = {}  # id(conn) -> pool it was checked out from
+_inherited_pools = []  # pools copied across fork; kept referenced, never closed
+
+def _build_pool():
+    """Create this process's pool: internal URL first, then the public one."""
+    global db_pool, db_url_in_use
+    candidates = (("primary", RAW_DATABASE_URL), ("public fallback", RAW_DATABASE_PUBLIC_URL))
+    for label, url in candidates:
+        if not url:
+            continue
         try:
-            db_pool = _create_pool(RAW_DATABASE_PUBLIC_URL)
-            print("[INFO] Connection pool created successfully (public fallback)")
-        except Exception as e2:
-            print(f"[ERROR] Public fallback DB pool failed: {e2}")
+            db_pool = _create_pool(url)
+            db_url_in_use = url
+            log.info("Connection pool created successfully (%s, pid %s)", label, os.getpid())
+            return db_pool
+        except Exception as e:
+            log.warning("%s DB pool failed: %s", label.capitalize(), e)
+    return None
+
+def _get_pool():
+    """Return this process's pool, (re)building it when needed."""
+    global db_pool, _pool_pid, _pool_failed_at
+    if db_pool is not None and _pool_pid == os.getpid():
+        return db_pool
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            # Inherited across fork: closing it would also close the parent's
+            # sockets, so just forget it (and keep it from being collected).
+            if db_pool is not None:
+                _inherited_pools.append(db_pool)
+            db_pool = None
+            _conn_pools.clear()
+            _pool_pid = os.getpid()
+        if db_pool is None:
+            retry_ok = (_pool_failed_at is None or
+                        time.monotonic() - _pool_failed_at >= DB_POOL_RETRY_INTERVAL)
+            if retry_ok and _build_pool() is None:
+                _pool_failed_at = time.monotonic()
+        return db_pool
+
+def _discard_pool(failed_pool):
+    """Drop a pool whose database stopped accepting connections."""
+    global db_pool, _pool_failed_at
+    with _pool_lock:
+        if db_pool is failed_pool:
             db_pool = None
+            _pool_failed_at = None  # fail over right away on the next checkout
+    failed_pool.closeall()
+
+def get_db_connection(primary=False):
+    """
+    Get a connection from this worker's pool. Waits at most
+    DB_POOL_CHECKOUT_TIMEOUT for a free one and then raises PoolExhausted
+    (answered with a 503). Returns None when the database is unreachable.
+
+    GET/HEAD requests are served from a read replica when one is configured
+    and healthy (see READ REPLICAS); pass primary=True for reads that must
+    see the latest writes or that write themselves.
+    """
+    if not primary and _replicas_allowed():
+        conn = _get_replica_connection()
+        if conn is not None:
+            return conn
+    current_pool = _get_pool()
+    if not current_pool:
+        log.error("DB pool is not initialized")
+        DB_POOL_ERRORS.labels("checkout", "no_pool").inc()
+        return None
+    started = time.perf_counter()
+    try:
+        conn = current_pool.getconn(DB_POOL_CHECKOUT_TIMEOUT)
+    except PoolExhausted:
+        log.warning("DB pool exhausted after waiting %ss", DB_POOL_CHECKOUT_TIMEOUT)
+        DB_POOL_ERRORS.labels("checkout", "exhausted").inc()
+        raise
+    except psycopg2.OperationalError:
+        log.exception("Failed to get connection from pool")
+        DB_POOL_ERRORS.labels("checkout", "connect").inc()
+        # The server went away: rebuild, falling back to the public URL.
+        _discard_pool(current_pool)
+        return None
+    except Exception:
+        log.exception("Failed to get connection from pool")
+        DB_POOL_ERRORS.labels("checkout", "other").inc()
+        return None
+    finally:
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+    _conn_pools[id(conn)] = current_pool
+    DB_POOL_CHECKED_OUT.inc()
+    return conn
+
+def release_db_connection(conn):
+    """Release a connection back to the pool it came from."""
+    if not conn:
+        return
+    owner = _conn_pools.pop(id(conn), None)
+    if owner is not None:
+        DB_POOL_CHECKED_OUT.dec()
+    try:
+        if owner is None:
+            conn.close()
+        else:
+            owner.putconn(conn)
+    except Exception:
+        log.exception("Failed to release connection")
+        DB_POOL_ERRORS.labels("release", "error").inc()
+
+@app.errorhandler(PoolExhausted)
+def handle_pool_exhausted(e):
+    resp = jsonify({"error": "Database is busy, please retry"})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = '1'
+    return resp
+
+# -----------------------------------------------------------------
+# READ REPLICAS
+# -----------------------------------------------------------------
+# Comma-separated replica URLs, same format as DATABASE_URL. Each gets its
+# own lazily built per-process pool. A replica lagging more than
+# REPLICA_MAX_LAG seconds, or failing to connect, is skipped until its next
+# check; with none usable, reads go to the primary.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",")
+                         if url.strip()]
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 2))
+# After a successful write a client reads from the primary for this long
+# (tracked in a cookie), so it always sees its own writes.
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+READ_YOUR_WRITES_COOKIE = "primary_until"
+
+class Replica:
+    """One replica's pool plus its last health/lag check."""
+
+    def __init__(self, url):
+        self.url = url
+        self.pool = None
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+        self._check_lock = threading.Lock()
+
+    def usable(self):
+        """Re-check health at most every REPLICA_CHECK_INTERVAL; never blocks on another thread's check."""
+        due = self.checked_at is None or time.monotonic() - self.checked_at >= REPLICA_CHECK_INTERVAL
+        if due and self._check_lock.acquire(blocking=False):
+            try:
+                self._check()
+            finally:
+                self.checked_at = time.monotonic()
+                self._check_lock.release()
+        return self.healthy
+
+    def _check(self):
+        conn = None
+        try:
+            if self.pool is None:
+                dsn, sslmode, _ = _dsn_and_sslmode(self.url)
+                self.pool = ConnectionPool(dsn, sslmode, minconn=0, maxconn=DB_POOL_MAX)
+            conn = self.pool.getconn(DB_POOL_CHECKOUT_TIMEOUT)
+            with conn.cursor() as cur:
+                # Fully replayed WAL means no lag even if the primary is idle;
+                # a server that is not in recovery (e.g. a second local
+                # instance in tests) counts as lag-free.
+                cur.execute('''
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                ''')
+                self.lag = float(cur.fetchone()[0])
+            self.healthy = self.lag <= REPLICA_MAX_LAG
+            if not self.healthy:
+                log.warning("Replica lag %.1fs exceeds %ss; reading from primary",
+                            self.lag, REPLICA_MAX_LAG)
+        except Exception as e:
+            log.warning("Replica health check failed: %s", e)
+            self.healthy = False
+            self.discard()
+            conn = None
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+
+    def discard(self):
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.closeall()
+
+_replicas = []
+_replicas_pid = None
+
+def _get_replicas():
+    """This process's replicas; like the primary pool, rebuilt after fork."""
+    global _replicas, _replicas_pid
+    if _replicas_pid != os.getpid():
+        with _pool_lock:
+            if _replicas_pid != os.getpid():
+                # Inherited pools share the parent's sockets: forget, don't close.
+                _inherited_pools.extend(r.pool for r in _replicas if r.pool is not None)
+                _replicas = [Replica(url) for url in DATABASE_REPLICA_URLS]
+                _replicas_pid = os.getpid()
+    return _replicas
+
+def _replicas_allowed():
+    """Reads of the current request may go to a replica."""
+    if not DATABASE_REPLICA_URLS or not has_request_context():
+        return False
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    try:
+        sticky_until = float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0))
+    except ValueError:
+        sticky_until = 0
+    return sticky_until < time.time()
+
+def _get_replica_connection():
+    """A connection to a healthy replica, or None to use the primary."""
+    candidates = [replica for replica in _get_replicas() if replica.usable()]
+    if not candidates:
+        return None
+    replica = random.choice(candidates)
+    pool = replica.pool
+    if pool is None:
+        return None
+    try:
+        conn = pool.getconn(DB_POOL_CHECKOUT_TIMEOUT)
+    except PoolExhausted:
+        DB_POOL_ERRORS.labels("replica_checkout", "exhausted").inc()
+        return None
+    except Exception as e:
+        log.warning("Replica connection failed, reading from primary: %s", e)
+        DB_POOL_ERRORS.labels("replica_checkout", "connect").inc()
+        replica.healthy = False
+        replica.discard()
+        return None
+    _conn_pools[id(conn)] = pool
+    DB_POOL_CHECKED_OUT.inc()
+    g.db_replica = True
+    return conn
+
+@app.after_request
+def mark_read_your_writes(resp):
+    """Pin a client that just wrote to the primary for READ_YOUR_WRITES_SECONDS."""
+    if (DATABASE_REPLICA_URLS and request.method not in ('GET', 'HEAD', 'OPTIONS')
+            and resp.status_code < 400):
+        resp.set_cookie(READ_YOUR_WRITES_COOKIE, f"{time.time() + READ_YOUR_WRITES_SECONDS:.3f}",
+                        max_age=int(READ_YOUR_WRITES_SECONDS) + 1, httponly=True, samesite='Lax')
+    return resp
+
+# -----------------------------------------------------------------
+# SCHEMA MIGRATIONS
+# -----------------------------------------------------------------
+# Schema changes live in migrations.py and are applied by
+# `flask --app server migrate` before the workers start; importing this
+# module never runs DDL.
+@app.cli.command("migrate")
+def migrate_command():
+    """Apply pending schema migrations (safe to run from several processes)."""
+    conn = get_db_connection()
+    if not conn:
+        log.error("No DB connection in migrate")
+        raise SystemExit(1)
+    try:
+        applied = run_migrations(conn)
+        if applied:
+            log.info("Applied migrations: %s", applied)
+        else:
+            log.info("Schema is up to date")
+    except Exception:
+        log.exception("Migration failed")
+        raise SystemExit(1)
+    finally:
+        release_db_connection(conn)
+
+# -----------------------------------------------------------------
+# RESPONSE CACHE
+# -----------------------------------------------------------------
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") not in ("0", "false", "False")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 30))
+CACHE_CHANNEL = "response_cache"  # also hard-coded in migration 4
+
+class ResponseCache:
+    """
+    Size-bounded LRU of rendered GET responses with a TTL.
+
+    Every entry is tagged with the resource it was built from ('conversations'
+    or 'inventory'). Invalidating a tag bumps its generation, which lazily
+    retires every entry of that tag and stops in-flight renders that started
+    before the write from being stored.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.listening = False
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._invalidated_at = {}
+        self._lock = threading.Lock()
+
+    def generation(self, tag):
+        with self._lock:
+            return self._generations.get(tag, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            tag, generation, expires, value = entry
+            if generation != self._generations.get(tag, 0) or expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, tag, generation, value):
+        with self._lock:
+            if generation != self._generations.get(tag, 0):
+                return
+            self._entries[key] = (tag, generation, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tag):
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            self._invalidated_at[tag] = time.monotonic()
+
+    def invalidated_within(self, tag, seconds):
+        with self._lock:
+            invalidated_at = self._invalidated_at.get(tag)
+        return invalidated_at is not None and time.monotonic() - invalidated_at < seconds
+
+    def clear(self):
+        with self._lock:
+            for tag in self._generations:
+                self._generations[tag] += 1
+            self._entries.clear()
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+_cache_listener_pid = None
+_cache_listener_lock = threading.Lock()
+
+def _cache_listener_loop():
+    """
+    LISTEN on a dedicated connection for invalidations from every worker
+    (fired by the triggers from migration 4) and for change events (see
+    CHANGE EVENTS). While not listening the cache is bypassed, so a worker
+    never serves entries it might have missed an invalidation for.
+    """
+    while True:
+        conn = None
+        try:
+            dsn, sslmode, _ = _dsn_and_sslmode(db_url_in_use)
+            conn = psycopg2.connect(dsn=dsn, sslmode=sslmode,
+                                    connect_timeout=DB_CONNECT_TIMEOUT)
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CACHE_CHANNEL}")
+                cur.execute(f"LISTEN {EVENTS_CHANNEL}")
+                cur.execute(EVENTS_HEAD_SQL)
+                event_hub.start(tuple(cur.fetchone() or (0, 0)))
+            response_cache.clear()
+            response_cache.listening = True
+            pruned_at = 0
+            while True:
+                timeout = EVENTS_POLL_INTERVAL if event_hub.has_subscribers else 30
+                if select.select([conn], [], [], timeout) == ([], [], []):
+                    # Idle: poll for held-back events, which also makes sure
+                    # the connection is still alive.
+                    with conn.cursor() as cur:
+                        if event_hub.has_subscribers:
+                            _poll_change_events(cur)
+                        else:
+                            cur.execute("SELECT 1")
+                    continue
+                conn.poll()
+                changed = False
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    if notify.channel == EVENTS_CHANNEL:
+                        changed = True
+                    else:
+                        response_cache.invalidate(notify.payload)
+                if changed:
+                    with conn.cursor() as cur:
+                        _poll_change_events(cur)
+                        if time.monotonic() - pruned_at > EVENTS_PRUNE_INTERVAL:
+                            _prune_change_events(cur)
+                            pruned_at = time.monotonic()
+        except Exception as e:
+            log.warning("Response cache listener lost its connection: %s", e)
+        finally:
+            response_cache.listening = False
+            response_cache.clear()
+            event_hub.stop()
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(5)
+
+def _ensure_cache_listener():
+    """Start the listener once per worker process (after any fork)."""
+    global _cache_listener_pid
+    if not _get_pool():
+        return False
+    if _cache_listener_pid != os.getpid():
+        with _cache_listener_lock:
+            if _cache_listener_pid != os.getpid():
+                threading.Thread(target=_cache_listener_loop, name="cache-listener",
+                                 daemon=True).start()
+                _cache_listener_pid = os.getpid()
+    return response_cache.listening
+
+def _body_etag(body):
+    """Strong ETag for a rendered response body."""
+    return hashlib.sha256(body).hexdigest()[:32]
+
+def cached_response(tag):
+    """
+    Cache a GET view's 200 responses keyed by path and query string, and
+    answer If-None-Match with 304 using a strong ETag of the body. Each entry
+    also keeps the compressed variants of its body (filled in by
+    compress_response), so a polled list is compressed once per encoding.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            use_cache = RESPONSE_CACHE_ENABLED and _ensure_cache_listener()
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = response_cache.get(key) if use_cache else None
+            if entry is None:
+                generation = response_cache.generation(tag)
+                resp = app.make_response(view(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+                body = resp.get_data()
+                entry = (body, resp.mimetype, _body_etag(body), {})
+                # A replica may not have replayed a just-invalidating write
+                # yet: serve its render, but don't keep it.
+                from_lagging_replica = (g.get('db_replica') and
+                                        response_cache.invalidated_within(tag, REPLICA_MAX_LAG))
+                if use_cache and not from_lagging_replica:
+                    response_cache.put(key, tag, generation, entry)
+
+            body, mimetype, etag, g.compressed_variants = entry
+            resp = Response(body, status=200, mimetype=mimetype)
+            resp.set_etag(etag)
+            resp.cache_control.no_cache = True
+            return resp.make_conditional(request)
+        return wrapper
+    return decorator
+
+# -----------------------------------------------------------------
+# CHANGE EVENTS
+# -----------------------------------------------------------------
+# Row triggers (migration 11) append every create, update and delete of a
+# conversation or inventory item to change_events and NOTIFY EVENTS_CHANNEL.
+# The listener thread above reads new events on its own connection and the
+# hub fans them out to every /api/events stream in the worker, so streams
+# cost no database connection while they wait.
+EVENTS_CHANNEL = "change_events"  # also hard-coded in migration 11
+# Seconds between polls while streams are open: an event whose transaction
+# committed behind an older, still running one is held until that finishes.
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", 1))
+EVENTS_RETENTION_HOURS = float(os.getenv("EVENTS_RETENTION_HOURS", 24))
+EVENTS_PRUNE_INTERVAL = 600
+EVENTS_HEARTBEAT = 15
+EVENTS_BATCH_SIZE = 500
+# Events a stream may fall behind by before it is closed; the client
+# reconnects with Last-Event-ID and catches up from the table.
+EVENTS_QUEUE_MAX = 1000
+# Longest backlog replayed on reconnect; beyond it the client gets a reset.
+EVENTS_REPLAY_MAX = int(os.getenv("EVENTS_REPLAY_MAX", 5000))
+# Open streams per worker under the Flask app, where each one holds a
+# request thread (gunicorn runs DB_POOL_MAX); further clients get a 503.
+# Kept below the thread count so streams cannot starve other requests.
+# asgi.py serves /api/events natively and is not limited.
+EVENTS_MAX_STREAMS = int(os.getenv("EVENTS_MAX_STREAMS", max(1, DB_POOL_MAX // 2)))
+
+# Events are ordered by (txid, id) and only read once txid is below the
+# oldest running transaction, so a later poll never finds an earlier event.
+EVENTS_SELECT_SQL = '''
+    SELECT txid, id, resource, action, row_id, data
+    FROM change_events
+'''
+EVENTS_HEAD_SQL = '''
+    SELECT txid, id
+    FROM change_events
+    WHERE txid < txid_snapshot_xmin(txid_current_snapshot())
+    ORDER BY txid DESC, id DESC
+    LIMIT 1
+'''
+
+class EventHub:
+    """
+    This worker's /api/events subscribers. `position` is the (txid, id) of
+    the last event published, or None while the listener is down; a stream
+    gets every event after the position it subscribed at.
+    """
+
+    def __init__(self):
+        self.position = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._started = threading.Event()
+
+    @property
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def subscribe(self, subscriber):
+        """Add `subscriber`; returns its start position, or None if not listening."""
+        with self._lock:
+            if self.position is None:
+                return None
+            self._subscribers.add(subscriber)
+            return self.position
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def start(self, position):
+        with self._lock:
+            self.position = position
+        self._started.set()
+
+    def wait_started(self, timeout):
+        """Wait up to `timeout` seconds for the listener; True once it is up."""
+        return self._started.wait(timeout)
+
+    def publish(self, events):
+        with self._lock:
+            self.position = tuple(events[-1][:2])
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if not subscriber.put(events):
+                self.unsubscribe(subscriber)
+                subscriber.close()
+
+    def stop(self):
+        """Close every stream; clients reconnect and replay what they missed."""
+        self._started.clear()
+        with self._lock:
+            self.position = None
+            subscribers, self._subscribers = self._subscribers, set()
+        for subscriber in subscribers:
+            subscriber.close()
+
+event_hub = EventHub()
+
+def _poll_change_events(cur):
+    """Publish the events committed since the hub's position."""
+    while event_hub.position is not None:
+        cur.execute(EVENTS_SELECT_SQL + '''
+            WHERE (txid, id) > (%s, %s)
+              AND txid < txid_snapshot_xmin(txid_current_snapshot())
+            ORDER BY txid, id
+            LIMIT %s
+        ''', (*event_hub.position, EVENTS_BATCH_SIZE))
+        events = cur.fetchall()
+        if events:
+            event_hub.publish(events)
+        if len(events) < EVENTS_BATCH_SIZE:
+            return
+
+def _prune_change_events(cur):
+    cur.execute('''
+        DELETE FROM change_events
+         WHERE created_at < (NOW() AT TIME ZONE 'utc') - %s * INTERVAL '1 hour'
+    ''', (EVENTS_RETENTION_HOURS,))
+
+class _QueueSubscriber:
+    """A Flask stream's inbox: lists of events, then None once closed."""
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=EVENTS_QUEUE_MAX)
+
+    def put(self, events):
+        try:
+            self.queue.put_nowait(events)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self):
+        # A full queue is closed by dropping its backlog.
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+def _parse_event_id(value):
+    """Parse a Last-Event-ID ('<txid>-<id>'). Raises ValueError if malformed."""
+    txid, _, event_id = value.strip().partition('-')
+    return int(txid), int(event_id)
+
+def _events_replay_query(last, position):
+    """
+    SQL for the events after `last` up to the stream's start `position`,
+    preceded by `last` itself when it is still stored (see _replay_events).
+    Returns (sql, params).
+    """
+    upper = max(last, position)
+    sql = EVENTS_SELECT_SQL + '''
+        WHERE (txid, id) >= (%s, %s) AND (txid, id) <= (%s, %s)
+        ORDER BY txid, id
+        LIMIT %s
+    '''
+    return sql, (*last, *upper, EVENTS_REPLAY_MAX + 2)
+
+def _replay_events(rows, last):
+    """
+    The events to replay from the rows of _events_replay_query, or None
+    when the client must reset: `last` was pruned or the backlog is too long.
+    """
+    if not rows or tuple(rows[0][:2]) != last or len(rows) > EVENTS_REPLAY_MAX + 1:
+        return None
+    return rows[1:]
+
+def _event_payload(row_id, data):
+    """Event data: the row's id plus, unless deleted, its changed fields."""
+    payload = {'id': row_id}
+    if data is None:
+        return payload
+    data = dict(data)
+    if 'photo_sha256' in data:
+        data['photo_url'] = _photo_url(row_id, data.pop('photo_sha256'))
+    if 'rating_count' in data:
+        count = data['rating_count']
+        data['average_rating'] = data['rating_sum'] / count if count > 0 else 0.0
+    payload.update(data)
+    return payload
+
+def _format_event(row):
+    txid, event_id, resource, action, row_id, data = row
+    body = app.json.dumps(_event_payload(row_id, data))
+    return f"id: {txid}-{event_id}\nevent: {resource}.{action}\ndata: {body}\n\n"
+
+def _format_reset(position):
+    """Tells the client to refetch everything; later events follow this id."""
+    return f"id: {position[0]}-{position[1]}\nevent: reset\ndata: {{}}\n\n"
+
+EVENTS_UNAVAILABLE = "Event stream unavailable"
+_event_stream_slots = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """
+    Server-Sent Events feed of conversation and inventory changes. Each
+    event is named '<resource>.<action>' (e.g. 'conversations.updated') and
+    carries the row's id and fields. Reconnecting with Last-Event-ID (or
+    ?last_event_id=) replays what was missed; 'reset' means too much was
+    missed and the client should refetch. At most EVENTS_MAX_STREAMS are
+    open per worker; beyond that the client gets a 503 with Retry-After.
+    """
+    if not _event_stream_slots.acquire(blocking=False):
+        resp = jsonify({"error": "Too many open event streams"})
+        resp.status_code = 503
+        resp.headers['Retry-After'] = '30'
+        return resp
+    try:
+        resp = app.make_response(_event_stream_response())
+    except Exception:
+        _event_stream_slots.release()
+        raise
+    if resp.is_streamed:
+        resp.call_on_close(_event_stream_slots.release)
+    else:
+        _event_stream_slots.release()
+    return resp
+
+def _event_stream_response():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    _ensure_cache_listener()
+    event_hub.wait_started(DB_CONNECT_TIMEOUT)
+    subscriber = _QueueSubscriber()
+    position = event_hub.subscribe(subscriber)
+    if position is None:
+        resp = jsonify({"error": EVENTS_UNAVAILABLE})
+        resp.status_code = 503
+        resp.headers['Retry-After'] = '5'
+        return resp
+
+    replay, last = [], position
+    if last_event_id:
+        try:
+            last = _parse_event_id(last_event_id)
+        except ValueError:
+            replay = None
+        if replay is not None:
+            conn = get_db_connection(primary=True)
+            if not conn:
+                event_hub.unsubscribe(subscriber)
+                return jsonify({"error": "Failed to connect to the database"}), 500
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(*_events_replay_query(last, position))
+                    replay = _replay_events(cur.fetchall(), last)
+            except Exception:
+                event_hub.unsubscribe(subscriber)
+                log.exception("Failed to replay events")
+                return jsonify({"error": "Failed to replay events"}), 500
+            finally:
+                release_db_connection(conn)
+    if replay is None:
+        last = position
+
+    def generate():
+        yield "retry: 3000\n\n"
+        if replay is None:
+            yield _format_reset(position)
+        else:
+            for row in replay:
+                yield _format_event(row)
+        while True:
+            try:
+                events = subscriber.queue.get(timeout=EVENTS_HEARTBEAT)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if events is None:
+                return
+            # Skip what a client coming from a worker further ahead has seen.
+            yield "".join(_format_event(row) for row in events if tuple(row[:2]) > last)
+
+    resp = Response(generate(), mimetype='text/event-stream')
+    # On close rather than in generate(): a HEAD request, or a client gone
+    # before the first chunk, never starts the generator.
+    resp.call_on_close(functools.partial(event_hub.unsubscribe, subscriber))
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+# -----------------------------------------------------------------
+# RESPONSE COMPRESSION
+# -----------------------------------------------------------------
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "1") not in ("0", "false", "False")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", 5))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", 3))
+# Only text bodies; photos are already-compressed images.
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv',
+                          'text/plain', 'text/html'}
+
+def _gzip_stream():
+    gz = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+    return (lambda chunk: gz.compress(chunk) + gz.flush(zlib.Z_SYNC_FLUSH)), gz.flush
+
+def _brotli_stream():
+    br = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+    return (lambda chunk: br.process(chunk) + br.flush()), br.finish
+
+def _zstd_stream():
+    zc = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+    return (lambda chunk: zc.compress(chunk) + zc.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)), zc.flush
+
+# Content-Encoding -> (one-shot compress, streaming compressor factory), in
+# server preference order for clients that accept several equally.
+COMPRESSION_ENCODINGS = {}
+if zstandard is not None:
+    COMPRESSION_ENCODINGS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compress(data),
+        _zstd_stream)
+if brotli is not None:
+    COMPRESSION_ENCODINGS['br'] = (
+        lambda data: brotli.compress(data, quality=COMPRESSION_BROTLI_QUALITY),
+        _brotli_stream)
+COMPRESSION_ENCODINGS['gzip'] = (
+    lambda data: zlib.compress(data, COMPRESSION_GZIP_LEVEL, wbits=31),
+    _gzip_stream)
+
+def _negotiate_encoding(accept_encodings):
+    """Best supported encoding for a parsed Accept-Encoding header, or None."""
+    best, best_quality = None, 0
+    for encoding in COMPRESSION_ENCODINGS:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def _compress_body(body, encoding):
+    return COMPRESSION_ENCODINGS[encoding][0](body)
+
+def _compress_stream(chunks, encoding):
+    """Compress a streamed body chunk by chunk, flushing after each one."""
+    feed, finish = COMPRESSION_ENCODINGS[encoding][1]()
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            out = feed(chunk)
+            if out:
+                yield out
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+@app.after_request
+def compress_response(resp):
+    """
+    Compress text responses with the best encoding the client accepts.
+    Bodies under COMPRESSION_MIN_SIZE are sent as is; streamed bodies are
+    always compressed. A strong ETag becomes weak, as the bytes differ
+    from the identity encoding.
+    """
+    if (not COMPRESSION_ENABLED or resp.status_code < 200
+            or resp.status_code in (204, 206, 304) or resp.direct_passthrough
+            or 'Content-Encoding' in resp.headers
+            or resp.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = _negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return resp
+
+    if resp.is_streamed:
+        resp.response = _compress_stream(resp.response, encoding)
+        resp.headers.pop('Content-Length', None)
+    else:
+        body = resp.get_data()
+        if len(body) < COMPRESSION_MIN_SIZE:
+            return resp
+        variants = g.get('compressed_variants')
+        data = variants.get(encoding) if variants is not None else None
+        if data is None:
+            data = _compress_body(body, encoding)
+            if variants is not None:
+                variants[encoding] = data
+        resp.set_data(data)
+    resp.content_encoding = encoding
+
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+# -----------------------------------------------------------------
+# ROOT ENDPOINT (TEST)
+# -----------------------------------------------------------------
+@app.route('/', methods=['GET'])
+def root():
+    return jsonify({"message": "Welcome to the API!"}), 200
+
+# -----------------------------------------------------------------
+# PHOTO STORAGE
+# -----------------------------------------------------------------
+PHOTO_MAX_AGE = int(os.getenv("PHOTO_MAX_AGE", 86400))
+PHOTO_CHUNK_SIZE = 64 * 1024
+# Largest photo accepted by the streaming upload route, in bytes.
+PHOTO_MAX_BYTES = int(os.getenv("PHOTO_MAX_BYTES", 10 * 1024 * 1024))
+# Multipart framing (boundaries, part headers, small fields) allowed on top
+# of PHOTO_MAX_BYTES when checking a multipart body's Content-Length.
+MULTIPART_OVERHEAD = 16 * 1024
+# Uploads are spooled in memory up to this size, then to a temporary file.
+PHOTO_SPOOL_MEMORY = 1024 * 1024
+
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+def _sniff_image_type(data):
+    """Return the image MIME type from its magic bytes, or None."""
+    for signature, content_type in _IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def _decode_photo(photo_b64):
+    """
+    Decode a client-supplied base64 photo (optionally a data: URL).
+    Returns (bytes, content_type). Raises ValueError if it is not an image.
+    """
+    if photo_b64.startswith("data:") and "," in photo_b64:
+        photo_b64 = photo_b64.split(",", 1)[1]
+    try:
+        data = base64.b64decode(photo_b64, validate=False)
+    except (binascii.Error, ValueError):
+        raise ValueError("photo_base64 is not valid base64")
+    content_type = _sniff_image_type(data)
+    if not content_type:
+        raise ValueError("photo_base64 is not a supported image type")
+    return data, content_type
+
+def _store_photo(cur, conv_id, data, content_type):
+    """
+    Insert or replace the photo for a conversation and queue its thumbnails.
+    Returns its sha256.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    cur.execute('''
+        INSERT INTO conversation_photos (conversation_id, content_type, sha256, byte_size, data)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (conversation_id) DO UPDATE
+           SET content_type = EXCLUDED.content_type,
+               sha256       = EXCLUDED.sha256,
+               byte_size    = EXCLUDED.byte_size,
+               data         = EXCLUDED.data
+    ''', (conv_id, content_type, digest, len(data), psycopg2.Binary(data)))
+    _photo_stored(cur, conv_id, digest)
+    return digest
+
+def _photo_stored(cur, conv_id, digest):
+    """Drop thumbnails of the previous photo and queue the new one's jobs."""
+    cur.execute('''
+        DELETE FROM conversation_thumbnails
+         WHERE conversation_id = %s AND source_sha256 <> %s
+    ''', (conv_id, digest))
+    _queue_thumbnails(conv_id, digest)
+    _enqueue_inference(cur, [digest])
+
+class PhotoTooLarge(Exception):
+    """An upload went past PHOTO_MAX_BYTES."""
+
+def _multipart_file_chunks(stream, boundary, field):
+    """
+    Yield the contents of the `field` file part of a multipart/form-data
+    body as it arrives, without buffering the other parts or the body.
+    Raises ValueError if the body ends without that part.
+    """
+    decoder = MultipartDecoder(boundary, max_form_memory_size=PHOTO_CHUNK_SIZE + MULTIPART_OVERHEAD)
+    in_field = False
+    while True:
+        chunk = stream.read(PHOTO_CHUNK_SIZE)
+        decoder.receive_data(chunk or None)
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, File):
+                in_field = event.name == field
+            elif isinstance(event, Data) and in_field:
+                if event.data:
+                    yield event.data
+                if not event.more_data:
+                    return
+            event = decoder.next_event()
+        if isinstance(event, Epilogue) or not chunk:
+            raise ValueError(f"multipart body has no '{field}' file")
+
+def _request_photo_chunks():
+    """
+    Iterate over the photo uploaded with the current request, a chunk at a
+    time: the 'photo' part of a multipart/form-data body, or the raw body.
+    """
+    if request.mimetype == 'multipart/form-data':
+        boundary = request.mimetype_params.get('boundary')
+        if not boundary:
+            raise ValueError("multipart body has no boundary")
+        return _multipart_file_chunks(request.stream, boundary.encode('latin-1'), 'photo')
+    return iter(lambda: request.stream.read(PHOTO_CHUNK_SIZE), b'')
+
+def _read_photo_head(chunks):
+    """
+    Read just enough of an upload to check its magic bytes.
+    Returns (head, content_type); raises ValueError if it is not an image.
+    """
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= 16:
+            break
+    content_type = _sniff_image_type(head)
+    if not content_type:
+        raise ValueError("photo is not a supported image type")
+    return head, content_type
+
+def _spool_photo(chunks):
+    """
+    Receive a whole upload before touching the database, so a slow client
+    holds no pooled connection, transaction or row lock. Checks the magic
+    bytes first and the size as the body arrives. Returns (file at offset
+    0, content_type); raises ValueError if it is not an image and
+    PhotoTooLarge past PHOTO_MAX_BYTES.
+    """
+    head, content_type = _read_photo_head(chunks)
+    spool = tempfile.SpooledTemporaryFile(max_size=PHOTO_SPOOL_MEMORY)
+    try:
+        byte_size = 0
+        for chunk in itertools.chain([head], chunks):
+            byte_size += len(chunk)
+            if byte_size > PHOTO_MAX_BYTES:
+                raise PhotoTooLarge()
+            spool.write(chunk)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, content_type
+
+class _PhotoCopySource:
+    """
+    File-like object feeding an upload to COPY as one hex-encoded bytea
+    field, hashing and counting it on the way through, so only the chunk in
+    flight is held in memory. An error from the body (too large, client
+    gone) ends the row early and is kept in `error` for the caller to raise
+    once COPY returns.
+    """
 
-def get_db_connection():
-    """Get a connection from the pool."""
-    if not db_pool:
-        print("[ERROR] DB pool is not initialized")
+    def __init__(self, chunks, max_bytes):
+        self.chunks = chunks
+        self.max_bytes = max_bytes
+        self.sha256 = hashlib.sha256()
+        self.byte_size = 0
+        self.error = None
+        self.pending = b"\\\\x"  # COPY text format for a literal \x
+        self.finished = False
+
+    def _next_hex(self):
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            return None
+        except Exception as e:
+            self.error = e
+            return None
+        self.byte_size += len(chunk)
+        if self.byte_size > self.max_bytes:
+            self.error = PhotoTooLarge()
+            return None
+        self.sha256.update(chunk)
+        return binascii.hexlify(chunk)
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.pending) < size):
+            encoded = self._next_hex()
+            if encoded is None:
+                self.pending += b"\n"
+                self.finished = True
+            else:
+                self.pending += encoded
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+def _store_photo_stream(cur, conv_id, content_type, chunks):
+    """
+    Insert or replace a conversation's photo from an iterable of byte
+    chunks. The bytes go through COPY into a transaction-scoped temp table
+    and are moved into conversation_photos server-side. Returns
+    (sha256, byte_size); raises PhotoTooLarge past PHOTO_MAX_BYTES.
+    """
+    source = _PhotoCopySource(chunks, PHOTO_MAX_BYTES)
+    cur.execute("CREATE TEMP TABLE photo_upload (data BYTEA NOT NULL) ON COMMIT DROP")
+    cur.copy_expert("COPY photo_upload (data) FROM STDIN", source, size=2 * PHOTO_CHUNK_SIZE)
+    if source.error:
+        raise source.error
+    digest = source.sha256.hexdigest()
+    cur.execute('''
+        INSERT INTO conversation_photos (conversation_id, content_type, sha256, byte_size, data)
+        SELECT %s, %s, %s, %s, data FROM photo_upload
+        ON CONFLICT (conversation_id) DO UPDATE
+           SET content_type = EXCLUDED.content_type,
+               sha256       = EXCLUDED.sha256,
+               byte_size    = EXCLUDED.byte_size,
+               data         = EXCLUDED.data
+    ''', (conv_id, content_type, digest, source.byte_size))
+    _photo_stored(cur, conv_id, digest)
+    return digest, source.byte_size
+
+def _photo_url(conv_id, sha256):
+    """Public URL of a conversation photo, versioned by content hash."""
+    if not sha256:
         return None
+    return f"/api/conversations/{conv_id}/photo?v={sha256[:16]}"
+
+def _stored_image_response(sql, params, label):
+    """
+    Serve one image row selected by `sql` as (content_type, sha256,
+    byte_size, data), where data is NULL when the client's ETag already
+    matches. Handles 304, Range (206) and long-lived caching.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            row = cur.fetchone()
+    except Exception:
+        log.exception("Failed to fetch conversation %s", label)
+        return jsonify({"error": f"Failed to fetch conversation {label}"}), 500
+    finally:
+        release_db_connection(conn)
+
+    if not row:
+        return jsonify({"error": f"{label.capitalize()} not found"}), 404
+
+    content_type, sha256, byte_size, data = row
+    if data is None:
+        resp = Response(status=304)
+    else:
+        resp = Response(
+            wrap_file(request.environ, io.BytesIO(bytes(data)), PHOTO_CHUNK_SIZE),
+            mimetype=content_type,
+            direct_passthrough=True,
+        )
+        resp.content_length = byte_size
+    resp.set_etag(sha256)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = PHOTO_MAX_AGE
+    if data is not None:
+        resp.make_conditional(request, accept_ranges=True, complete_length=byte_size)
+    return resp
+
+# -----------------------------------------------------------------
+# THUMBNAILS
+# -----------------------------------------------------------------
+# Square bounding boxes, in pixels; list responses link the first one.
+THUMBNAIL_SIZES = tuple(sorted(
+    int(size) for size in os.getenv("THUMBNAIL_SIZES", "160,480").split(",") if size.strip()))
+THUMBNAIL_LIST_SIZE = THUMBNAIL_SIZES[0]
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+THUMBNAIL_QUEUE_MAX = int(os.getenv("THUMBNAIL_QUEUE_MAX", 200))
+
+_thumbnail_executor = None
+_thumbnail_executor_pid = None
+_thumbnail_lock = threading.Lock()
+_thumbnail_pending = 0
+
+def _make_thumbnails(data):
+    """Downscale image bytes to every THUMBNAIL_SIZES box. Returns [(size, jpeg bytes)]."""
+    with Image.open(io.BytesIO(data)) as image:
+        # Let the JPEG decoder downscale while decoding.
+        image.draft("RGB", (THUMBNAIL_SIZES[-1], THUMBNAIL_SIZES[-1]))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+
+        thumbnails = []
+        for size in reversed(THUMBNAIL_SIZES):
+            image.thumbnail((size, size), Image.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            thumbnails.append((size, out.getvalue()))
+    return thumbnails
+
+def _save_thumbnails(cur, conv_id, source_sha256, thumbnails):
+    """Store thumbnails unless the photo has been replaced in the meantime."""
+    for size, data in thumbnails:
+        cur.execute('''
+            INSERT INTO conversation_thumbnails
+                (conversation_id, size, source_sha256, content_type, sha256, byte_size, data)
+            SELECT p.conversation_id, %s, p.sha256, 'image/jpeg', %s, %s, %s
+              FROM conversation_photos p
+             WHERE p.conversation_id = %s AND p.sha256 = %s
+            ON CONFLICT (conversation_id, size) DO UPDATE
+               SET source_sha256 = EXCLUDED.source_sha256,
+                   content_type  = EXCLUDED.content_type,
+                   sha256        = EXCLUDED.sha256,
+                   byte_size     = EXCLUDED.byte_size,
+                   data          = EXCLUDED.data
+        ''', (size, hashlib.sha256(data).hexdigest(), len(data), psycopg2.Binary(data),
+              conv_id, source_sha256))
+
+def _thumbnail_job(conv_id, source_sha256, request_id=None):
+    """
+    Background job: read the photo, downscale it and store the thumbnails.
+    `request_id` is the ID of the request that queued it, for its log lines.
+    """
+    global _thumbnail_pending
+    # Only the ID: the rest of the request's context (Flask's request and
+    # app contexts) must not outlive the request in this thread.
+    current_request_id.set(request_id)
+    conn = None
     try:
-        conn = db_pool.getconn()
-        return conn
+        conn = get_db_connection()
+        if not conn:
+            return
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT data FROM conversation_photos WHERE conversation_id = %s AND sha256 = %s",
+                (conv_id, source_sha256))
+            row = cur.fetchone()
+            if not row:
+                return  # deleted or replaced since the job was queued
+            _save_thumbnails(cur, conv_id, source_sha256, _make_thumbnails(bytes(row[0])))
+        conn.commit()
+        _touch_conversations(conn, [conv_id])
+        response_cache.invalidate('conversations')
     except Exception as e:
-        print(f"[ERROR] Failed to get connection from pool: {e}")
+        if conn is not None:
+            conn.rollback()
+        log.warning("Thumbnails for conversation %s failed: %s", conv_id, e)
+    finally:
+        if conn is not None:
+            release_db_connection(conn)
+        with _thumbnail_lock:
+            _thumbnail_pending -= 1
+
+def _get_thumbnail_executor():
+    """This worker's thumbnail thread pool, created lazily after any fork."""
+    global _thumbnail_executor, _thumbnail_executor_pid, _thumbnail_pending
+    if _thumbnail_executor_pid != os.getpid():
+        with _thumbnail_lock:
+            if _thumbnail_executor_pid != os.getpid():
+                _thumbnail_executor = ThreadPoolExecutor(
+                    max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnails")
+                _thumbnail_executor_pid = os.getpid()
+                _thumbnail_pending = 0
+    return _thumbnail_executor
+
+def _queue_thumbnails(conv_id, source_sha256):
+    """
+    Remember a photo that needs thumbnails; the jobs are submitted once the
+    request has finished (after its commit). A job for a rolled back or
+    since-replaced photo finds no matching row and does nothing.
+    """
+    if Image is None:
+        return
+    if has_request_context():
+        g.setdefault('thumbnail_jobs', []).append((conv_id, source_sha256))
+
+@app.after_request
+def submit_thumbnail_jobs(resp):
+    global _thumbnail_pending
+    jobs = g.pop('thumbnail_jobs', None)
+    if not jobs or resp.status_code >= 400:
+        return resp
+    executor = _get_thumbnail_executor()
+    for conv_id, source_sha256 in jobs:
+        with _thumbnail_lock:
+            if _thumbnail_pending >= THUMBNAIL_QUEUE_MAX:
+                log.warning("Thumbnail queue full, skipping conversation %s "
+                            "(run `flask --app server backfill-thumbnails`)", conv_id)
+                continue
+            _thumbnail_pending += 1
+        executor.submit(_thumbnail_job, conv_id, source_sha256, current_request_id.get())
+    return resp
+
+def _thumbnail_url(conv_id, sha256):
+    """URL of a conversation's list-size thumbnail, versioned by content hash."""
+    if not sha256:
         return None
+    return f"/api/conversations/{conv_id}/thumbnail?size={THUMBNAIL_LIST_SIZE}&v={sha256[:16]}"
+
+# -----------------------------------------------------------------
+# PHOTO INFERENCE
+# -----------------------------------------------------------------
+# The photo_inferences table is the job queue: uploads insert a 'pending'
+# row per (photo hash, model) in their own transaction, so identical photos
+# share one job and result, and workers claim batches with SKIP LOCKED.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "")
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 1))
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", 8))
+INFERENCE_POLL_INTERVAL = float(os.getenv("INFERENCE_POLL_INTERVAL", 5))
+INFERENCE_MAX_ATTEMPTS = int(os.getenv("INFERENCE_MAX_ATTEMPTS", 3))
+# A 'running' job not finished after this many seconds (its worker died) is retried.
+INFERENCE_STALE_AFTER = int(os.getenv("INFERENCE_STALE_AFTER", 300))
+
+try:
+    inference_backend = load_backend(
+        INFERENCE_BACKEND,
+        model_id=os.getenv("INFERENCE_MODEL_ID"),
+        api_url=os.getenv("INFERENCE_API_URL", "https://detect.roboflow.com"),
+        api_key=os.getenv("ROBOFLOW_API_KEY"),
+    )
+except Exception:
+    log.exception("Inference backend '%s' is unavailable", INFERENCE_BACKEND)
+    inference_backend = None
+
+_inference_wakeup = threading.Event()
+_inference_workers_pid = None
+_inference_lock = threading.Lock()
+
+def _enqueue_inference(cur, digests):
+    """Queue inference for photo hashes, inside the caller's transaction."""
+    if inference_backend is None or not digests:
+        return
+    execute_values(cur, '''
+        INSERT INTO photo_inferences (sha256, model)
+        VALUES %s
+        ON CONFLICT (sha256, model) DO NOTHING
+    ''', [(digest, inference_backend.model) for digest in set(digests)])
+    if has_request_context():
+        g.inference_queued = True
+
+def _run_inference_batch():
+    """
+    Claim up to INFERENCE_BATCH_SIZE jobs, run them as one backend call and
+    store the results. Returns the number of jobs claimed (0: queue empty).
+    """
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    model = inference_backend.model
+    try:
+        with conn.cursor() as cur:
+            cur.execute('''
+                UPDATE photo_inferences i
+                   SET status = 'running',
+                       attempts = i.attempts + 1,
+                       updated_at = NOW() AT TIME ZONE 'utc'
+                 WHERE (i.sha256, i.model) IN (
+                        SELECT sha256, model
+                          FROM photo_inferences
+                         WHERE model = %s
+                           AND attempts < %s
+                           AND (status = 'pending'
+                                OR (status = 'running'
+                                    AND updated_at < (NOW() AT TIME ZONE 'utc')
+                                                     - make_interval(secs => %s)))
+                         ORDER BY created_at
+                         LIMIT %s
+                           FOR UPDATE SKIP LOCKED)
+                RETURNING i.sha256
+            ''', (model, INFERENCE_MAX_ATTEMPTS, INFERENCE_STALE_AFTER, INFERENCE_BATCH_SIZE))
+            digests = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            if not digests:
+                return 0
+
+            cur.execute('''
+                SELECT DISTINCT ON (sha256) sha256, data
+                  FROM conversation_photos
+                 WHERE sha256 = ANY(%s)
+            ''', (digests,))
+            images = {digest: bytes(data) for digest, data in cur.fetchall()}
+            gone = [digest for digest in digests if digest not in images]
+            if gone:
+                # Every conversation with this photo was deleted or changed.
+                cur.execute("DELETE FROM photo_inferences WHERE model = %s AND sha256 = ANY(%s)",
+                            (model, gone))
+            batch = [digest for digest in digests if digest in images]
+
+            if batch:
+                try:
+                    results = inference_backend.infer_batch([images[digest] for digest in batch])
+                    if len(results) != len(batch):
+                        raise ValueError(f"backend returned {len(results)} results "
+                                         f"for {len(batch)} images")
+                except Exception as e:
+                    log.warning("Inference batch of %s photos failed: %s", len(batch), e)
+                    cur.execute('''
+                        UPDATE photo_inferences
+                           SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+                               error = %s,
+                               updated_at = NOW() AT TIME ZONE 'utc'
+                         WHERE model = %s AND sha256 = ANY(%s)
+                    ''', (INFERENCE_MAX_ATTEMPTS, str(e), model, batch))
+                    conn.commit()
+                    _touch_photo_conversations(conn, batch)
+                    return len(digests)
+
+                execute_values(cur, '''
+                    UPDATE photo_inferences i
+                       SET status = 'done',
+                           result = v.result::jsonb,
+                           error = NULL,
+                           updated_at = NOW() AT TIME ZONE 'utc'
+                      FROM (VALUES %s) AS v (sha256, model, result)
+                     WHERE i.sha256 = v.sha256 AND i.model = v.model
+                ''', [(digest, model, Json(result, dumps=app.json.dumps))
+                      for digest, result in zip(batch, results)], page_size=len(batch))
+            conn.commit()
+            _touch_photo_conversations(conn, batch)
+        response_cache.invalidate('conversations')
+        return len(digests)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+def _inference_worker_loop():
+    while True:
+        _inference_wakeup.wait(INFERENCE_POLL_INTERVAL)
+        _inference_wakeup.clear()
+        try:
+            while _run_inference_batch():
+                pass
+        except Exception as e:
+            log.warning("Inference worker error: %s", e)
+            time.sleep(INFERENCE_POLL_INTERVAL)
+
+def _ensure_inference_workers():
+    """Start INFERENCE_WORKERS threads once per worker process (after any fork)."""
+    global _inference_workers_pid
+    if inference_backend is None or _inference_workers_pid == os.getpid():
+        return
+    with _inference_lock:
+        if _inference_workers_pid != os.getpid():
+            for n in range(INFERENCE_WORKERS):
+                threading.Thread(target=_inference_worker_loop, name=f"inference-{n}",
+                                 daemon=True).start()
+            _inference_workers_pid = os.getpid()
+
+@app.after_request
+def wake_inference_workers(resp):
+    _ensure_inference_workers()
+    if g.pop('inference_queued', False):
+        _inference_wakeup.set()
+    return resp
+
+@app.cli.command("run-inference")
+def run_inference_command():
+    """Queue every stored photo without a result and run inference to completion."""
+    if inference_backend is None:
+        log.error("INFERENCE_BACKEND is not configured")
+        return
+    conn = get_db_connection()
+    if not conn:
+        log.error("No DB connection in run-inference")
+        return
+    try:
+        with conn.cursor() as cur:
+            cur.execute('''
+                INSERT INTO photo_inferences (sha256, model)
+                SELECT DISTINCT sha256, %s FROM conversation_photos
+                ON CONFLICT (sha256, model) DO NOTHING
+            ''', (inference_backend.model,))
+            log.info("Queued %s photos for inference", cur.rowcount)
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    done = 0
+    while True:
+        claimed = _run_inference_batch()
+        if not claimed:
+            break
+        done += claimed
+        log.info("Processed %s inference jobs so far", done)
+    log.info("Inference finished: %s jobs processed", done)
+
+# -----------------------------------------------------------------
+# KEYSET PAGINATION
+# -----------------------------------------------------------------
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", 50))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 500))
+# Unpaged list requests answer 400 instead of loading a longer table.
+MAX_UNPAGED_ROWS = int(os.getenv("MAX_UNPAGED_ROWS", 1000))
+MAX_SEARCH_QUERY_LENGTH = 256
+
+def _encode_token(values):
+    """Pack a list of JSON-serializable sort-key values into an opaque token."""
+    raw = json.dumps(values).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_token(token):
+    """Inverse of _encode_token."""
+    padded = token + "=" * (-len(token) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded))
+
+def _encode_cursor(created_at, conv_id):
+    """Pack the (created_at, id) of the last row into an opaque token."""
+    return _encode_token([created_at.isoformat(), conv_id])
+
+def _decode_cursor(token):
+    """Inverse of _encode_cursor. Raises ValueError on a malformed token."""
+    try:
+        created_at, conv_id = _decode_token(token)
+        return datetime.fromisoformat(created_at), int(conv_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _decode_search_cursor(token):
+    """Decode a (rank, id) search cursor. Raises ValueError on a malformed token."""
+    try:
+        rank, conv_id = _decode_token(token)
+        return float(rank), int(conv_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _parse_bool_arg(args, name):
+    """Return True/False for a boolean query parameter, None if absent."""
+    raw = args.get(name)
+    if raw is None or raw == '':
+        return None
+    if raw.lower() in ('1', 'true', 'yes'):
+        return True
+    if raw.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f"{name} must be true or false")
+
+def _parse_datetime_arg(args, name):
+    raw = args.get(name)
+    if not raw:
+        return None
+    try:
+        return datetime.fromisoformat(raw)
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO 8601 date or datetime")
+
+def _parse_page_args(args, decode_cursor=_decode_cursor):
+    """
+    Read 'limit' and 'cursor' from the query string `args`.
+    Returns (limit, cursor) where cursor is None or the tuple produced by
+    `decode_cursor` (by default (created_at, id)).
+    Raises ValueError with a client-facing message on bad input.
+    """
+    raw_limit = args.get('limit')
+    if raw_limit is None or raw_limit == '':
+        limit = DEFAULT_PAGE_SIZE
+    else:
+        try:
+            limit = int(raw_limit)
+        except ValueError:
+            raise ValueError("limit must be an integer")
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        limit = min(limit, MAX_PAGE_SIZE)
+
+    raw_cursor = args.get('cursor')
+    cursor = decode_cursor(raw_cursor) if raw_cursor else None
+    return limit, cursor
+
+def _is_paged(args):
+    """
+    Whether a list request asked for a page. Requests with neither 'limit'
+    nor 'cursor' get every row as a bare JSON array, the shape the list
+    routes returned before pagination, so existing clients keep working,
+    up to MAX_UNPAGED_ROWS rows (see _unpaged_rows).
+    """
+    return bool(args.get('limit') or args.get('cursor'))
+
+def _fetch_size(limit):
+    """LIMIT for a list query: one row past the page, or past the unpaged ceiling."""
+    return (MAX_UNPAGED_ROWS if limit is None else limit) + 1
+
+def _unpaged_rows(rows):
+    """The rows of an unpaged list; raises ValueError past MAX_UNPAGED_ROWS."""
+    if len(rows) > MAX_UNPAGED_ROWS:
+        raise ValueError(f"More than {MAX_UNPAGED_ROWS} rows; "
+                         "page through them with 'limit' and 'cursor'")
+    return rows
+
+# Every field a conversation read can return: name -> (SQL expressions,
+# converter from their values, None when the single value is used as is).
+# Reads select only the requested fields (`fields=` query parameter), so
+# e.g. the photo join or the conversation_text column are skipped when
+# nobody asked for them.
+_CONVERSATION_FIELDS = {
+    'id': (('c.id',), None),
+    'conversation': (('c.conversation_text',), None),
+    'created_at': (('c.created_at',), None),
+    'is_saved': (('c.is_saved',), None),
+    'is_shared': (('c.is_shared',), None),
+    'rating_sum': (('COALESCE(c.rating_sum, 0)',), float),
+    'rating_count': (('COALESCE(c.rating_count, 0)',), int),
+    'average_rating': ((
+        'CASE WHEN COALESCE(c.rating_count, 0) > 0 '
+        'THEN COALESCE(c.rating_sum, 0) / c.rating_count ELSE 0 END',
+    ), float),
+    'photo_url': (('c.id', 'p.sha256'), _photo_url),
+    'thumbnail_url': (('c.id', f'''(SELECT t.sha256 FROM conversation_thumbnails t
+                                   WHERE t.conversation_id = c.id
+                                     AND t.size = {THUMBNAIL_LIST_SIZE})'''), _thumbnail_url),
+    # Latest inference for the current photo: {"model", "status", "result"}.
+    'inference': (('''(SELECT jsonb_build_object('model', i.model, 'status', i.status,
+                                                'result', i.result)
+                         FROM conversation_photos ip
+                         JOIN photo_inferences i ON i.sha256 = ip.sha256
+                        WHERE ip.conversation_id = c.id
+                        ORDER BY i.updated_at DESC
+                        LIMIT 1)''',), None),
+    'title': (('c.title',), lambda title: title if title else None),
+    'updated_at': (('c.updated_at',), None),
+}
+PHOTO_JOIN_SQL = "LEFT JOIN conversation_photos p ON p.conversation_id = c.id"
+
+def _parse_fields(args):
+    """
+    Read the comma-separated 'fields' query parameter. Returns the requested
+    field names in canonical order (all of them when absent).
+    """
+    raw = args.get('fields')
+    if not raw:
+        return tuple(_CONVERSATION_FIELDS)
+    requested = {name.strip() for name in raw.split(',') if name.strip()}
+    unknown = requested - set(_CONVERSATION_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    if not requested:
+        raise ValueError("fields must name at least one field")
+    return tuple(name for name in _CONVERSATION_FIELDS if name in requested)
+
+def _projection_sql(fields):
+    """
+    SELECT list for `fields`, led by the c.id/c.created_at keyset columns
+    (aliased _id/_created_at), plus the photo join if photo_url is wanted.
+    Returns (select_sql, column_aliases, join_sql).
+    """
+    exprs = [('c.id', '_id'), ('c.created_at', '_created_at')]
+    for name in fields:
+        for expr in _CONVERSATION_FIELDS[name][0]:
+            exprs.append((expr, f'_f{len(exprs)}'))
+    select_sql = ", ".join(f"{expr} AS {alias}" for expr, alias in exprs)
+    join_sql = PHOTO_JOIN_SQL if 'photo_url' in fields else ""
+    return select_sql, [alias for _, alias in exprs], join_sql
+
+@functools.lru_cache(maxsize=128)
+def _projection_plan(fields):
+    """(name, first column, column count, converter) per field, computed once per `fields`."""
+    plan = []
+    i = 2
+    for name in fields:
+        exprs, convert = _CONVERSATION_FIELDS[name]
+        plan.append((name, i, len(exprs), convert))
+        i += len(exprs)
+    return tuple(plan)
+
+def _project_row(row, fields):
+    """Build the response dict for a row laid out by _projection_sql()."""
+    item = {}
+    for name, i, width, convert in _projection_plan(fields):
+        if convert is None:
+            item[name] = row[i]
+        elif width == 1:
+            item[name] = convert(row[i])
+        else:
+            item[name] = convert(*row[i:i + width])
+    return item
+
+# The query builders and page serializers below are shared by the Flask
+# routes and the async entry point (asgi.py), so both serve identical bodies.
+def _list_conversations_query(args, where_sql):
+    """
+    Build the SQL for one keyset-paginated page of conversations, newest
+    first. `where_sql` is a constant filter (e.g. 'c.is_saved') matching one
+    of the partial indexes created by migration 2.
+    Returns (sql, params, limit, fields), with limit None for an unpaged
+    request (see _is_paged); raises ValueError on bad query args.
+    """
+    limit, cursor = _parse_page_args(args)
+    if not _is_paged(args):
+        limit = None
+    fields = _parse_fields(args)
+    conditions = [where_sql] if where_sql else []
+    params = []
+    if cursor:
+        conditions.append("(c.created_at, c.id) < (%s, %s)")
+        params.extend(cursor)
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+    # Fetch one extra row to learn whether another page exists.
+    params.append(_fetch_size(limit))
+    select_sql, _, join_sql = _projection_sql(fields)
+    sql = f'''
+        SELECT {select_sql}
+        FROM conversations c
+        {join_sql}
+        {where}
+        ORDER BY c.created_at DESC, c.id DESC
+        LIMIT %s
+    '''
+    return sql, params, limit, fields
+
+def _conversation_page(rows, limit, fields):
+    """
+    Turn the limit+1 rows of a list query into the page payload, or every
+    row into a bare array when limit is None. Raises ValueError when an
+    unpaged list is over MAX_UNPAGED_ROWS.
+    """
+    if limit is None:
+        return [_project_row(row, fields) for row in _unpaged_rows(rows)]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1][1], rows[-1][0])
+    return {"items": [_project_row(row, fields) for row in rows], "next_cursor": next_cursor}
+
+def _list_conversations(where_sql, label):
+    """Serve one page of conversations (see _list_conversations_query)."""
+    try:
+        sql, params, limit, fields = _list_conversations_query(request.args, where_sql)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        return jsonify(_conversation_page(rows, limit, fields)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception:
+        log.exception("Failed to fetch %s", label)
+        return jsonify({"error": f"Failed to fetch {label}"}), 500
+    finally:
+        release_db_connection(conn)
+
+# -----------------------------------------------------------------
+# BULK INSERT
+# -----------------------------------------------------------------
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 1000))
+MAX_BULK_CHUNK_SIZE = 10000
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+# NDJSON bodies larger than this are spooled to a temporary file.
+BULK_SPOOL_MEMORY = 1024 * 1024
+
+def _bulk_chunk_size():
+    """Read the optional 'chunk_size' query parameter."""
+    raw = request.args.get('chunk_size')
+    if not raw:
+        return BULK_CHUNK_SIZE
+    try:
+        size = int(raw)
+    except ValueError:
+        raise ValueError("chunk_size must be an integer")
+    if size < 1:
+        raise ValueError("chunk_size must be positive")
+    return min(size, MAX_BULK_CHUNK_SIZE)
+
+def _ndjson_rows(body):
+    for line_no, line in enumerate(body, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            raise ValueError(f"Invalid JSON on line {line_no}")
+
+def _receive_bulk_rows():
+    """
+    Receive a whole bulk request body before touching the database, so a
+    slow client holds no pooled connection or transaction (as with photo
+    uploads). NDJSON bodies are spooled, to disk past BULK_SPOOL_MEMORY,
+    and parsed line by line as they are inserted; anything else must be a
+    JSON array. Returns (rows, spool file or None); raises ValueError.
+    """
+    if request.mimetype in NDJSON_MIMETYPES:
+        spool = tempfile.SpooledTemporaryFile(max_size=BULK_SPOOL_MEMORY)
+        try:
+            while True:
+                chunk = request.stream.read(PHOTO_CHUNK_SIZE)
+                if not chunk:
+                    break
+                spool.write(chunk)
+            spool.seek(0)
+        except BaseException:
+            spool.close()
+            raise
+        return _ndjson_rows(spool), spool
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array or an NDJSON body")
+    return data, None
+
+def _bulk_insert(validate_row, insert_chunk, label, cache_tag):
+    """
+    Receive the body, then validate rows as they are read and insert them
+    chunk by chunk inside one transaction. `validate_row` raises ValueError
+    for a bad row; `insert_chunk(cur, rows)` returns the new ids in input
+    order.
+    """
+    try:
+        chunk_size = _bulk_chunk_size()
+        rows, spool = _receive_bulk_rows()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        return _insert_bulk_rows(rows, chunk_size, validate_row, insert_chunk, label, cache_tag)
+    finally:
+        if spool is not None:
+            spool.close()
+
+def _insert_bulk_rows(rows, chunk_size, validate_row, insert_chunk, label, cache_tag):
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+    ids = []
+    chunk = []
+    try:
+        with conn.cursor() as cur:
+            for index, raw in enumerate(rows):
+                try:
+                    chunk.append(validate_row(raw))
+                except ValueError as e:
+                    conn.rollback()
+                    return jsonify({"error": f"Row {index}: {e}"}), 400
+                if len(chunk) >= chunk_size:
+                    ids.extend(insert_chunk(cur, chunk))
+                    chunk = []
+            if chunk:
+                ids.extend(insert_chunk(cur, chunk))
+        conn.commit()
+        response_cache.invalidate(cache_tag)
+        return jsonify({"ids": ids, "count": len(ids)}), 201
+    except ValueError as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 400
+    except Exception:
+        conn.rollback()
+        log.exception("Failed to bulk insert %s", label)
+        return jsonify({"error": f"Failed to bulk insert {label}"}), 500
+    finally:
+        release_db_connection(conn)
+
+def _validate_bulk_conversation(raw):
+    if not isinstance(raw, dict):
+        raise ValueError("expected an object")
+    text = raw.get('conversation')
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("No conversation text provided")
+    title = raw.get('title')
+    if title is not None and not isinstance(title, str):
+        raise ValueError("title must be a string")
+    is_saved = raw.get('is_saved', False)
+    is_shared = raw.get('is_shared', False)
+    if not isinstance(is_saved, bool) or not isinstance(is_shared, bool):
+        raise ValueError("is_saved and is_shared must be booleans")
+    photo = _decode_photo(raw['photo_base64']) if raw.get('photo_base64') else None
+    return text.strip(), (title or '').strip() or None, is_saved, is_shared, photo
+
+def _insert_conversation_chunk(cur, rows):
+    now = datetime.utcnow()
+    inserted = execute_values(cur, '''
+        INSERT INTO conversations (
+            conversation_text, created_at, is_saved, is_shared,
+            rating_sum, rating_count, title
+        )
+        VALUES %s
+        RETURNING id
+    ''', [(text, now, is_saved, is_shared, 0, 0, title)
+          for text, title, is_saved, is_shared, _ in rows],
+        page_size=len(rows), fetch=True)
+    ids = [r[0] for r in inserted]
+
+    photos = []
+    digests = []
+    for conv_id, row in zip(ids, rows):
+        if row[4]:
+            data, content_type = row[4]
+            digest = hashlib.sha256(data).hexdigest()
+            photos.append((conv_id, content_type, digest, len(data), psycopg2.Binary(data)))
+            _queue_thumbnails(conv_id, digest)
+            digests.append(digest)
+    if photos:
+        execute_values(cur, '''
+            INSERT INTO conversation_photos (conversation_id, content_type, sha256, byte_size, data)
+            VALUES %s
+        ''', photos, page_size=len(photos))
+        _enqueue_inference(cur, digests)
+    return ids
+
+def _validate_bulk_inventory(raw):
+    if not isinstance(raw, dict):
+        raise ValueError("expected an object")
+    name = raw.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("Name cannot be empty")
+    return (name.strip(),)
+
+def _insert_inventory_chunk(cur, rows):
+    inserted = execute_values(cur, 'INSERT INTO inventory (name) VALUES %s RETURNING id',
+                              rows, page_size=len(rows), fetch=True)
+    return [r[0] for r in inserted]
+
+# -----------------------------------------------------------------
+# CONVERSATIONS ENDPOINTS
+# -----------------------------------------------------------------
+# endpoint -> (WHERE filter, label used in error messages)
+CONVERSATION_LIST_FILTERS = {
+    'get_conversations': (None, "conversations"),
+    'get_saved_conversations': ("c.is_saved", "saved conversations"),
+    'get_shared_conversations': ("c.is_shared", "shared conversations"),
+}
+
+@app.route('/api/conversations', methods=['GET'])
+@cached_response('conversations')
+def get_conversations():
+    return _list_conversations(*CONVERSATION_LIST_FILTERS['get_conversations'])
+
+@app.route('/api/conversations/saved', methods=['GET'])
+@cached_response('conversations')
+def get_saved_conversations():
+    return _list_conversations(*CONVERSATION_LIST_FILTERS['get_saved_conversations'])
+
+@app.route('/api/conversations/shared', methods=['GET'])
+@cached_response('conversations')
+def get_shared_conversations():
+    return _list_conversations(*CONVERSATION_LIST_FILTERS['get_shared_conversations'])
+
+def _search_conversations_query(args):
+    """
+    Build the ranked full-text search SQL. Returns (sql, params, limit,
+    fields, highlight); raises ValueError on bad query args.
+    """
+    q = args.get('q', '').strip()
+    if not q:
+        raise ValueError("q is required")
+    if len(q) > MAX_SEARCH_QUERY_LENGTH:
+        raise ValueError("q is too long")
+    limit, cursor = _parse_page_args(args, _decode_search_cursor)
+    fields = _parse_fields(args)
+    highlight = bool(_parse_bool_arg(args, 'highlight'))
+
+    params = [q]
+    after = ""
+    if cursor:
+        after = "AND (ts_rank(c.search_vector, q.query), c.id) < (%s::real, %s)"
+        params.extend(cursor)
+    params.append(limit + 1)
+    select_sql, aliases, join_sql = _projection_sql(fields)
+    outer = ", ".join(f"page.{alias}" for alias in aliases)
+    # Headlines are expensive, so only the rows on this page get one.
+    snippet, text_join = "NULL", ""
+    if highlight:
+        snippet = ("ts_headline('english', c.conversation_text, q.query, "
+                   "'MaxFragments=2, MaxWords=20, MinWords=5')")
+        text_join = "JOIN conversations c ON c.id = page._id"
+    sql = f'''
+        WITH q AS (SELECT websearch_to_tsquery('english', %s) AS query)
+        SELECT {outer}, page.rank, {snippet}
+        FROM (
+            SELECT {select_sql},
+                   ts_rank(c.search_vector, q.query) AS rank
+            FROM conversations c
+            CROSS JOIN q
+            {join_sql}
+            WHERE c.search_vector @@ q.query
+            {after}
+            ORDER BY rank DESC, c.id DESC
+            LIMIT %s
+        ) page
+        CROSS JOIN q
+        {text_join}
+        ORDER BY page.rank DESC, page._id DESC
+    '''
+    return sql, params, limit, fields, highlight
+
+def _search_page(rows, limit, fields, highlight):
+    """Turn the limit+1 rows of a search query into the page payload."""
+    rank_index = len(rows[0]) - 2 if rows else 0
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_token([rows[-1][rank_index], rows[-1][0]])
+
+    results = []
+    for row in rows:
+        item = _project_row(row, fields)
+        item['rank'] = row[rank_index]
+        if highlight:
+            item['snippet'] = row[rank_index + 1]
+        results.append(item)
+    return {"items": results, "next_cursor": next_cursor}
+
+@app.route('/api/conversations/search', methods=['GET'])
+@cached_response('conversations')
+def search_conversations():
+    """
+    Full-text search over title and conversation_text, best matches first.
+    Query params: q (web-search syntax), limit, cursor, fields,
+    highlight=true to add a 'snippet' with <b>-marked matches.
+    """
+    try:
+        sql, params, limit, fields, highlight = _search_conversations_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        return jsonify(_search_page(rows, limit, fields, highlight)), 200
+    except Exception:
+        log.exception("Failed to search conversations")
+        return jsonify({"error": "Failed to search conversations"}), 500
+    finally:
+        release_db_connection(conn)
+
+# Bayesian average: (rating_sum + PRIOR_MEAN * PRIOR_WEIGHT) / (rating_count + PRIOR_WEIGHT),
+# so a handful of ratings cannot outrank a well-rated conversation.
+RATING_PRIOR_MEAN = float(os.getenv("RATING_PRIOR_MEAN", 3))
+RATING_PRIOR_WEIGHT = float(os.getenv("RATING_PRIOR_WEIGHT", 5))
+# Window name -> days; 'all' ranks by conversations.rating_score instead.
+RANKING_WINDOWS = {'24h': 1, '7d': 7, '30d': 30}
+RANKING_REFRESH_INTERVAL = int(os.getenv("RANKING_REFRESH_INTERVAL", 300))
+DEFAULT_TOP_LIMIT = 10
+MAX_TOP_LIMIT = 100
+# Class key for the per-window advisory locks; the window's days are the
+# second key. Ratings take them shared, a rebuild takes its window's
+# exclusively, so no increment commits while a rebuild reads rating_events.
+RANKING_LOCK_KEY = 720_416_017
+
+def _lock_rankings(cur, windows, shared):
+    """Take the advisory locks of `windows` until the transaction ends, in a fixed order."""
+    lock = "pg_advisory_xact_lock_shared" if shared else "pg_advisory_xact_lock"
+    cur.execute(f"SELECT {lock}(%s, d) FROM unnest(%s::int[]) AS d",
+                (RANKING_LOCK_KEY, sorted(RANKING_WINDOWS[w] for w in windows)))
+
+def _record_rating(cur, conv_id, rating):
+    """Append a rating event and add it to every windowed leaderboard."""
+    _lock_rankings(cur, RANKING_WINDOWS, shared=True)
+    cur.execute("INSERT INTO rating_events (conversation_id, rating) VALUES (%s, %s)",
+                (conv_id, rating))
+    cur.execute('''
+        INSERT INTO conversation_rankings AS r
+            (window_name, conversation_id, rating_sum, rating_count, score)
+        SELECT w, %(id)s, %(rating)s, 1, (%(rating)s + %(prior)s) / (1 + %(weight)s)
+          FROM unnest(%(windows)s::text[]) AS w
+        ON CONFLICT (window_name, conversation_id) DO UPDATE
+           SET rating_sum   = r.rating_sum + EXCLUDED.rating_sum,
+               rating_count = r.rating_count + 1,
+               score        = (r.rating_sum + EXCLUDED.rating_sum + %(prior)s)
+                              / (r.rating_count + 1 + %(weight)s)
+    ''', {'id': conv_id, 'rating': rating, 'windows': list(RANKING_WINDOWS),
+          'prior': RATING_PRIOR_MEAN * RATING_PRIOR_WEIGHT, 'weight': RATING_PRIOR_WEIGHT})
+
+# Rebuild one windowed leaderboard from the events still inside it, in one
+# statement so readers never see it half-built. It overwrites the counts
+# with a snapshot of rating_events, so _refresh_ranking first takes the
+# window's lock exclusively: ratings committed before it are in the
+# snapshot, and ratings after it wait and then add to the rebuilt rows.
+RANKING_REBUILD_SQL = '''
+    WITH fresh AS (
+        SELECT conversation_id, SUM(rating) AS rating_sum, COUNT(*) AS rating_count
+          FROM rating_events
+         WHERE created_at >= (NOW() AT TIME ZONE 'utc') - make_interval(days => %(days)s)
+         GROUP BY conversation_id
+    ), dropped AS (
+        DELETE FROM conversation_rankings r
+         WHERE r.window_name = %(window)s
+           AND NOT EXISTS (SELECT 1 FROM fresh f WHERE f.conversation_id = r.conversation_id)
+    ), rebuilt AS (
+        INSERT INTO conversation_rankings AS r
+            (window_name, conversation_id, rating_sum, rating_count, score)
+        SELECT %(window)s, conversation_id, rating_sum, rating_count,
+               (rating_sum + %(prior)s) / (rating_count + %(weight)s)
+          FROM fresh
+        ON CONFLICT (window_name, conversation_id) DO UPDATE
+           SET rating_sum   = EXCLUDED.rating_sum,
+               rating_count = EXCLUDED.rating_count,
+               score        = EXCLUDED.score
+    )
+    INSERT INTO ranking_refreshes (window_name, refreshed_at, expired_before)
+    VALUES (%(window)s, NOW() AT TIME ZONE 'utc',
+            (NOW() AT TIME ZONE 'utc') - make_interval(days => %(days)s))
+    ON CONFLICT (window_name) DO UPDATE
+       SET refreshed_at   = EXCLUDED.refreshed_at,
+           expired_before = EXCLUDED.expired_before
+'''
+
+# Subtract the events that aged out of a window since the last pass
+# (created_at in [expired_before, cutoff)). The SKIP LOCKED claim on the
+# window's ranking_refreshes row means one worker does each pass.
+RANKING_EXPIRE_SQL = '''
+    WITH claim AS (
+        SELECT expired_before
+          FROM ranking_refreshes
+         WHERE window_name = %(window)s
+           AND refreshed_at <= (NOW() AT TIME ZONE 'utc') - make_interval(secs => %(interval)s)
+           FOR UPDATE SKIP LOCKED
+    ), expired AS (
+        SELECT e.conversation_id, SUM(e.rating) AS rating_sum, COUNT(*) AS rating_count
+          FROM rating_events e, claim
+         WHERE e.created_at >= claim.expired_before
+           AND e.created_at < (NOW() AT TIME ZONE 'utc') - make_interval(days => %(days)s)
+         GROUP BY e.conversation_id
+    ), emptied AS (
+        DELETE FROM conversation_rankings r
+         USING expired x
+         WHERE r.window_name = %(window)s AND r.conversation_id = x.conversation_id
+           AND r.rating_count <= x.rating_count
+    ), reduced AS (
+        UPDATE conversation_rankings r
+           SET rating_sum   = r.rating_sum - x.rating_sum,
+               rating_count = r.rating_count - x.rating_count,
+               score        = (r.rating_sum - x.rating_sum + %(prior)s)
+                              / (r.rating_count - x.rating_count + %(weight)s)
+          FROM expired x
+         WHERE r.window_name = %(window)s AND r.conversation_id = x.conversation_id
+           AND r.rating_count > x.rating_count
+    )
+    UPDATE ranking_refreshes
+       SET refreshed_at   = NOW() AT TIME ZONE 'utc',
+           expired_before = (NOW() AT TIME ZONE 'utc') - make_interval(days => %(days)s)
+      FROM claim
+     WHERE window_name = %(window)s
+'''
 
-def release_db_connection(conn):
-    """Release a connection back to the pool."""
-    if not db_pool or not conn:
-        return
-    try:
-        db_pool.putconn(conn)
-    except Exception as e:
-        print(f"[ERROR] Failed to release connection: {e}")
+def _ranking_params(window):
+    return {'window': window, 'days': RANKING_WINDOWS[window],
+            'interval': RANKING_REFRESH_INTERVAL,
+            'prior': RATING_PRIOR_MEAN * RATING_PRIOR_WEIGHT, 'weight': RATING_PRIOR_WEIGHT}
 
-# -----------------------------------------------------------------
-# TABLE CREATION / MIGRATION
-# -----------------------------------------------------------------
-def create_conversations_table():
+def _refresh_ranking(cur, window):
     """
-    Creates or updates the 'conversations' table with fields:
-      - id SERIAL PRIMARY KEY
-      - conversation_text TEXT NOT NULL
-      - created_at TIMESTAMP NOT NULL
-      - is_saved BOOLEAN NOT NULL DEFAULT FALSE
-      - is_shared BOOLEAN NOT NULL DEFAULT FALSE
-      - rating_sum FLOAT DEFAULT 0
-      - rating_count INT DEFAULT 0
-      - photo_base64 TEXT
-      - title TEXT (optional short name)
+    Rebuild one windowed leaderboard from the events still inside it. Holds
+    the window's lock, and so blocks new ratings, until the caller commits.
     """
-    conn = get_db_connection()
-    if not conn:
-        print("[ERROR] No DB connection in create_conversations_table()")
-        return
+    _lock_rankings(cur, (window,), shared=False)
+    cur.execute(RANKING_REBUILD_SQL, _ranking_params(window))
 
-    try:
-        with conn.cursor() as cur:
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id SERIAL PRIMARY KEY,
-                    conversation_text TEXT NOT NULL,
-                    created_at TIMESTAMP NOT NULL,
-                    is_saved BOOLEAN NOT NULL DEFAULT FALSE,
-                    is_shared BOOLEAN NOT NULL DEFAULT FALSE
-                )
-            ''')
+def _expire_rankings(conn):
+    """
+    Drop expired ratings from every windowed leaderboard, at most every
+    RANKING_REFRESH_INTERVAL seconds per window across all workers, one
+    transaction per window. Runs in the ranking thread, never in a request.
+    A window that was never built is rebuilt.
+    """
+    for window in RANKING_WINDOWS:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM ranking_refreshes WHERE window_name = %s", (window,))
+                if cur.fetchone() is None:
+                    _refresh_ranking(cur, window)
+                else:
+                    cur.execute(RANKING_EXPIRE_SQL, _ranking_params(window))
             conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
-            cur.execute("""
-                SELECT column_name
-                  FROM information_schema.columns
-                 WHERE table_name='conversations'
-            """)
-            existing_cols = [row[0] for row in cur.fetchall()]
-
-            if 'rating_sum' not in existing_cols:
-                print("[INFO] Adding 'rating_sum' column to 'conversations' table...")
-                cur.execute("ALTER TABLE conversations ADD COLUMN rating_sum FLOAT DEFAULT 0")
-                conn.commit()
+_ranking_thread_pid = None
+_ranking_thread_lock = threading.Lock()
 
-            if 'rating_count' not in existing_cols:
-                print("[INFO] Adding 'rating_count' column to 'conversations' table...")
-                cur.execute("ALTER TABLE conversations ADD COLUMN rating_count INT DEFAULT 0")
-                conn.commit()
+def _ranking_expiry_loop():
+    while True:
+        conn = None
+        try:
+            conn = get_db_connection(primary=True)
+            if conn:
+                _expire_rankings(conn)
+        except Exception as e:
+            log.warning("Ranking expiry failed: %s", e)
+        finally:
+            if conn:
+                release_db_connection(conn)
+        time.sleep(RANKING_REFRESH_INTERVAL)
 
-            if 'photo_base64' not in existing_cols:
-                print("[INFO] Adding 'photo_base64' column to 'conversations' table...")
-                cur.execute("ALTER TABLE conversations ADD COLUMN photo_base64 TEXT")
-                conn.commit()
+def _ensure_ranking_thread():
+    """Start the ranking expiry thread once per worker process (after any fork)."""
+    global _ranking_thread_pid
+    if _ranking_thread_pid == os.getpid():
+        return
+    with _ranking_thread_lock:
+        if _ranking_thread_pid != os.getpid():
+            threading.Thread(target=_ranking_expiry_loop, name="ranking-expiry",
+                             daemon=True).start()
+            _ranking_thread_pid = os.getpid()
 
-            if 'is_saved' not in existing_cols:
-                print("[INFO] Adding 'is_saved' column to 'conversations' table...")
-                cur.execute("""
-                    ALTER TABLE conversations
-                    ADD COLUMN is_saved BOOLEAN NOT NULL DEFAULT FALSE
-                """)
-                conn.commit()
+@app.after_request
+def start_ranking_thread(resp):
+    _ensure_ranking_thread()
+    return resp
 
-            if 'title' not in existing_cols:
-                print("[INFO] Adding 'title' column to 'conversations' table...")
-                cur.execute("ALTER TABLE conversations ADD COLUMN title TEXT")
-                conn.commit()
+@app.route('/api/conversations/top', methods=['GET'])
+@cached_response('conversations')
+def get_top_conversations():
+    """
+    Highest-ranked conversations by Bayesian average rating, read from an
+    index in score order. window=24h|7d|30d counts only that period's
+    ratings; window=all (default) uses every rating. Also takes limit, fields.
+    """
+    window = request.args.get('window', 'all')
+    if window != 'all' and window not in RANKING_WINDOWS:
+        return jsonify({"error": f"window must be one of all, {', '.join(RANKING_WINDOWS)}"}), 400
+    try:
+        limit = int(request.args.get('limit') or DEFAULT_TOP_LIMIT)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+    limit = min(limit, MAX_TOP_LIMIT)
+    try:
+        fields = _parse_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-            if 'is_shared' not in existing_cols:
-                print("[INFO] Adding 'is_shared' column to 'conversations' table...")
-                cur.execute("ALTER TABLE conversations ADD COLUMN is_shared BOOLEAN NOT NULL DEFAULT FALSE")
-                conn.commit()
+    select_sql, _, join_sql = _projection_sql(fields)
+    if window == 'all':
+        sql = f'''
+            SELECT {select_sql}, c.rating_score, COALESCE(c.rating_count, 0)
+            FROM conversations c
+            {join_sql}
+            WHERE c.rating_count > 0
+            ORDER BY c.rating_score DESC, c.id DESC
+            LIMIT %s
+        '''
+        params = (limit,)
+    else:
+        sql = f'''
+            SELECT {select_sql}, r.score, r.rating_count
+            FROM conversation_rankings r
+            JOIN conversations c ON c.id = r.conversation_id
+            {join_sql}
+            WHERE r.window_name = %s
+            ORDER BY r.score DESC, r.conversation_id DESC
+            LIMIT %s
+        '''
+        params = (window, limit)
 
-    except Exception as e:
-        print(f"[ERROR] Failed to create/migrate conversations table: {e}")
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        items = []
+        for row in rows:
+            item = _project_row(row, fields)
+            item['score'] = row[-2]
+            item['window_rating_count'] = row[-1]
+            items.append(item)
+        return jsonify({"window": window, "items": items}), 200
+    except Exception:
+        log.exception("Failed to fetch top conversations")
+        return jsonify({"error": "Failed to fetch top conversations"}), 500
     finally:
         release_db_connection(conn)
 
-def create_inventory_table():
-    """
-    Creates an 'inventory' table with only 'id' (SERIAL) and 'name' (TEXT NOT NULL).
-    """
+@app.cli.command("refresh-rankings")
+def refresh_rankings_command():
+    """Recompute every rating_score with the configured prior and rebuild all windows."""
     conn = get_db_connection()
     if not conn:
-        print("[ERROR] No DB connection in create_inventory_table()")
+        log.error("No DB connection in refresh-rankings")
         return
-
     try:
         with conn.cursor() as cur:
             cur.execute('''
-                CREATE TABLE IF NOT EXISTS inventory (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL
-                )
-            ''')
+                UPDATE conversations
+                   SET rating_score = (COALESCE(rating_sum, 0) + %s) / (COALESCE(rating_count, 0) + %s)
+                 WHERE rating_count > 0
+            ''', (RATING_PRIOR_MEAN * RATING_PRIOR_WEIGHT, RATING_PRIOR_WEIGHT))
+            log.info("Rescored %s rated conversations", cur.rowcount)
+        conn.commit()
+        # One transaction per window, so ratings wait on one rebuild at a time.
+        for window in RANKING_WINDOWS:
+            with conn.cursor() as cur:
+                _refresh_ranking(cur, window)
             conn.commit()
-    except Exception as e:
-        print(f"[ERROR] Failed to create inventory table: {e}")
+            log.info("Rebuilt the %s ranking", window)
+    except Exception:
+        conn.rollback()
+        log.exception("Ranking refresh failed")
     finally:
         release_db_connection(conn)
 
-# Create tables on startup
-with app.app_context():
-    create_inventory_table()
-    create_conversations_table()
+# Totals kept by the conversation_stats triggers (migration 10), summed
+# over the table's few slots instead of counting conversations.
+CONVERSATION_STATS_SQL = '''
+    SELECT COALESCE(SUM(total), 0), COALESCE(SUM(saved), 0), COALESCE(SUM(shared), 0),
+           COALESCE(SUM(rated), 0), COALESCE(SUM(rating_sum), 0), COALESCE(SUM(rating_count), 0)
+    FROM conversation_stats
+'''
+# The same figures counted from the conversations themselves.
+CONVERSATION_STATS_ACTUAL_SQL = '''
+    SELECT COUNT(*),
+           COUNT(*) FILTER (WHERE is_saved),
+           COUNT(*) FILTER (WHERE is_shared),
+           COUNT(*) FILTER (WHERE rating_count > 0),
+           COALESCE(SUM(rating_sum), 0),
+           COALESCE(SUM(rating_count), 0)
+    FROM conversations
+'''
 
-# -----------------------------------------------------------------
-# ROOT ENDPOINT (TEST)
-# -----------------------------------------------------------------
-@app.route('/', methods=['GET'])
-def root():
-    return jsonify({"message": "Welcome to the API!"}), 200
+def _conversation_stats(rows):
+    total, saved, shared, rated, rating_sum, rating_count = rows[0]
+    rating_count = int(rating_count)
+    return {
+        'total': int(total),
+        'saved': int(saved),
+        'shared': int(shared),
+        'rated': int(rated),
+        'rating_count': rating_count,
+        'average_rating': float(rating_sum) / rating_count if rating_count else 0.0,
+    }
 
-# -----------------------------------------------------------------
-# CONVERSATIONS ENDPOINTS
-# -----------------------------------------------------------------
-@app.route('/api/conversations', methods=['GET'])
-def get_conversations():
+@app.route('/api/conversations/stats', methods=['GET'])
+@cached_response('conversations')
+def get_conversation_stats():
+    """
+    Dashboard totals: all, saved, shared and rated conversations, and the
+    mean of every rating. Read from counters, so the cost does not grow
+    with the number of conversations.
+    """
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Failed to connect to the database"}), 500
     try:
         with conn.cursor() as cur:
-            cur.execute('''
-                SELECT
-                    id,
-                    conversation_text,
-                    created_at,
-                    is_saved,
-                    is_shared,
-                    COALESCE(rating_sum, 0),
-                    COALESCE(rating_count, 0),
-                    photo_base64,
-                    title
-                FROM conversations
-                ORDER BY created_at DESC
-            ''')
+            cur.execute(CONVERSATION_STATS_SQL)
             rows = cur.fetchall()
-            results = []
-            for row in rows:
-                conv_id      = row[0]
-                conversation = row[1]
-                created_at   = row[2]
-                is_saved     = row[3]
-                is_shared    = row[4]
-                rating_sum   = float(row[5])
-                rating_count = int(row[6])
-                photo_base64 = row[7]
-                title        = row[8] if row[8] else None
-
-                avg_rating = 0.0
-                if rating_count > 0:
-                    avg_rating = rating_sum / rating_count
-
-                results.append({
-                    'id': conv_id,
-                    'conversation': conversation,
-                    'created_at': created_at,
-                    'is_saved': is_saved,
-                    'is_shared': is_shared,
-                    'rating_sum': rating_sum,
-                    'rating_count': rating_count,
-                    'average_rating': avg_rating,
-                    'photo_base64': photo_base64,
-                    'title': title
-                })
-            return jsonify(results), 200
-    except Exception as e:
-        print(f"[ERROR] Failed to fetch conversations: {e}")
-        return jsonify({"error": "Failed to fetch conversations"}), 500
+            return jsonify(_conversation_stats(rows)), 200
+    except Exception:
+        log.exception("Failed to fetch conversation stats")
+        return jsonify({"error": "Failed to fetch conversation stats"}), 500
     finally:
         release_db_connection(conn)
 
-@app.route('/api/conversations/saved', methods=['GET'])
-def get_saved_conversations():
+@app.cli.command("reconcile-stats")
+def reconcile_stats_command():
+    """Recount conversation_stats from the conversations table and report any drift."""
     conn = get_db_connection()
     if not conn:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        log.error("No DB connection in reconcile-stats")
+        return
     try:
         with conn.cursor() as cur:
+            # Blocks conversation writes (not reads) until the commit, so no
+            # trigger update can land between the count and the rewrite.
+            cur.execute("LOCK TABLE conversations IN SHARE MODE")
+            cur.execute(CONVERSATION_STATS_SQL)
+            kept = _conversation_stats(cur.fetchall())
+            cur.execute(CONVERSATION_STATS_ACTUAL_SQL)
+            actual_row = cur.fetchone()
+            actual = _conversation_stats([actual_row])
             cur.execute('''
-                SELECT
-                    id,
-                    conversation_text,
-                    created_at,
-                    is_saved,
-                    is_shared,
-                    COALESCE(rating_sum, 0),
-                    COALESCE(rating_count, 0),
-                    photo_base64,
-                    title
-                FROM conversations
-                WHERE is_saved = TRUE
-                ORDER BY created_at DESC
+                UPDATE conversation_stats
+                   SET total = 0, saved = 0, shared = 0, rated = 0,
+                       rating_sum = 0, rating_count = 0
+                 WHERE slot <> 0
             ''')
-            rows = cur.fetchall()
-            results = []
-            for row in rows:
-                conv_id      = row[0]
-                conversation = row[1]
-                created_at   = row[2]
-                is_saved     = row[3]
-                is_shared    = row[4]
-                rating_sum   = float(row[5])
-                rating_count = int(row[6])
-                photo_base64 = row[7]
-                title        = row[8] if row[8] else None
-
-                avg_rating = 0.0
-                if rating_count > 0:
-                    avg_rating = rating_sum / rating_count
-
-                results.append({
-                    'id': conv_id,
-                    'conversation': conversation,
-                    'created_at': created_at,
-                    'is_saved': is_saved,
-                    'is_shared': is_shared,
-                    'rating_sum': rating_sum,
-                    'rating_count': rating_count,
-                    'average_rating': avg_rating,
-                    'photo_base64': photo_base64,
-                    'title': title
-                })
-            return jsonify(results), 200
-    except Exception as e:
-        print(f"[ERROR] Failed to fetch saved conversations: {e}")
-        return jsonify({"error": "Failed to fetch saved conversations"}), 500
+            cur.execute('''
+                UPDATE conversation_stats
+                   SET total = %s, saved = %s, shared = %s, rated = %s,
+                       rating_sum = %s, rating_count = %s
+                 WHERE slot = 0
+            ''', actual_row)
+        conn.commit()
+        response_cache.invalidate('conversations')
+        drift = {name: actual[name] - kept[name] for name in actual if actual[name] != kept[name]}
+        if drift:
+            log.warning("Corrected conversation stats drift: %s", drift)
+        else:
+            log.info("Conversation stats were already correct")
+    except Exception:
+        conn.rollback()
+        log.exception("Stats reconciliation failed")
     finally:
         release_db_connection(conn)
 
-@app.route('/api/conversations/shared', methods=['GET'])
-def get_shared_conversations():
+# Delta sync: every conversation write gets a new (change_txid,
+# change_seq) version and every delete a tombstone with one (migration 12).
+# A sync token is the version of the last change a client has applied.
+
+def _touch_conversations(conn, conv_ids):
+    """
+    Give conversations a new version, so delta sync picks up data written
+    after them (thumbnails, inference results). Commits on its own, after
+    the caller's commit, so a job never waits on a conversation row while
+    holding other locks.
+    """
+    if not conv_ids:
+        return
+    with conn.cursor() as cur:
+        cur.execute("SELECT touch_conversations(%s)", (list(conv_ids),))
+    conn.commit()
+
+def _touch_photo_conversations(conn, digests):
+    """_touch_conversations for every conversation whose photo is in `digests`."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT conversation_id FROM conversation_photos WHERE sha256 = ANY(%s)",
+                    (list(digests),))
+        conv_ids = [row[0] for row in cur.fetchall()]
+    _touch_conversations(conn, conv_ids)
+
+def _decode_change_token(token):
+    """Decode a (change_txid, change_seq) sync token. Raises ValueError if malformed."""
+    try:
+        txid, seq = _decode_token(token)
+        return int(txid), int(seq)
+    except Exception:
+        raise ValueError("Invalid since token")
+
+def _conversation_changes_query(args):
+    """
+    Build the SQL for one page of changes after the `since` token (all
+    conversations when absent), oldest first: changed rows and tombstones
+    merged in version order, each side read from its version index.
+    Returns (sql, params, limit, fields, since); raises ValueError on bad
+    query args.
+    """
+    limit, _ = _parse_page_args(args)
+    fields = _parse_fields(args)
+    raw_since = args.get('since')
+    since = _decode_change_token(raw_since) if raw_since else (0, 0)
+
+    select_sql, aliases, join_sql = _projection_sql(fields)
+    blanks = ", ".join("NULL" for _ in aliases)
+    # Versions at or past the oldest running transaction may still be
+    # joined by earlier ones, so they wait for a later sync.
+    sql = f'''
+        WITH h AS (SELECT txid_snapshot_xmin(txid_current_snapshot()) AS horizon)
+        SELECT changes.*
+        FROM (
+            (SELECT c.change_txid AS _txid, c.change_seq AS _seq, NULL::int AS _deleted_id,
+                    {select_sql}
+             FROM conversations c
+             CROSS JOIN h
+             {join_sql}
+             WHERE (c.change_txid, c.change_seq) > (%s, %s)
+               AND c.change_txid < h.horizon
+             ORDER BY c.change_txid, c.change_seq
+             LIMIT %s)
+            UNION ALL
+            (SELECT t.change_txid, t.change_seq, t.conversation_id, {blanks}
+             FROM conversation_tombstones t
+             CROSS JOIN h
+             WHERE (t.change_txid, t.change_seq) > (%s, %s)
+               AND t.change_txid < h.horizon
+             ORDER BY t.change_txid, t.change_seq
+             LIMIT %s)
+        ) changes
+        ORDER BY changes._txid, changes._seq
+        LIMIT %s
+    '''
+    params = [*since, limit + 1, *since, limit + 1, limit + 1]
+    return sql, params, limit, fields, since
+
+def _changes_page(rows, limit, fields, since):
+    """
+    Turn the limit+1 rows of a changes query into the sync payload. Apply
+    `items` and `deleted`, store `next_token`, and repeat while `has_more`.
+    """
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items, deleted = [], []
+    for row in rows:
+        if row[2] is not None:
+            deleted.append(row[2])
+        else:
+            items.append(_project_row(row[3:], fields))
+    last = (rows[-1][0], rows[-1][1]) if rows else since
+    return {"items": items, "deleted": deleted,
+            "next_token": _encode_token(list(last)), "has_more": has_more}
+
+@app.route('/api/conversations/changes', methods=['GET'])
+def get_conversation_changes():
+    """
+    Conversations created, updated or deleted since the `since` token, for
+    clients keeping a local copy. Takes limit and fields like the lists.
+    Not cached: rows become readable when older transactions end, which
+    sends no invalidation.
+    """
+    try:
+        sql, params, limit, fields, since = _conversation_changes_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Failed to connect to the database"}), 500
     try:
         with conn.cursor() as cur:
-            cur.execute('''
-                SELECT
-                    id,
-                    conversation_text,
-                    created_at,
-                    is_saved,
-                    is_shared,
-                    COALESCE(rating_sum, 0),
-                    COALESCE(rating_count, 0),
-                    photo_base64,
-                    title
-                FROM conversations
-                WHERE is_shared = TRUE
-                ORDER BY created_at DESC
-            ''')
+            cur.execute(sql, params)
             rows = cur.fetchall()
-            results = []
-            for row in rows:
-                conv_id      = row[0]
-                conversation = row[1]
-                created_at   = row[2]
-                is_saved     = row[3]
-                is_shared    = row[4]
-                rating_sum   = float(row[5])
-                rating_count = int(row[6])
-                photo_base64 = row[7]
-                title        = row[8] if row[8] else None
-
-                avg_rating = 0.0
-                if rating_count > 0:
-                    avg_rating = rating_sum / rating_count
-
-                results.append({
-                    'id': conv_id,
-                    'conversation': conversation,
-                    'created_at': created_at,
-                    'is_saved': is_saved,
-                    'is_shared': is_shared,
-                    'rating_sum': rating_sum,
-                    'rating_count': rating_count,
-                    'average_rating': avg_rating,
-                    'photo_base64': photo_base64,
-                    'title': title
-                })
-            return jsonify(results), 200
-    except Exception as e:
-        print(f"[ERROR] Failed to fetch shared conversations: {e}")
-        return jsonify({"error": "Failed to fetch shared conversations"}), 500
+        return jsonify(_changes_page(rows, limit, fields, since)), 200
+    except Exception:
+        log.exception("Failed to fetch conversation changes")
+        return jsonify({"error": "Failed to fetch conversation changes"}), 500
     finally:
         release_db_connection(conn)
 
@@ -378,6 +3069,12 @@ def add_conversation():
     title = data.get('title', '').strip()
     if not conversation_text:
         return jsonify({"error": "No conversation text provided"}), 400
+    photo = None
+    if data.get('photo_base64'):
+        try:
+            photo = _decode_photo(data['photo_base64'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Failed to connect to the database"}), 500
@@ -391,10 +3088,9 @@ def add_conversation():
                     is_shared,
                     rating_sum,
                     rating_count,
-                    photo_base64,
                     title
                 )
-                VALUES (%s, %s, %s, %s, 0, 0, %s, %s)
+                VALUES (%s, %s, %s, %s, 0, 0, %s)
                 RETURNING
                     id,
                     conversation_text,
@@ -403,138 +3099,172 @@ def add_conversation():
                     is_shared,
                     rating_sum,
                     rating_count,
-                    photo_base64,
                     title
             ''', (
                 conversation_text,
                 datetime.utcnow(),
                 False,
                 False,
-                data.get('photo_base64'),
                 title if title else None
             ))
             new_conv = cur.fetchone()
+            photo_sha256 = None
+            if photo:
+                photo_sha256 = _store_photo(cur, new_conv[0], *photo)
             conn.commit()
+            response_cache.invalidate('conversations')
             return jsonify({
                 'id': new_conv[0],
                 'conversation': new_conv[1],
-                'created_at': new_conv[2].isoformat(),
+                'created_at': new_conv[2],
                 'is_saved': new_conv[3],
                 'is_shared': new_conv[4],
                 'rating_sum': float(new_conv[5]),
                 'rating_count': int(new_conv[6]),
                 'average_rating': (float(new_conv[5]) / int(new_conv[6])) if int(new_conv[6]) > 0 else 0.0,
-                'photo_base64': new_conv[7],
-                'title': new_conv[8]
+                'photo_url': _photo_url(new_conv[0], photo_sha256),
+                'title': new_conv[7]
             }), 201
-    except Exception as e:
-        print(f"[ERROR] Failed to add conversation: {e}")
+    except Exception:
+        log.exception("Failed to add conversation")
         return jsonify({"error": "Failed to add conversation"}), 500
     finally:
         release_db_connection(conn)
 
-@app.route('/api/conversations/<int:conversation_id>', methods=['PUT'])
+@app.route('/api/conversations/bulk', methods=['POST'])
+def add_conversations_bulk():
+    return _bulk_insert(_validate_bulk_conversation, _insert_conversation_chunk, "conversations",
+                        "conversations")
+
+@app.route('/api/conversations/<int:conversation_id>', methods=['PUT', 'PATCH'])
 def update_conversation(conversation_id):
-    data = request.get_json()
+    """
+    Partial update in a single statement: only the supplied fields are
+    written, and a rating is added server-side so concurrent raters never
+    overwrite each other's increments. Each rating is also appended to
+    rating_events and to the windowed leaderboards.
+    """
+    data = request.get_json() or {}
+    sets = []
+    params = []
+
     is_saved = data.get('is_saved')
+    if isinstance(is_saved, bool):
+        sets.append("is_saved = %s")
+        params.append(is_saved)
+
     new_is_shared = data.get('is_shared')
+    if isinstance(new_is_shared, bool):
+        sets.append("is_shared = %s")
+        params.append(new_is_shared)
+
     new_rating = data.get('rating')
+    if isinstance(new_rating, (int, float)) and not isinstance(new_rating, bool):
+        new_rating = float(new_rating)
+        # SET expressions see the old values, so rating_score is computed
+        # from the same increment.
+        sets.append("rating_sum = COALESCE(rating_sum, 0) + %s")
+        sets.append("rating_count = COALESCE(rating_count, 0) + 1")
+        sets.append("rating_score = (COALESCE(rating_sum, 0) + %s + %s)"
+                    " / (COALESCE(rating_count, 0) + 1 + %s)")
+        params += [new_rating, new_rating,
+                   RATING_PRIOR_MEAN * RATING_PRIOR_WEIGHT, RATING_PRIOR_WEIGHT]
+    else:
+        new_rating = None
+
+    if 'title' in data and (data['title'] is None or isinstance(data['title'], str)):
+        new_title = (data['title'] or '').strip()
+        sets.append("title = %s")
+        params.append(new_title if new_title else None)
+
     photo_b64 = data.get('photo_base64')
-    new_title = data.get('title', '').strip()
+    photo = None
+    if isinstance(photo_b64, str) and photo_b64:
+        try:
+            photo = _decode_photo(photo_b64)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    remove_photo = photo_b64 == ''
+
+    if not sets and not photo and not remove_photo:
+        return jsonify({"error": "No updatable fields provided"}), 400
+
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Failed to connect to the database"}), 500
     try:
         with conn.cursor() as cur:
-            cur.execute('''
+            if sets:
+                target = f'''
+                    UPDATE conversations
+                       SET {", ".join(sets)}
+                     WHERE id = %s
+                 RETURNING id, conversation_text, created_at, is_saved, is_shared,
+                           rating_sum, rating_count, title
+                '''
+            else:
+                # Photo-only change: lock the row so the photo write below
+                # cannot race a concurrent delete.
+                target = '''
+                    SELECT id, conversation_text, created_at, is_saved, is_shared,
+                           rating_sum, rating_count, title
+                      FROM conversations
+                     WHERE id = %s
+                       FOR UPDATE
+                '''
+            params.append(conversation_id)
+            cur.execute(f'''
+                WITH target AS ({target})
                 SELECT
-                    id,
-                    conversation_text,
-                    created_at,
-                    is_saved,
-                    is_shared,
-                    COALESCE(rating_sum, 0),
-                    COALESCE(rating_count, 0),
-                    photo_base64,
-                    title
-                FROM conversations
-                WHERE id = %s
-            ''', (conversation_id,))
-            row = cur.fetchone()
-            if not row:
+                    t.id,
+                    t.conversation_text,
+                    t.created_at,
+                    t.is_saved,
+                    t.is_shared,
+                    COALESCE(t.rating_sum, 0),
+                    COALESCE(t.rating_count, 0),
+                    p.sha256,
+                    t.title
+                FROM target t
+                LEFT JOIN conversation_photos p ON p.conversation_id = t.id
+            ''', params)
+            updated = cur.fetchone()
+            if not updated:
+                conn.rollback()
                 return jsonify({"error": "Conversation not found"}), 404
 
-            current_is_saved = row[3]
-            current_is_shared = row[4]
-            current_rating_sum = float(row[5])
-            current_rating_cnt = int(row[6])
-            current_photo_b64 = row[7]
-            current_title = row[8] if row[8] else None
-
-            if isinstance(is_saved, bool):
-                current_is_saved = is_saved
-            if isinstance(new_is_shared, bool):
-                current_is_shared = new_is_shared
-            if isinstance(new_rating, (int, float)):
-                current_rating_sum += float(new_rating)
-                current_rating_cnt += 1
-            if isinstance(photo_b64, str):
-                current_photo_b64 = photo_b64 if photo_b64 else None
-            if isinstance(new_title, str):
-                current_title = new_title if new_title else None
-
-            cur.execute('''
-                UPDATE conversations
-                   SET is_saved     = %s,
-                       is_shared    = %s,
-                       rating_sum   = %s,
-                       rating_count = %s,
-                       photo_base64 = %s,
-                       title        = %s
-                 WHERE id = %s
-             RETURNING
-                id,
-                conversation_text,
-                created_at,
-                is_saved,
-                is_shared,
-                rating_sum,
-                rating_count,
-                photo_base64,
-                title
-            ''', (
-                current_is_saved,
-                current_is_shared,
-                current_rating_sum,
-                current_rating_cnt,
-                current_photo_b64,
-                current_title,
-                conversation_id
-            ))
-            updated = cur.fetchone()
+            if new_rating is not None:
+                _record_rating(cur, conversation_id, new_rating)
+            photo_sha256 = updated[7]
+            if photo:
+                photo_sha256 = _store_photo(cur, conversation_id, *photo)
+            elif remove_photo:
+                cur.execute('DELETE FROM conversation_photos WHERE conversation_id = %s',
+                            (conversation_id,))
+                photo_sha256 = None
             conn.commit()
-            if updated:
-                sum_val   = float(updated[5])
-                count_val = int(updated[6])
-                avg_rating = 0.0
-                if count_val > 0:
-                    avg_rating = sum_val / count_val
-                return jsonify({
-                    'id': updated[0],
-                    'conversation': updated[1],
-                    'created_at': updated[2].isoformat(),
-                    'is_saved': updated[3],
-                    'is_shared': updated[4],
-                    'rating_sum': sum_val,
-                    'rating_count': count_val,
-                    'average_rating': avg_rating,
-                    'photo_base64': updated[7],
-                    'title': updated[8]
-                }), 200
-            else:
-                return jsonify({"error": "Conversation not found"}), 404
-    except Exception as e:
-        print(f"[ERROR] Failed to update conversation: {e}")
+            response_cache.invalidate('conversations')
+
+            sum_val   = float(updated[5])
+            count_val = int(updated[6])
+            avg_rating = 0.0
+            if count_val > 0:
+                avg_rating = sum_val / count_val
+            return jsonify({
+                'id': updated[0],
+                'conversation': updated[1],
+                'created_at': updated[2],
+                'is_saved': updated[3],
+                'is_shared': updated[4],
+                'rating_sum': sum_val,
+                'rating_count': count_val,
+                'average_rating': avg_rating,
+                'photo_url': _photo_url(updated[0], photo_sha256),
+                'title': updated[8]
+            }), 200
+    except Exception:
+        conn.rollback()
+        log.exception("Failed to update conversation")
         return jsonify({"error": "Failed to update conversation"}), 500
     finally:
         release_db_connection(conn)
@@ -549,41 +3279,547 @@ def delete_conversation(conversation_id):
             cur.execute('DELETE FROM conversations WHERE id = %s RETURNING id', (conversation_id,))
             deleted = cur.fetchone()
             conn.commit()
+            response_cache.invalidate('conversations')
             if deleted:
                 return jsonify({"deleted_id": deleted[0]}), 200
             else:
                 return jsonify({"error": "Conversation not found"}), 404
-    except Exception as e:
-        print(f"[ERROR] Failed to delete conversation: {e}")
+    except Exception:
+        log.exception("Failed to delete conversation")
         return jsonify({"error": "Failed to delete conversation"}), 500
     finally:
         release_db_connection(conn)
 
+@app.route('/api/conversations/<int:conversation_id>/photo', methods=['GET'])
+def get_conversation_photo(conversation_id):
+    """
+    Stream the raw photo bytes. Supports If-None-Match (304) and Range (206).
+    The image bytes are only read from the database when the client's ETag
+    does not already match.
+    """
+    return _stored_image_response('''
+        SELECT content_type,
+               sha256,
+               byte_size,
+               CASE WHEN sha256 = ANY(%s) THEN NULL ELSE data END
+          FROM conversation_photos
+         WHERE conversation_id = %s
+    ''', (list(request.if_none_match.as_set()), conversation_id), "photo")
+
+@app.route('/api/conversations/<int:conversation_id>/photo', methods=['PUT'])
+def upload_conversation_photo(conversation_id):
+    """
+    Replace the photo with the raw request body, or with the 'photo' part
+    of a multipart/form-data body. The image is spooled (see _spool_photo)
+    and then copied to the database in chunks in one short transaction; the
+    type comes from its magic bytes, not the declared Content-Type.
+    """
+    limit = PHOTO_MAX_BYTES
+    if request.mimetype == 'multipart/form-data':
+        limit += MULTIPART_OVERHEAD
+    if request.content_length is not None and request.content_length > limit:
+        return jsonify({"error": f"Photo exceeds {PHOTO_MAX_BYTES} bytes"}), 413
+    try:
+        spool, content_type = _spool_photo(_request_photo_chunks())
+    except PhotoTooLarge:
+        return jsonify({"error": f"Photo exceeds {PHOTO_MAX_BYTES} bytes"}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with spool:
+        return _save_spooled_photo(conversation_id, spool, content_type)
+
+def _save_spooled_photo(conversation_id, spool, content_type):
+    """Store a spooled upload as the conversation's photo; returns the response."""
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+    try:
+        with conn.cursor() as cur:
+            # Lock the row so the photo cannot race a concurrent delete.
+            cur.execute('SELECT id FROM conversations WHERE id = %s FOR UPDATE',
+                        (conversation_id,))
+            if not cur.fetchone():
+                conn.rollback()
+                return jsonify({"error": "Conversation not found"}), 404
+            digest, byte_size = _store_photo_stream(
+                cur, conversation_id, content_type,
+                iter(lambda: spool.read(PHOTO_CHUNK_SIZE), b''))
+        conn.commit()
+        response_cache.invalidate('conversations')
+        return jsonify({
+            'id': conversation_id,
+            'photo_url': _photo_url(conversation_id, digest),
+            'content_type': content_type,
+            'byte_size': byte_size,
+        }), 200
+    except Exception:
+        conn.rollback()
+        log.exception("Failed to upload conversation photo")
+        return jsonify({"error": "Failed to upload conversation photo"}), 500
+    finally:
+        release_db_connection(conn)
+
+@app.route('/api/conversations/<int:conversation_id>/thumbnail', methods=['GET'])
+def get_conversation_thumbnail(conversation_id):
+    """
+    Stream a downscaled JPEG of the photo; `size` is one of THUMBNAIL_SIZES
+    (default: the list size). 404 until the background job has made it.
+    """
+    try:
+        size = int(request.args.get('size', THUMBNAIL_LIST_SIZE))
+    except ValueError:
+        size = None
+    if size not in THUMBNAIL_SIZES:
+        return jsonify({"error": f"size must be one of {', '.join(map(str, THUMBNAIL_SIZES))}"}), 400
+    return _stored_image_response('''
+        SELECT content_type,
+               sha256,
+               byte_size,
+               CASE WHEN sha256 = ANY(%s) THEN NULL ELSE data END
+          FROM conversation_thumbnails
+         WHERE conversation_id = %s AND size = %s
+    ''', (list(request.if_none_match.as_set()), conversation_id, size), "thumbnail")
+
+# -----------------------------------------------------------------
+# EXPORT
+# -----------------------------------------------------------------
+EXPORT_ITERSIZE = int(os.getenv("EXPORT_ITERSIZE", 2000))
+EXPORT_FLUSH_BYTES = 64 * 1024
+def _export_records(conn, where, params, fields):
+    """
+    Yield export rows as dicts from a server-side (named) cursor, so only
+    EXPORT_ITERSIZE rows are ever held in worker memory.
+    """
+    select_sql, _, join_sql = _projection_sql(fields)
+    with conn.cursor(name="conversations_export") as cur:
+        cur.itersize = EXPORT_ITERSIZE
+        cur.execute(f'''
+            SELECT {select_sql}
+            FROM conversations c
+            {join_sql}
+            {where}
+            ORDER BY c.created_at, c.id
+        ''', params)
+        for row in cur:
+            record = _project_row(row, fields)
+            for name, value in record.items():
+                if isinstance(value, datetime):
+                    record[name] = value.isoformat()
+            yield record
+
+def _encode_ndjson(records):
+    for record in records:
+        yield app.json.dumps(record) + "\n"
+
+def _csv_cell(value):
+    """Structured values (e.g. inference) go into a CSV cell as JSON, not repr()."""
+    if isinstance(value, (dict, list)):
+        return app.json.dumps(value)
+    return value
+
+def _encode_csv(records, fields):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for record in records:
+        writer.writerow([_csv_cell(record[name]) for name in fields])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+def _buffered_bytes(chunks):
+    """Join small text chunks into ~64 KiB writes."""
+    pending = []
+    size = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        pending.append(data)
+        size += len(data)
+        if size >= EXPORT_FLUSH_BYTES:
+            yield b"".join(pending)
+            pending, size = [], 0
+    if pending:
+        yield b"".join(pending)
+
+@app.route('/api/conversations/export', methods=['GET'])
+def export_conversations():
+    """
+    Stream every matching conversation as NDJSON (default) or CSV.
+    Filters: saved, shared (true/false), since, until (ISO 8601, on created_at).
+    `fields` picks the exported columns, as on the list routes.
+    The stream is compressed by compress_response when the client accepts it.
+    """
+    fmt = request.args.get('format', 'ndjson').lower()
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+    try:
+        saved = _parse_bool_arg(request.args, 'saved')
+        shared = _parse_bool_arg(request.args, 'shared')
+        since = _parse_datetime_arg(request.args, 'since')
+        until = _parse_datetime_arg(request.args, 'until')
+        fields = _parse_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conditions = []
+    params = []
+    if saved is not None:
+        conditions.append("c.is_saved = %s")
+        params.append(saved)
+    if shared is not None:
+        conditions.append("c.is_shared = %s")
+        params.append(shared)
+    if since:
+        conditions.append("c.created_at >= %s")
+        params.append(since)
+    if until:
+        conditions.append("c.created_at < %s")
+        params.append(until)
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    def generate():
+        try:
+            records = _export_records(conn, where, params, fields)
+            chunks = _encode_csv(records, fields) if fmt == 'csv' else _encode_ndjson(records)
+            yield from _buffered_bytes(chunks)
+        except Exception:
+            log.exception("Conversation export aborted")
+            # The 200 is already sent: re-raise so the server drops the
+            # connection without ending the chunked body, and the client
+            # sees an incomplete download instead of a short file.
+            raise
+
+    def release():
+        conn.rollback()
+        release_db_connection(conn)
+
+    if fmt == 'csv':
+        mimetype, filename = 'text/csv', 'conversations.csv'
+    else:
+        mimetype, filename = 'application/x-ndjson', 'conversations.ndjson'
+    resp = Response(generate(), mimetype=mimetype)
+    # The WSGI server closes the response even when generate() never ran
+    # (HEAD, or a client gone before the first chunk), so the pooled
+    # connection is always returned.
+    resp.call_on_close(release)
+    resp.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return resp
+
+@app.cli.command("migrate-photos")
+def migrate_photos_command():
+    """One-shot move of legacy conversations.photo_base64 into conversation_photos."""
+    batch_size = 200
+    moved = skipped = 0
+    last_id = 0
+    conn = get_db_connection()
+    if not conn:
+        log.error("No DB connection in migrate-photos")
+        return
+    try:
+        with conn.cursor() as cur:
+            while True:
+                cur.execute('''
+                    SELECT id, photo_base64
+                      FROM conversations
+                     WHERE photo_base64 IS NOT NULL
+                       AND id > %s
+                     ORDER BY id
+                     LIMIT %s
+                     FOR UPDATE SKIP LOCKED
+                ''', (last_id, batch_size))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                done_ids = []
+                for conv_id, photo_b64 in rows:
+                    last_id = conv_id
+                    try:
+                        data, content_type = _decode_photo(photo_b64)
+                    except ValueError as e:
+                        log.warning("Skipping photo of conversation %s: %s", conv_id, e)
+                        skipped += 1
+                        continue
+                    cur.execute('''
+                        INSERT INTO conversation_photos (conversation_id, content_type, sha256, byte_size, data)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (conversation_id) DO NOTHING
+                    ''', (conv_id, content_type, hashlib.sha256(data).hexdigest(),
+                          len(data), psycopg2.Binary(data)))
+                    done_ids.append(conv_id)
+                if done_ids:
+                    cur.execute('UPDATE conversations SET photo_base64 = NULL WHERE id = ANY(%s)',
+                                (done_ids,))
+                conn.commit()
+                moved += len(done_ids)
+                log.info("Migrated %s photos so far (up to id %s)", moved, last_id)
+        log.info("Photo migration finished: %s moved, %s skipped", moved, skipped)
+    except Exception:
+        conn.rollback()
+        log.exception("Photo migration failed")
+    finally:
+        release_db_connection(conn)
+
+@app.cli.command("backfill-thumbnails")
+def backfill_thumbnails_command():
+    """Generate missing thumbnails (every THUMBNAIL_SIZES box) for existing photos."""
+    if Image is None:
+        log.error("Pillow is not installed; cannot generate thumbnails")
+        return
+    batch_size = 50
+    made = failed = 0
+    last_id = 0
+    conn = get_db_connection()
+    if not conn:
+        log.error("No DB connection in backfill-thumbnails")
+        return
+    try:
+        with conn.cursor() as cur, ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS) as executor:
+            while True:
+                cur.execute('''
+                    SELECT p.conversation_id, p.sha256, p.data
+                      FROM conversation_photos p
+                     WHERE p.conversation_id > %s
+                       AND (SELECT COUNT(*)
+                              FROM conversation_thumbnails t
+                             WHERE t.conversation_id = p.conversation_id
+                               AND t.source_sha256 = p.sha256
+                               AND t.size = ANY(%s)) < %s
+                     ORDER BY p.conversation_id
+                     LIMIT %s
+                ''', (last_id, list(THUMBNAIL_SIZES), len(THUMBNAIL_SIZES), batch_size))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                futures = [(conv_id, sha256, executor.submit(_make_thumbnails, bytes(data)))
+                           for conv_id, sha256, data in rows]
+                thumbnailed = []
+                for conv_id, sha256, future in futures:
+                    last_id = conv_id
+                    try:
+                        thumbnails = future.result()
+                    except Exception as e:
+                        log.warning("Skipping thumbnails of conversation %s: %s", conv_id, e)
+                        failed += 1
+                        continue
+                    _save_thumbnails(cur, conv_id, sha256, thumbnails)
+                    thumbnailed.append(conv_id)
+                    made += 1
+                conn.commit()
+                _touch_conversations(conn, thumbnailed)
+                log.info("Thumbnailed %s photos so far (up to id %s)", made, last_id)
+        log.info("Thumbnail backfill finished: %s done, %s failed", made, failed)
+    except Exception:
+        conn.rollback()
+        log.exception("Thumbnail backfill failed")
+    finally:
+        release_db_connection(conn)
+
 # -----------------------------------------------------------------
 # INVENTORY ENDPOINTS
 # -----------------------------------------------------------------
+MAX_INVENTORY_QUERY_LENGTH = 100
+DEFAULT_SUGGEST_LIMIT = int(os.getenv("DEFAULT_SUGGEST_LIMIT", 8))
+MAX_SUGGEST_LIMIT = 25
+
+def _inventory_search_term(args):
+    """Read 'q' from the query string; returns None when it is absent or blank."""
+    q = args.get('q', '').strip()
+    if len(q) > MAX_INVENTORY_QUERY_LENGTH:
+        raise ValueError("q is too long")
+    return q or None
+
+def _like_prefix(q):
+    """`q` as a case-insensitive LIKE prefix pattern, wildcards escaped."""
+    escaped = q.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+def _decode_inventory_cursor(token):
+    """
+    Decode an inventory cursor: (id,) for the plain list, (prefix, score, id)
+    for a `q=` match. Raises ValueError on a malformed token.
+    """
+    try:
+        values = _decode_token(token)
+        if len(values) == 1:
+            return (int(values[0]),)
+        prefix, score, item_id = values
+        return bool(prefix), float(score), int(item_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _inventory_list_query(args):
+    """
+    Build the SQL for one page of inventory. Without `q` items are listed
+    newest first; with it, names starting with `q` come first, then fuzzy
+    (trigram) matches by similarity. Both use the indexes from migration 9.
+    Returns (sql, params, limit), with limit None for an unpaged request
+    (see _is_paged); raises ValueError on bad query args.
+    """
+    q = _inventory_search_term(args)
+    limit, cursor = _parse_page_args(args, _decode_inventory_cursor)
+    if cursor and len(cursor) != (3 if q else 1):
+        raise ValueError("Invalid cursor")
+    if not _is_paged(args):
+        limit = None
+    fetch = _fetch_size(limit)
+
+    if not q:
+        params = []
+        where = ""
+        if cursor:
+            where = "WHERE id < %s"
+            params.extend(cursor)
+        params.append(fetch)
+        sql = f'''
+            SELECT id, name
+            FROM inventory
+            {where}
+            ORDER BY id DESC
+            LIMIT %s
+        '''
+        return sql, params, limit
+
+    pattern = _like_prefix(q)
+    params = [pattern, q, pattern, q]
+    after = ""
+    if cursor:
+        after = "WHERE (m.prefix, m.score, m.id) < (%s, %s::real, %s)"
+        params.extend(cursor)
+    params.append(fetch)
+    sql = f'''
+        SELECT m.id, m.name, m.prefix, m.score
+        FROM (
+            SELECT i.id, i.name,
+                   lower(i.name) COLLATE "C" LIKE %s AS prefix,
+                   similarity(i.name, %s) AS score
+            FROM inventory i
+            WHERE lower(i.name) COLLATE "C" LIKE %s OR i.name %% %s
+        ) m
+        {after}
+        ORDER BY m.prefix DESC, m.score DESC, m.id DESC
+        LIMIT %s
+    '''
+    return sql, params, limit
+
+def _inventory_page(rows, limit):
+    """
+    Turn the limit+1 rows of an inventory query into the page payload, or
+    every row into a bare array when limit is None. Raises ValueError when
+    an unpaged list is over MAX_UNPAGED_ROWS.
+    """
+    if limit is None:
+        return [{'id': row[0], 'name': row[1]} for row in _unpaged_rows(rows)]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        # Plain rows are (id, name); matches add (prefix, score).
+        next_cursor = _encode_token([rows[-1][2], rows[-1][3], rows[-1][0]]
+                                    if len(rows[-1]) > 2 else [rows[-1][0]])
+    return {"items": [{'id': row[0], 'name': row[1]} for row in rows],
+            "next_cursor": next_cursor}
+
+def _inventory_suggest_query(args):
+    """
+    Build the SQL for name suggestions: distinct names starting with `q`,
+    topped up with the closest trigram matches. Each branch reads its rows
+    in order from an index (migration 9) and stops at `limit`, so a short
+    prefix never sorts the whole table.
+    Returns (sql, params); raises ValueError on bad query args.
+    """
+    q = _inventory_search_term(args)
+    if not q:
+        raise ValueError("q is required")
+    raw_limit = args.get('limit')
+    if raw_limit is None or raw_limit == '':
+        limit = DEFAULT_SUGGEST_LIMIT
+    else:
+        try:
+            limit = int(raw_limit)
+        except ValueError:
+            raise ValueError("limit must be an integer")
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        limit = min(limit, MAX_SUGGEST_LIMIT)
+
+    sql = '''
+        SELECT name
+        FROM (
+            SELECT DISTINCT ON (name) name, tier, score
+            FROM (
+                (SELECT name, 0 AS tier, 1::real AS score
+                 FROM inventory
+                 WHERE lower(name) COLLATE "C" LIKE %s
+                 ORDER BY lower(name) COLLATE "C"
+                 LIMIT %s)
+                UNION ALL
+                (SELECT name, 1 AS tier, similarity(name, %s) AS score
+                 FROM inventory
+                 WHERE name %% %s
+                 ORDER BY name <-> %s
+                 LIMIT %s)
+            ) candidates
+            ORDER BY name, tier, score DESC
+        ) named
+        ORDER BY tier, score DESC, lower(name)
+        LIMIT %s
+    '''
+    params = [_like_prefix(q), limit, q, q, q, limit, limit]
+    return sql, params
+
+def _inventory_suggestions(rows):
+    return {"suggestions": [row[0] for row in rows]}
+
 @app.route('/api/inventory', methods=['GET'])
+@cached_response('inventory')
 def get_inventory():
+    try:
+        sql, params, limit = _inventory_list_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Failed to connect to the database"}), 500
     try:
         with conn.cursor() as cur:
-            cur.execute('SELECT id, name FROM inventory ORDER BY id DESC')
+            cur.execute(sql, params)
             rows = cur.fetchall()
-            inventory_list = []
-            for row in rows:
-                inventory_list.append({
-                    'id': row[0],
-                    'name': row[1],
-                })
-            return jsonify(inventory_list), 200
-    except Exception as e:
-        print(f"[ERROR] Failed to fetch inventory: {e}")
+            return jsonify(_inventory_page(rows, limit)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception:
+        log.exception("Failed to fetch inventory")
         return jsonify({"error": "Failed to fetch inventory"}), 500
     finally:
         release_db_connection(conn)
 
+@app.route('/api/inventory/suggest', methods=['GET'])
+@cached_response('inventory')
+def suggest_inventory():
+    try:
+        sql, params = _inventory_suggest_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            return jsonify(_inventory_suggestions(rows)), 200
+    except Exception:
+        log.exception("Failed to suggest inventory names")
+        return jsonify({"error": "Failed to suggest inventory names"}), 500
+    finally:
+        release_db_connection(conn)
+
 @app.route('/api/inventory', methods=['POST'])
 def add_inventory():
     data = request.get_json()
@@ -598,16 +3834,21 @@ def add_inventory():
             cur.execute('INSERT INTO inventory (name) VALUES (%s) RETURNING id, name', (name,))
             new_item = cur.fetchone()
             conn.commit()
+            response_cache.invalidate('inventory')
             return jsonify({
                 'id': new_item[0],
                 'name': new_item[1],
             }), 201
-    except Exception as e:
-        print(f"[ERROR] Failed to add to inventory: {e}")
+    except Exception:
+        log.exception("Failed to add to inventory")
         return jsonify({"error": "Failed to add to inventory"}), 500
     finally:
         release_db_connection(conn)
 
+@app.route('/api/inventory/bulk', methods=['POST'])
+def add_inventory_bulk():
+    return _bulk_insert(_validate_bulk_inventory, _insert_inventory_chunk, "inventory", "inventory")
+
 @app.route('/api/inventory/<int:item_id>', methods=['PUT'])
 def edit_inventory(item_id):
     data = request.get_json()
@@ -627,6 +3868,7 @@ def edit_inventory(item_id):
             ''', (name, item_id))
             updated_item = cur.fetchone()
             conn.commit()
+            response_cache.invalidate('inventory')
             if updated_item:
                 return jsonify({
                     'id': updated_item[0],
@@ -634,8 +3876,8 @@ def edit_inventory(item_id):
                 }), 200
             else:
                 return jsonify({"error": "Item not found"}), 404
-    except Exception as e:
-        print(f"[ERROR] Failed to edit inventory item: {e}")
+    except Exception:
+        log.exception("Failed to edit inventory item")
         return jsonify({"error": "Failed to edit inventory item"}), 500
     finally:
         release_db_connection(conn)
@@ -650,12 +3892,13 @@ def delete_inventory(item_id):
             cur.execute('DELETE FROM inventory WHERE id = %s RETURNING id', (item_id,))
             deleted = cur.fetchone()
             conn.commit()
+            response_cache.invalidate('inventory')
             if deleted:
                 return jsonify({"deleted_id": deleted[0]}), 200
             else:
                 return jsonify({"error": "Item not found"}), 404
-    except Exception as e:
-        print(f"[ERROR] Failed to delete inventory item: {e}")
+    except Exception:
+        log.exception("Failed to delete inventory item")
         return jsonify({"error": "Failed to delete inventory item"}), 500
     finally:
         release_db_connection(conn)
@@ -669,7 +3912,7 @@ def health_check():
 
 @app.route('/api/health/db', methods=['GET'])
 def health_check_db():
-    conn = get_db_connection()
+    conn = get_db_connection(primary=True)
     if not conn:
         return jsonify({"status": "db: down"}), 500
     try:
@@ -677,8 +3920,8 @@ def health_check_db():
             cur.execute("SELECT 1")
             cur.fetchone()
         return jsonify({"status": "db: up"}), 200
-    except Exception as e:
-        print(f"[ERROR] DB health check failed: {e}")
+    except Exception:
+        log.exception("DB health check failed")
         return jsonify({"status": "db: error"}), 500
     finally:
         release_db_connection(conn)
@@ -0,0 +1,58 @@
+import os
+import sys
+
+import pytest
+
+# server.py and asgi.py are top-level modules, not a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Tests that take the `db` fixture run against this database, which they
+# migrate and empty; they are skipped when it is unset or unreachable.
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture(scope="session")
+def migrated_database():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    import psycopg2
+    from migrations import run_migrations
+    try:
+        conn = psycopg2.connect(TEST_DATABASE_URL, connect_timeout=5)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"test database unavailable: {e}")
+    try:
+        run_migrations(conn)
+    finally:
+        conn.close()
+    return TEST_DATABASE_URL
+
+
+@pytest.fixture
+def connect(migrated_database):
+    """Open extra connections to the test database; all closed after the test."""
+    import psycopg2
+    opened = []
+
+    def open_connection():
+        conn = psycopg2.connect(migrated_database)
+        opened.append(conn)
+        return conn
+    yield open_connection
+    for conn in opened:
+        conn.close()
+
+
+@pytest.fixture
+def db(connect):
+    """A connection to the emptied test database."""
+    conn = connect()
+    with conn.cursor() as cur:
+        # As in benchmark.seed: TRUNCATE fires no triggers, so clear the
+        # side tables and zero the stats counters too.
+        cur.execute("TRUNCATE conversations, inventory, photo_inferences, ranking_refreshes, "
+                    "change_events, conversation_tombstones RESTART IDENTITY CASCADE")
+        cur.execute("UPDATE conversation_stats SET total = 0, saved = 0, shared = 0, "
+                    "rated = 0, rating_sum = 0, rating_count = 0")
+    conn.commit()
+    return conn
@@ -0,0 +1,16 @@
+import io
+
+import pytest
+
+import server
+
+
+def test_ndjson_rows_skip_blank_lines():
+    body = io.BytesIO(b'{"name": "a"}\n\n  {"name": "b"}\r\n')
+    assert list(server._ndjson_rows(body)) == [{'name': 'a'}, {'name': 'b'}]
+
+
+def test_ndjson_rows_report_the_bad_line():
+    body = io.BytesIO(b'{"name": "a"}\n{nope\n')
+    with pytest.raises(ValueError, match="line 2"):
+        list(server._ndjson_rows(body))
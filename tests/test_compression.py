@@ -0,0 +1,36 @@
+import pytest
+from werkzeug.http import parse_accept_header
+
+import server
+
+
+def negotiate(header):
+    return server._negotiate_encoding(parse_accept_header(header))
+
+
+def test_no_header_means_identity():
+    assert negotiate(None) is None
+    assert negotiate("identity") is None
+
+
+def test_gzip_only():
+    assert negotiate("gzip") == "gzip"
+
+
+def test_highest_quality_wins():
+    assert negotiate("gzip;q=1.0, br;q=0.5") == "gzip"
+
+
+def test_zero_quality_refuses_an_encoding():
+    assert negotiate("gzip;q=0") is None
+
+
+@pytest.mark.skipif("zstd" not in server.COMPRESSION_ENCODINGS, reason="zstandard not installed")
+def test_server_preference_breaks_ties():
+    assert negotiate("gzip, br, zstd") == "zstd"
+
+
+def test_compressed_body_round_trips():
+    import zlib
+    body = b'{"items": []}' * 100
+    assert zlib.decompress(server._compress_body(body, "gzip"), 31) == body
@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+
+import server
+
+
+def test_streams_beyond_the_cap_get_a_503(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(server, "_event_stream_slots", slots)
+    slots.acquire()
+    resp = server.app.test_client().get('/api/events')
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '30'
+    # The rejected request must not take or release a slot.
+    assert not slots.acquire(blocking=False)
+
+
+def test_event_id():
+    assert server._parse_event_id(" 123-45 ") == (123, 45)
+    with pytest.raises(ValueError):
+        server._parse_event_id("123")
+
+
+def event(txid, event_id):
+    return (txid, event_id, 'conversations', 'updated', 1, {'title': 't'})
+
+
+def test_replay_skips_the_last_seen_event():
+    rows = [event(10, 1), event(10, 2), event(11, 3)]
+    assert server._replay_events(rows, (10, 1)) == rows[1:]
+
+
+def test_replay_resets_when_last_event_was_pruned():
+    assert server._replay_events([event(10, 2)], (10, 1)) is None
+    assert server._replay_events([], (10, 1)) is None
+
+
+def test_replay_resets_when_backlog_is_too_long(monkeypatch):
+    monkeypatch.setattr(server, "EVENTS_REPLAY_MAX", 2)
+    rows = [event(10, n) for n in range(1, 5)]
+    assert server._replay_events(rows, (10, 1)) is None
+    assert server._replay_events(rows[:3], (10, 1)) == rows[1:3]
@@ -0,0 +1,103 @@
+import server
+
+
+def new_events(conn, after=(0, 0)):
+    with conn.cursor() as cur:
+        cur.execute(server.EVENTS_SELECT_SQL + '''
+            WHERE (txid, id) > (%s, %s)
+            ORDER BY txid, id
+        ''', after)
+        rows = cur.fetchall()
+    conn.commit()
+    return rows
+
+
+def actions(rows):
+    return [(resource, action, row_id) for _, _, resource, action, row_id, _ in rows]
+
+
+def test_writes_append_events_in_commit_order(db):
+    with db.cursor() as cur:
+        cur.execute("INSERT INTO conversations (conversation_text, created_at) "
+                    "VALUES ('a', NOW() AT TIME ZONE 'utc') RETURNING id")
+        conv_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO inventory (name) VALUES ('Chocolate') RETURNING id")
+        item_id = cur.fetchone()[0]
+    db.commit()
+    with db.cursor() as cur:
+        cur.execute("UPDATE conversations SET title = 'renamed' WHERE id = %s", (conv_id,))
+        # Not a field the API returns: no event.
+        cur.execute("UPDATE conversations SET rating_score = 4 WHERE id = %s", (conv_id,))
+    db.commit()
+
+    rows = new_events(db)
+    assert actions(rows) == [('conversations', 'created', conv_id),
+                             ('inventory', 'created', item_id),
+                             ('conversations', 'updated', conv_id)]
+    assert rows[-1][5]['title'] == 'renamed'
+    assert server._event_payload(conv_id, rows[-1][5])['average_rating'] == 0.0
+
+
+def test_deleting_a_conversation_with_a_photo_is_one_event(db):
+    with db.cursor() as cur:
+        cur.execute("INSERT INTO conversations (conversation_text, created_at) "
+                    "VALUES ('a', NOW() AT TIME ZONE 'utc') RETURNING id")
+        conv_id = cur.fetchone()[0]
+        cur.execute('''
+            INSERT INTO conversation_photos (conversation_id, content_type, sha256, byte_size, data)
+            VALUES (%s, 'image/png', %s, 1, '\\x00')
+        ''', (conv_id, 'ab' * 32))
+    db.commit()
+    start = new_events(db)[-1][:2]
+    assert new_events(db)[-1][5] == {'photo_sha256': 'ab' * 32}
+
+    with db.cursor() as cur:
+        cur.execute("DELETE FROM conversations WHERE id = %s", (conv_id,))
+    db.commit()
+    rows = new_events(db, start)
+    assert actions(rows) == [('conversations', 'deleted', conv_id)]
+    assert rows[0][5] is None
+
+
+def test_replay_from_stored_events(db):
+    with db.cursor() as cur:
+        for name in ('a', 'b', 'c'):
+            cur.execute("INSERT INTO inventory (name) VALUES (%s)", (name,))
+            db.commit()
+    rows = new_events(db)
+    first, position = tuple(rows[0][:2]), tuple(rows[-1][:2])
+    with db.cursor() as cur:
+        cur.execute(*server._events_replay_query(first, position))
+        replay = server._replay_events(cur.fetchall(), first)
+    db.commit()
+    assert [tuple(row[:2]) for row in replay] == [tuple(row[:2]) for row in rows[1:]]
+
+
+def test_poll_publishes_only_committed_events(db, connect, monkeypatch):
+    hub = server.EventHub()
+    monkeypatch.setattr(server, "event_hub", hub)
+    subscriber = server._QueueSubscriber()
+    with db.cursor() as cur:
+        cur.execute(server.EVENTS_HEAD_SQL)
+        hub.start(tuple(cur.fetchone() or (0, 0)))
+    db.commit()
+    hub.subscribe(subscriber)
+
+    pending = connect()
+    with pending.cursor() as cur:
+        cur.execute("INSERT INTO inventory (name) VALUES ('pending')")
+    with db.cursor() as cur:
+        cur.execute("INSERT INTO inventory (name) VALUES ('committed')")
+    db.commit()
+
+    with db.cursor() as cur:
+        # The committed event is newer than the open transaction, so it
+        # is held back until that one ends.
+        server._poll_change_events(cur)
+        assert subscriber.queue.empty()
+        pending.commit()
+        db.commit()
+        server._poll_change_events(cur)
+    db.commit()
+    published = subscriber.queue.get_nowait()
+    assert [row[5]['name'] for row in published] == ['pending', 'committed']
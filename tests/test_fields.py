@@ -0,0 +1,84 @@
+from datetime import datetime
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import server
+
+
+def test_all_fields_by_default():
+    assert server._parse_fields(MultiDict()) == tuple(server._CONVERSATION_FIELDS)
+
+
+def test_fields_come_back_in_canonical_order():
+    fields = server._parse_fields(MultiDict({'fields': 'title, id,created_at,id'}))
+    assert fields == ('id', 'created_at', 'title')
+
+
+def test_unknown_fields_are_listed():
+    with pytest.raises(ValueError, match="Unknown fields: bogus, nope"):
+        server._parse_fields(MultiDict({'fields': 'id,nope,bogus'}))
+
+
+def test_empty_field_list_is_rejected():
+    with pytest.raises(ValueError, match="at least one field"):
+        server._parse_fields(MultiDict({'fields': ' , '}))
+
+
+def test_project_row_follows_projection_layout():
+    fields = ('id', 'rating_count', 'photo_url', 'title')
+    _, aliases, join_sql = server._projection_sql(fields)
+    # _id, _created_at, then id, rating_count, photo_url (id, sha256), title
+    assert len(aliases) == 7
+    assert join_sql == server.PHOTO_JOIN_SQL
+    row = (7, datetime(2024, 1, 1), 7, 3.0, 7, "ab" * 32, "")
+    assert server._project_row(row, fields) == {
+        'id': 7,
+        'rating_count': 3,
+        'photo_url': f"/api/conversations/7/photo?v={'ab' * 8}",
+        'title': None,
+    }
+
+
+def test_projection_skips_photo_join_when_not_asked_for():
+    _, _, join_sql = server._projection_sql(('id', 'title'))
+    assert join_sql == ""
+
+
+def test_csv_export_writes_structured_values_as_json():
+    fields = ('id', 'inference', 'title')
+    records = [{'id': 1, 'inference': {'model': 'm', 'status': 'done', 'result': [1]},
+                'title': None}]
+    with server.app.app_context():
+        body = "".join(server._encode_csv(records, fields))
+    assert body.splitlines()[1] == '1,"{""model"":""m"",""status"":""done"",""result"":[1]}",'
+
+
+class RowsConnection:
+    """Just enough of a connection for _export_records' named cursor."""
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self, name=None):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def test_export_records_write_every_timestamp_as_iso8601():
+    fields = ('created_at', 'updated_at')
+    created, updated = datetime(2024, 1, 1, 8, 30), datetime(2024, 1, 2, 9, 45)
+    conn = RowsConnection([(1, created, created, updated)])
+    assert list(server._export_records(conn, "", (), fields)) == [
+        {'created_at': '2024-01-01T08:30:00', 'updated_at': '2024-01-02T09:45:00'},
+    ]
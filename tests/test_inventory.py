@@ -0,0 +1,30 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import server
+
+
+def test_unpaged_inventory_is_a_bare_array():
+    rows = [(2, 'b'), (1, 'a')]
+    assert server._inventory_page(rows, None) == [{'id': 2, 'name': 'b'}, {'id': 1, 'name': 'a'}]
+
+
+def test_unpaged_inventory_stops_at_the_ceiling(monkeypatch):
+    monkeypatch.setattr(server, 'MAX_UNPAGED_ROWS', 1)
+    _, params, limit = server._inventory_list_query(MultiDict())
+    assert limit is None and params == [2]
+    with pytest.raises(ValueError, match="More than 1 rows"):
+        server._inventory_page([(2, 'b'), (1, 'a')], None)
+
+
+def test_paged_inventory_has_a_cursor():
+    rows = [(2, 'b'), (1, 'a')]
+    assert server._inventory_page(rows, 1) == {'items': [{'id': 2, 'name': 'b'}],
+                                               'next_cursor': server._encode_token([2])}
+
+
+def test_inventory_cursor_plain_and_match():
+    assert server._decode_inventory_cursor(server._encode_token([5])) == (5,)
+    assert server._decode_inventory_cursor(server._encode_token([1, "0.5", 3])) == (True, 0.5, 3)
+    with pytest.raises(ValueError):
+        server._decode_inventory_cursor(server._encode_token([1, 2]))
@@ -0,0 +1,141 @@
+import threading
+import time
+
+import psycopg2.extensions
+import pytest
+
+import server
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        if not self.conn.alive:
+            raise psycopg2.OperationalError("server closed the connection")
+
+
+class FakeInfo:
+    def __init__(self):
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.alive = True
+        self.rollbacks = 0
+        self.info = FakeInfo()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def make_pool(monkeypatch):
+    created = []
+
+    def connect(self):
+        conn = FakeConnection()
+        created.append(conn)
+        return conn
+
+    monkeypatch.setattr(server.ConnectionPool, "_connect", connect)
+
+    def make(minconn=0, maxconn=2):
+        pool = server.ConnectionPool("postgresql://fake", "disable", minconn, maxconn)
+        pool.created = created
+        return pool
+    return make
+
+
+def test_minconn_connections_are_opened_up_front(make_pool):
+    pool = make_pool(minconn=2, maxconn=3)
+    assert len(pool.created) == 2
+
+
+def test_returned_connection_is_reused(make_pool):
+    pool = make_pool()
+    conn = pool.getconn(timeout=1)
+    pool.putconn(conn)
+    assert pool.getconn(timeout=1) is conn
+    assert len(pool.created) == 1
+
+
+def test_checkout_times_out_when_every_connection_is_out(make_pool):
+    pool = make_pool(maxconn=1)
+    pool.getconn(timeout=1)
+    started = time.monotonic()
+    with pytest.raises(server.PoolExhausted):
+        pool.getconn(timeout=0.05)
+    assert time.monotonic() - started < 1
+
+
+def test_waiting_checkout_gets_the_released_connection(make_pool):
+    pool = make_pool(maxconn=1)
+    conn = pool.getconn(timeout=1)
+    threading.Timer(0.05, pool.putconn, (conn,)).start()
+    assert pool.getconn(timeout=2) is conn
+
+
+def test_open_transaction_is_rolled_back_on_return(make_pool):
+    pool = make_pool()
+    conn = pool.getconn(timeout=1)
+    conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    pool.putconn(conn)
+    assert conn.rollbacks == 1
+    assert pool.getconn(timeout=1) is conn
+
+
+def test_broken_connection_is_discarded_on_return(make_pool):
+    pool = make_pool(maxconn=1)
+    conn = pool.getconn(timeout=1)
+    conn.closed = 2
+    pool.putconn(conn)
+    fresh = pool.getconn(timeout=1)
+    assert fresh is not conn
+    assert len(pool.created) == 2
+
+
+def test_idle_connection_is_validated_before_reuse(make_pool, monkeypatch):
+    pool = make_pool()
+    conn = pool.getconn(timeout=1)
+    pool.putconn(conn)
+    conn.alive = False
+    # Pretend it has been idle past DB_POOL_VALIDATE_AFTER.
+    pool._idle = [(conn, time.monotonic() - server.DB_POOL_VALIDATE_AFTER - 1)]
+    fresh = pool.getconn(timeout=1)
+    assert fresh is not conn and conn.closed
+
+
+def test_get_db_connection_raises_pool_exhausted_as_503(make_pool, monkeypatch):
+    pool = make_pool(maxconn=1)
+    monkeypatch.setattr(server, "_get_pool", lambda: pool)
+    monkeypatch.setattr(server, "DB_POOL_CHECKOUT_TIMEOUT", 0.05)
+    held = server.get_db_connection(primary=True)
+    try:
+        with server.app.test_request_context():
+            with pytest.raises(server.PoolExhausted) as exc:
+                server.get_db_connection(primary=True)
+            resp = server.handle_pool_exhausted(exc.value)
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After'] == '1'
+    finally:
+        server.release_db_connection(held)
+    again = server.get_db_connection(primary=True)
+    server.release_db_connection(again)
+    assert again is held
@@ -0,0 +1,96 @@
+import threading
+
+import server
+
+
+def add_conversation(conn):
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO conversations (conversation_text, created_at) "
+                    "VALUES ('hello', NOW() AT TIME ZONE 'utc') RETURNING id")
+        conv_id = cur.fetchone()[0]
+    conn.commit()
+    return conv_id
+
+
+def window_counts(conn, conv_id):
+    with conn.cursor() as cur:
+        cur.execute('''
+            SELECT window_name, rating_count, rating_sum
+            FROM conversation_rankings
+            WHERE conversation_id = %s
+        ''', (conv_id,))
+        rows = cur.fetchall()
+    conn.commit()
+    return {window: (count, total) for window, count, total in rows}
+
+
+def test_a_rating_counts_in_every_window(db):
+    conv_id = add_conversation(db)
+    with db.cursor() as cur:
+        server._record_rating(cur, conv_id, 4.0)
+    db.commit()
+    assert window_counts(db, conv_id) == {window: (1, 4.0) for window in server.RANKING_WINDOWS}
+
+
+def test_first_pass_builds_each_window_from_its_events(db):
+    conv_id = add_conversation(db)
+    with db.cursor() as cur:
+        cur.execute('''
+            INSERT INTO rating_events (conversation_id, rating, created_at)
+            VALUES (%(id)s, 5, (NOW() AT TIME ZONE 'utc') - INTERVAL '2 days'),
+                   (%(id)s, 3, NOW() AT TIME ZONE 'utc')
+        ''', {'id': conv_id})
+    db.commit()
+    server._expire_rankings(db)
+    counts = window_counts(db, conv_id)
+    assert counts['24h'] == (1, 3.0)
+    assert counts['7d'] == (2, 8.0)
+
+
+def test_ratings_leave_a_window_once_they_age_out(db):
+    conv_id = add_conversation(db)
+    server._expire_rankings(db)  # builds the empty windows
+    with db.cursor() as cur:
+        server._record_rating(cur, conv_id, 5.0)
+        server._record_rating(cur, conv_id, 1.0)
+        # Age the 5 past a day and make the 24h window due for a pass.
+        cur.execute("UPDATE rating_events SET created_at = created_at - INTERVAL '2 days' "
+                    "WHERE rating = 5")
+        cur.execute('''
+            UPDATE ranking_refreshes
+               SET refreshed_at = refreshed_at - make_interval(secs => %s),
+                   expired_before = expired_before - INTERVAL '2 days'
+             WHERE window_name = '24h'
+        ''', (server.RANKING_REFRESH_INTERVAL + 1,))
+    db.commit()
+    server._expire_rankings(db)
+    counts = window_counts(db, conv_id)
+    assert counts['24h'] == (1, 1.0)
+    assert counts['7d'] == (2, 6.0)
+
+
+def test_a_rebuild_keeps_a_rating_that_commits_while_it_runs(db, connect):
+    conv_id = add_conversation(db)
+    with db.cursor() as cur:
+        server._record_rating(cur, conv_id, 3.0)
+    db.commit()
+    rater = connect()
+    with rater.cursor() as cur:
+        server._record_rating(cur, conv_id, 4.0)
+
+    rebuilder = connect()
+
+    def rebuild():
+        with rebuilder.cursor() as cur:
+            server._refresh_ranking(cur, '24h')
+        rebuilder.commit()
+    thread = threading.Thread(target=rebuild)
+    thread.start()
+    thread.join(0.5)
+    assert thread.is_alive()
+    rater.commit()
+    thread.join(5)
+    assert not thread.is_alive()
+    # Without the window lock the rebuild would count only the first
+    # rating and overwrite the second one's increment.
+    assert window_counts(db, conv_id)['24h'] == (2, 7.0)
@@ -0,0 +1,9 @@
+import pytest
+
+import server
+
+
+def test_search_cursor():
+    assert server._decode_search_cursor(server._encode_token([0.25, "9"])) == (0.25, 9)
+    with pytest.raises(ValueError):
+        server._decode_search_cursor(server._encode_token([0.25]))
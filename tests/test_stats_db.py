@@ -0,0 +1,47 @@
+import server
+
+
+def stats(conn, sql):
+    with conn.cursor() as cur:
+        cur.execute(sql)
+        rows = cur.fetchall()
+    conn.commit()
+    return server._conversation_stats(rows)
+
+
+def test_counters_follow_inserts_updates_and_deletes(db, connect):
+    with db.cursor() as cur:
+        cur.execute('''
+            INSERT INTO conversations (conversation_text, is_saved, is_shared, rating_sum, rating_count, created_at)
+            VALUES ('a', TRUE, FALSE, 0, 0, NOW() AT TIME ZONE 'utc'),
+                   ('b', FALSE, TRUE, 9, 2, NOW() AT TIME ZONE 'utc'),
+                   ('c', TRUE, TRUE, 4, 1, NOW() AT TIME ZONE 'utc')
+        ''')
+    db.commit()
+    assert stats(db, server.CONVERSATION_STATS_SQL) == {
+        'total': 3, 'saved': 2, 'shared': 2, 'rated': 2,
+        'rating_count': 3, 'average_rating': 13 / 3,
+    }
+
+    # Another backend adds to another slot.
+    other = connect()
+    with other.cursor() as cur:
+        cur.execute("UPDATE conversations SET is_saved = NOT is_saved, "
+                    "rating_sum = rating_sum + 5, rating_count = rating_count + 1 "
+                    "WHERE conversation_text IN ('a', 'b')")
+        cur.execute("DELETE FROM conversations WHERE conversation_text = 'c'")
+    other.commit()
+    assert stats(db, server.CONVERSATION_STATS_SQL) == stats(db, server.CONVERSATION_STATS_ACTUAL_SQL)
+    assert stats(db, server.CONVERSATION_STATS_SQL)['total'] == 2
+
+
+def test_updates_that_change_no_counted_column_are_free(db):
+    with db.cursor() as cur:
+        cur.execute("INSERT INTO conversations (conversation_text, created_at) "
+                    "VALUES ('a', NOW() AT TIME ZONE 'utc')")
+        cur.execute("SELECT SUM(total) FROM conversation_stats")
+        before = cur.fetchone()[0]
+        cur.execute("UPDATE conversations SET title = 'renamed'")
+        cur.execute("SELECT SUM(total) FROM conversation_stats")
+        assert cur.fetchone()[0] == before == 1
+    db.commit()
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+def change_row(txid, seq, conv_id, deleted=False):
+    """A row of _conversation_changes_query with fields=('id', 'title')."""
+    if deleted:
+        return (txid, seq, conv_id, None, None, None, None)
+    return (txid, seq, None, conv_id, datetime(2024, 1, 1), conv_id, f"title {conv_id}")
+
+
+def test_changes_page_splits_items_and_tombstones():
+    rows = [change_row(5, 1, 1), change_row(5, 2, 2, deleted=True), change_row(6, 3, 3)]
+    page = server._changes_page(rows, 10, ('id', 'title'), (0, 0))
+    assert page['items'] == [{'id': 1, 'title': 'title 1'}, {'id': 3, 'title': 'title 3'}]
+    assert page['deleted'] == [2]
+    assert page['has_more'] is False
+    assert server._decode_change_token(page['next_token']) == (6, 3)
+
+
+def test_changes_page_stops_at_limit():
+    rows = [change_row(5, n, n) for n in range(1, 4)]
+    page = server._changes_page(rows, 2, ('id', 'title'), (0, 0))
+    assert [item['id'] for item in page['items']] == [1, 2]
+    assert page['has_more'] is True
+    assert server._decode_change_token(page['next_token']) == (5, 2)
+
+
+def test_empty_changes_page_keeps_the_token():
+    page = server._changes_page([], 10, ('id',), (42, 9))
+    assert page == {'items': [], 'deleted': [],
+                    'next_token': server._encode_token([42, 9]), 'has_more': False}
+
+
+def test_change_token():
+    assert server._decode_change_token(server._encode_token([100, 7])) == (100, 7)
+    with pytest.raises(ValueError, match="Invalid since token"):
+        server._decode_change_token("garbage")
@@ -0,0 +1,89 @@
+from werkzeug.datastructures import MultiDict
+
+import server
+
+
+def version(conn, conv_id):
+    with conn.cursor() as cur:
+        cur.execute("SELECT change_txid, change_seq FROM conversations WHERE id = %s", (conv_id,))
+        row = cur.fetchone()
+    conn.commit()
+    return row
+
+
+def sync(conn, since=None, limit=10):
+    args = MultiDict({'fields': 'id,title', 'limit': str(limit)})
+    if since:
+        args['since'] = since
+    sql, params, limit, fields, since = server._conversation_changes_query(args)
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    conn.commit()
+    return server._changes_page(rows, limit, fields, since)
+
+
+def test_api_visible_changes_bump_the_version(db):
+    with db.cursor() as cur:
+        cur.execute("INSERT INTO conversations (conversation_text, created_at) "
+                    "VALUES ('a', NOW() AT TIME ZONE 'utc') RETURNING id")
+        conv_id = cur.fetchone()[0]
+    db.commit()
+    created = version(db, conv_id)
+
+    with db.cursor() as cur:
+        cur.execute("UPDATE conversations SET rating_score = 4 WHERE id = %s", (conv_id,))
+    db.commit()
+    assert version(db, conv_id) == created
+
+    with db.cursor() as cur:
+        cur.execute("UPDATE conversations SET title = 'renamed' WHERE id = %s", (conv_id,))
+    db.commit()
+    renamed = version(db, conv_id)
+    assert renamed > created
+
+    with db.cursor() as cur:
+        cur.execute('''
+            INSERT INTO conversation_photos (conversation_id, content_type, sha256, byte_size, data)
+            VALUES (%s, 'image/png', %s, 1, '\\x00')
+        ''', (conv_id, 'ab' * 32))
+    db.commit()
+    assert version(db, conv_id) > renamed
+
+
+def test_sync_returns_changes_then_tombstones(db):
+    with db.cursor() as cur:
+        cur.execute("INSERT INTO conversations (conversation_text, title, created_at) "
+                    "VALUES ('a', 'one', NOW() AT TIME ZONE 'utc'), "
+                    "('b', 'two', NOW() AT TIME ZONE 'utc') RETURNING id")
+        first, second = [row[0] for row in cur.fetchall()]
+    db.commit()
+
+    page = sync(db)
+    assert [item['id'] for item in page['items']] == [first, second]
+    assert page['deleted'] == [] and not page['has_more']
+
+    with db.cursor() as cur:
+        cur.execute("UPDATE conversations SET title = 'uno' WHERE id = %s", (first,))
+        cur.execute("DELETE FROM conversations WHERE id = %s", (second,))
+    db.commit()
+    later = sync(db, page['next_token'])
+    assert later['items'] == [{'id': first, 'title': 'uno'}]
+    assert later['deleted'] == [second]
+
+    # Nothing new: the token stays put.
+    assert sync(db, later['next_token'])['next_token'] == later['next_token']
+
+
+def test_sync_pages_through_changes(db):
+    with db.cursor() as cur:
+        cur.execute("INSERT INTO conversations (conversation_text, created_at) "
+                    "SELECT 'c' || n, NOW() AT TIME ZONE 'utc' "
+                    "FROM generate_series(1, 5) AS n")
+    db.commit()
+    seen, token, has_more = [], None, True
+    while has_more:
+        page = sync(db, token, limit=2)
+        seen += [item['id'] for item in page['items']]
+        token, has_more = page['next_token'], page['has_more']
+    assert len(seen) == len(set(seen)) == 5
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import server
+
+
+def test_token_round_trip_is_url_safe_and_unpadded():
+    values = [1.5, "a/b+c", None, 42]
+    token = server._encode_token(values)
+    assert "=" not in token and "/" not in token and "+" not in token
+    assert server._decode_token(token) == values
+
+
+def test_list_cursor_round_trip():
+    created_at = datetime(2024, 1, 2, 3, 4, 5, 678000)
+    token = server._encode_cursor(created_at, 17)
+    assert server._decode_cursor(token) == (created_at, 17)
+
+
+@pytest.mark.parametrize("token", ["", "not-base64!", server._encode_token([1]),
+                                   server._encode_token(["yesterday", 1])])
+def test_list_cursor_rejects_malformed_tokens(token):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        server._decode_cursor(token)
+
+
+def test_page_args_defaults_and_clamping():
+    assert server._parse_page_args(MultiDict()) == (server.DEFAULT_PAGE_SIZE, None)
+    limit, _ = server._parse_page_args(MultiDict({'limit': str(server.MAX_PAGE_SIZE + 1)}))
+    assert limit == server.MAX_PAGE_SIZE
+
+
+@pytest.mark.parametrize("limit, message", [("x", "integer"), ("0", "positive")])
+def test_page_args_reject_bad_limits(limit, message):
+    with pytest.raises(ValueError, match=message):
+        server._parse_page_args(MultiDict({'limit': limit}))
+
+
+def test_page_args_decode_the_cursor():
+    token = server._encode_cursor(datetime(2024, 1, 1), 3)
+    _, cursor = server._parse_page_args(MultiDict({'cursor': token}))
+    assert cursor == (datetime(2024, 1, 1), 3)
+
+
+def test_only_limit_or_cursor_asks_for_a_page():
+    assert not server._is_paged(MultiDict())
+    assert not server._is_paged(MultiDict({'fields': 'id', 'limit': ''}))
+    assert server._is_paged(MultiDict({'limit': '10'}))
+    assert server._is_paged(MultiDict({'cursor': server._encode_cursor(datetime(2024, 1, 1), 3)}))
+
+
+def test_unpaged_lists_stop_at_the_ceiling(monkeypatch):
+    monkeypatch.setattr(server, 'MAX_UNPAGED_ROWS', 2)
+    sql, params, limit, fields = server._list_conversations_query(MultiDict({'fields': 'id'}), "")
+    assert limit is None and params[-1] == 3
+    row = (1, datetime(2024, 1, 1), 1)
+    assert server._conversation_page([row, row], None, fields) == [{'id': 1}, {'id': 1}]
+    with pytest.raises(ValueError, match="More than 2 rows"):
+        server._conversation_page([row, row, row], None, fields)